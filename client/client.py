@@ -2,6 +2,8 @@ import asyncio
 import ssl
 import sys
 import json
+import random
+import time
 from pathlib import Path
 from datetime import datetime
 import threading
@@ -10,7 +12,11 @@ from colorama import init, Fore, Style
 # Add parent directory to path
 sys.path.append(str(Path(__file__).parent.parent))
 
-from common.protocol import Message, MessageType, Priority
+from common.framing import FrameProtocol
+from common.protocol import (
+    Message, MessageType, Priority, SUPPORTED_CODECS, CODEC_JSON, CODEC_BINARY,
+    FILE_STREAM_MAGIC, pack_file_chunk, unpack_file_chunk
+)
 
 # Import from current directory
 from ui_manager import UIManager
@@ -19,16 +25,29 @@ from file_manager import FileManager
 init(autoreset=True)  # Initialize colorama
 
 class ChatClient:
-    def __init__(self, host='localhost', port=8888):
+    def __init__(self, host='localhost', port=8888, codecs=None):
         self.host = host
         self.port = port
+        self.codecs = codecs or SUPPORTED_CODECS  # offered to the server, in order of preference
         self.reader = None
         self.writer = None
         self.ui = UIManager()
         self.file_manager = FileManager()
         self.username = None
         self.current_room = None
+        self.last_message_id = None  # newest room message seen, for catching up after a reconnect
         self.running = False
+        self.resume_token = None
+        self.max_reconnect_delay = 10
+        self.codec = CODEC_JSON  # upgraded once the server agrees on a codec
+        self.file_window = 16  # file chunks in flight before waiting for FILE_ACKs
+        self.file_ack_timeout = 30
+        self.file_credits = {}  # {transfer_id: Semaphore of chunks we may still send}
+        self.file_needs = {}  # {transfer_id: Future for the server's FILE_NEED reply}
+        self.out_frames = []  # queued during this pass of the event loop, written together
+        self.flush_waiter = None  # resolved once out_frames has been written
+        self.write_stats = {'writes': 0, 'frames': 0, 'bytes': 0}
+        self.trace_sample_rate = 0  # share of our text messages to trace, set by the server
         self.ssl_context = self._create_ssl_context()
     
     def _create_ssl_context(self):
@@ -38,34 +57,70 @@ class ChatClient:
         return ssl_context
     
     async def connect(self):
+        # Set first: the receive loop started by _open_connection runs while we wait on the send
+        self.running = True
+        if not await self._open_connection():
+            self.running = False
+            return False
+        
+        self.ui.print_success("Connected to server")
+        
+        # Start heartbeat
+        asyncio.create_task(self._send_heartbeat())
+        
+        return True
+    
+    async def _open_connection(self):
         try:
-            self.reader, self.writer = await asyncio.open_connection(
-                self.host, self.port, ssl=self.ssl_context
+            # One FrameProtocol both reads and writes the connection
+            _, self.writer = await asyncio.get_running_loop().create_connection(
+                FrameProtocol, self.host, self.port, ssl=self.ssl_context
             )
-            self.running = True
-            self.ui.print_success("Connected to server")
-            
-            # Start receiving messages
-            asyncio.create_task(self._receive_messages())
-            
-            # Start heartbeat
-            asyncio.create_task(self._send_heartbeat())
-            
-            return True
+            self.reader = self.writer
         except Exception as e:
             self.ui.print_error(f"Failed to connect: {e}")
             return False
+        
+        # Start receiving messages
+        asyncio.create_task(self._receive_messages())
+        
+        # Offer the compact binary codec; JSON stays in use until the server agrees
+        self.codec = CODEC_JSON
+        await self.send_message(Message(
+            MessageType.SERVER_INFO,
+            {'codecs': self.codecs},
+            priority=Priority.HIGH
+        ))
+        return True
+    
+    async def _reconnect(self):
+        # Jittered exponential backoff keeps a server-wide blip from
+        # turning into a synchronized reconnect storm
+        delay = 0.5
+        while self.running:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            self.ui.print_system("Reconnecting...")
+            if await self._open_connection():
+                await self.send_message(Message(
+                    MessageType.RESUME_REQUEST,
+                    {
+                        'token': self.resume_token,
+                        'room_id': self.current_room,
+                        'last_message_id': self.last_message_id
+                    },
+                    priority=Priority.HIGH
+                ))
+                return
+            delay = min(delay * 2, self.max_reconnect_delay)
     
     async def _receive_messages(self):
         while self.running:
             try:
-                # Read message length
-                import struct
-                length_data = await self.reader.readexactly(4)
-                length = struct.unpack('!I', length_data)[0]
-                
-                # Read message data
-                data = await self.reader.readexactly(length)
+                # Valid until the next read_frame(); handlers copy what they keep
+                data = await self.reader.read_frame()
+                if data[0] == FILE_STREAM_MAGIC:
+                    await self._handle_file_stream(data)
+                    continue
                 message = Message.from_bytes(data)
                 
                 await self._handle_message(message)
@@ -77,19 +132,28 @@ class ChatClient:
                 self.ui.print_error(f"Error receiving message: {e}")
                 break
         
-        self.running = False
+        if self.running and self.resume_token:
+            asyncio.create_task(self._reconnect())
+        else:
+            self.running = False
     
     async def _handle_message(self, message):
         handlers = {
             MessageType.AUTH_RESPONSE: self._handle_auth_response,
+            MessageType.RESUME_RESPONSE: self._handle_resume_response,
             MessageType.REGISTER_RESPONSE: self._handle_register_response,
             MessageType.TEXT_MESSAGE: self._handle_text_message,
             MessageType.USER_LIST: self._handle_user_list,
             MessageType.ROOM_INFO: self._handle_room_info,
             MessageType.SUCCESS: self._handle_success,
             MessageType.ERROR: self._handle_error,
+            MessageType.FILE_TRANSFER: self._handle_file_transfer,
             MessageType.FILE_CHUNK: self._handle_file_chunk,
+            MessageType.FILE_ACK: self._handle_file_ack,
+            MessageType.FILE_NEED: self._handle_file_need,
+            MessageType.HISTORY: self._handle_history,
             MessageType.HEARTBEAT: self._handle_heartbeat,
+            MessageType.SERVER_INFO: self._handle_server_info,
         }
         
         handler = handlers.get(message.type)
@@ -100,10 +164,36 @@ class ChatClient:
         while self.running:
             await asyncio.sleep(30)
             await self.send_message(Message(MessageType.HEARTBEAT))
+            await self._fetch_missing_chunks(self.file_manager.stalled_transfers(min_idle=30))
+            self.file_manager.evict_idle_transfers()
+    
+    def _queue_frame(self, frame):
+        """Frames queued in one pass of the event loop go out in a single write;
+        returns a future resolved once it has been handed to the transport"""
+        self.out_frames.append(frame)
+        if self.flush_waiter is None:
+            loop = asyncio.get_running_loop()
+            self.flush_waiter = loop.create_future()
+            loop.call_soon(self._flush)
+        return self.flush_waiter
+    
+    def _flush(self):
+        waiter, self.flush_waiter = self.flush_waiter, None
+        frames, self.out_frames = self.out_frames, []
+        data = b''.join(frames)
+        try:
+            self.writer.write(data)
+        except Exception as e:
+            waiter.set_exception(e)
+            return
+        self.write_stats['writes'] += 1
+        self.write_stats['frames'] += len(frames)
+        self.write_stats['bytes'] += len(data)
+        waiter.set_result(None)
     
     async def send_message(self, message):
         try:
-            self.writer.write(message.to_bytes())
+            await self._queue_frame(message.to_bytes(self.codec))
             await self.writer.drain()
         except Exception as e:
             self.ui.print_error(f"Failed to send message: {e}")
@@ -147,6 +237,9 @@ class ChatClient:
             priority=Priority.NORMAL,
             room_id=self.current_room
         )
+        if self.trace_sample_rate and random.random() < self.trace_sample_rate:
+            # Every member receiving it reports back when, for the server's latency stats
+            message.data['trace'] = {'id': f"{random.getrandbits(64):016x}", 'sent': time.monotonic_ns()}
         await self.send_message(message)
         
         # Display own message
@@ -160,35 +253,113 @@ class ChatClient:
         message = Message(MessageType.USER_LIST)
         await self.send_message(message)
     
+    async def request_history(self, since=None):
+        message = Message(
+            MessageType.HISTORY,
+            {'since': since}
+        )
+        await self.send_message(message)
+    
     async def send_file(self, file_path):
         if not self.current_room:
             self.ui.print_error("You must join a room first")
             return
         
-        chunks = self.file_manager.prepare_file(file_path)
-        if not chunks:
+        # Hashing every chunk reads the whole file; keep it off the event loop
+        loop = asyncio.get_running_loop()
+        metadata = await loop.run_in_executor(None, self.file_manager.prepare_file, file_path)
+        if not metadata:
             return
         
-        for chunk in chunks:
-            message = Message(
+        transfer_id = metadata['transfer_id']
+        streaming = self.codec == CODEC_BINARY
+        need = self.file_needs[transfer_id] = loop.create_future()
+        # Window flow control: every chunk takes a credit, every FILE_ACK returns one
+        credits = self.file_credits[transfer_id] = asyncio.Semaphore(self.file_window)
+        try:
+            # Announce the manifest; the server answers with the chunks it does not
+            # hold yet, so a file it has seen before is not uploaded again
+            await self.send_message(Message(
                 MessageType.FILE_TRANSFER,
-                chunk,
+                metadata,
                 priority=Priority.LOW,
                 room_id=self.current_room
-            )
-            await self.send_message(message)
-            await asyncio.sleep(0.1)  # Rate limiting
+            ))
+            missing = await asyncio.wait_for(need, self.file_ack_timeout)
+            
+            for chunk_num, data in self.file_manager.read_chunks(file_path, metadata['chunk_size'], missing):
+                await asyncio.wait_for(credits.acquire(), self.file_ack_timeout)
+                if streaming:
+                    await self._queue_frame(pack_file_chunk(transfer_id, chunk_num, data))
+                    await self.writer.drain()
+                else:
+                    await self.send_message(Message(
+                        MessageType.FILE_TRANSFER,
+                        {
+                            'transfer_id': transfer_id,
+                            'filename': metadata['filename'],
+                            'size': metadata['size'],
+                            'chunk_size': metadata['chunk_size'],
+                            'chunk_num': chunk_num,
+                            'total_chunks': metadata['total_chunks'],
+                            'data': data
+                        },
+                        priority=Priority.LOW,
+                        room_id=self.current_room
+                    ))
+        except asyncio.TimeoutError:
+            self.ui.print_error("File transfer stalled: no acknowledgement from server")
+            return
+        except Exception as e:
+            self.ui.print_error(f"Failed to send file: {e}")
+            return
+        finally:
+            del self.file_credits[transfer_id]
+            del self.file_needs[transfer_id]
         
-        self.ui.print_success(f"File sent: {Path(file_path).name}")
+        self.ui.print_success(
+            f"File sent: {Path(file_path).name} "
+            f"({len(missing)}/{metadata['total_chunks']} chunks uploaded)"
+        )
+    
+    async def _fetch_missing_chunks(self, transfer_ids):
+        # Ask the server's content store for whatever an interrupted transfer lacks
+        for transfer_id in transfer_ids:
+            transfer = self.file_manager.active_transfers.get(transfer_id)
+            if not transfer or not transfer['file_hash']:
+                continue
+            missing = self.file_manager.missing_chunks(transfer_id)
+            if missing:
+                await self.send_message(Message(
+                    MessageType.FILE_FETCH,
+                    {
+                        'file_hash': transfer['file_hash'],
+                        'filename': transfer['filename'],
+                        'chunks': missing
+                    },
+                    priority=Priority.LOW
+                ))
     
     # Message handlers
     async def _handle_auth_response(self, message):
         if message.data['success']:
             self.ui.print_success("Login successful!")
             self.username = message.data.get('username')
+            self.resume_token = message.data.get('resume_token')
         else:
             self.ui.print_error(f"Login failed: {message.data.get('error')}")
     
+    async def _handle_resume_response(self, message):
+        if message.data['success']:
+            self.resume_token = message.data.get('resume_token')
+            self.current_room = message.data.get('room_id')
+            self.ui.print_success("Session resumed")
+            await self._fetch_missing_chunks(list(self.file_manager.active_transfers))
+        else:
+            self.resume_token = None
+            self.current_room = None
+            self.ui.print_error(f"Could not resume session: {message.data.get('error')}. Please /login again")
+    
     async def _handle_register_response(self, message):
         if message.data['success']:
             self.ui.print_success("Registration successful! Please login.")
@@ -196,6 +367,16 @@ class ChatClient:
             self.ui.print_error(f"Registration failed: {message.data.get('error')}")
     
     async def _handle_text_message(self, message):
+        trace = message.data.get('trace')
+        if trace:
+            await self.send_message(Message(
+                MessageType.TRACE_RECEIPT,
+                {'id': trace.get('id'), 'sent': trace.get('sent'), 'received': time.monotonic_ns()},
+                priority=Priority.LOW,
+                room_id=message.room_id
+            ))
+        if self.last_message_id is None or message.id > self.last_message_id:
+            self.last_message_id = message.id
         self.ui.print_message(
             message.data['username'],
             message.data['text'],
@@ -218,16 +399,60 @@ class ChatClient:
     
     async def _handle_success(self, message):
         if 'room_id' in message.data:
+            if message.data['room_id'] != self.current_room:
+                self.last_message_id = None
             self.current_room = message.data['room_id']
             self.ui.print_success(f"Successfully joined room: {message.data.get('name', self.current_room)}")
     
+    async def _handle_history(self, message):
+        if message.data['count']:
+            more = " (more available: /history <last id>)" if message.data['more'] else ""
+            self.ui.print_system(
+                f"Replayed {message.data['count']} messages "
+                f"#{message.data['first_id']:.0f}-#{message.data['last_id']:.0f}{more}"
+            )
+    
     async def _handle_error(self, message):
         self.ui.print_error(message.data.get('error', 'Unknown error'))
     
+    async def _handle_file_transfer(self, message):
+        if message.data['transfer_id'] in self.file_manager.active_transfers:
+            # Posted again while we still had a partial copy: top it up
+            await self._fetch_missing_chunks([message.data['transfer_id']])
+            return
+        
+        self.file_manager.start_transfer(message.data)
+        self.ui.print_system(
+            f"{message.data['username']} is sending {message.data['filename']} "
+            f"({message.data['size']} bytes)"
+        )
+    
     async def _handle_file_chunk(self, message):
         if self.file_manager.receive_chunk(message.data):
             self.ui.print_success(f"File received: {message.data['filename']}")
     
+    async def _handle_file_stream(self, data):
+        transfer_id, chunk_num, payload = unpack_file_chunk(data)
+        transfer = self.file_manager.active_transfers.get(transfer_id)
+        if transfer and self.file_manager.receive_stream_chunk(transfer_id, chunk_num, payload):
+            self.ui.print_success(f"File received: {transfer['filename']}")
+    
+    async def _handle_file_need(self, message):
+        need = self.file_needs.get(message.data['transfer_id'])
+        if need and not need.done():
+            need.set_result(message.data['chunks'])
+    
+    async def _handle_file_ack(self, message):
+        credits = self.file_credits.get(message.data['transfer_id'])
+        if credits:
+            credits.release()
+    
+    async def _handle_server_info(self, message):
+        codec = message.data.get('codec')
+        if codec in SUPPORTED_CODECS:
+            self.codec = codec
+        self.trace_sample_rate = message.data.get('trace_sample_rate', 0)
+    
     async def _handle_heartbeat(self, message):
         # Heartbeat response received
         pass
@@ -235,6 +460,10 @@ class ChatClient:
     async def disconnect(self):
         self.running = False
         if self.writer:
+            if self.resume_token:
+                # Ends the session on the server, so the resume token cannot be used again
+                await self.send_message(Message(MessageType.LOGOUT, priority=Priority.HIGH))
+                self.resume_token = None
             self.writer.close()
             await self.writer.wait_closed()
     
@@ -276,6 +505,7 @@ class ChatClient:
             '/join': lambda: self.join_room(parts[1]) if len(parts) >= 2 else self.ui.print_error("Usage: /join <room_id>"),
             '/rooms': self.list_rooms,
             '/users': self.list_users,
+            '/history': lambda: self.request_history(int(parts[1]) if len(parts) >= 2 else None),
             '/file': lambda: self.send_file(parts[1]) if len(parts) >= 2 else self.ui.print_error("Usage: /file <path>"),
             '/quit': self._quit
         }
@@ -297,6 +527,7 @@ Available commands:
   /join <room_id>          - Join a room
   /rooms                   - List all rooms
   /users                   - List users in current room
+  /history [id]            - Show recent messages, or those after message id
   /file <path>             - Send a file
   /quit                    - Quit the application
         """
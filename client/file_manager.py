@@ -1,16 +1,29 @@
 import os
 import json
+import time
 import base64
+import hashlib
+import re
 from pathlib import Path
+from common.manifest import hash_chunk, build_manifest_blob, transfer_id_for
+
+# 16 bytes on the wire; as hex it names the .part file, so nothing else may pass
+_TRANSFER_ID = re.compile(r'[0-9a-f]{32}')
 
 class FileManager:
-    def __init__(self, download_dir='downloads'):
+    def __init__(self, download_dir='downloads', chunk_size=64 * 1024, max_file_size=1024 * 1024 * 1024):
         self.download_dir = Path(download_dir)
         self.download_dir.mkdir(exist_ok=True)
         self.active_transfers = {}
-        self.chunk_size = 4096  # 4KB chunks
+        self.chunk_size = chunk_size
+        self.max_file_size = max_file_size
     
     def prepare_file(self, file_path):
+        """Build the manifest for an outgoing transfer (hashes every chunk).
+
+        The data itself is read again lazily by read_chunks, and only for
+        the chunks the server asks for.
+        """
         try:
             path = Path(file_path)
             if not path.exists():
@@ -18,64 +31,134 @@ class FileManager:
                 return None
             
             file_size = path.stat().st_size
-            if file_size > 10 * 1024 * 1024:  # 10MB limit
-                print("File too large (max 10MB)")
+            if file_size > self.max_file_size:
+                print(f"File too large (max {self.max_file_size // (1024 * 1024)}MB)")
                 return None
             
-            chunks = []
-            transfer_id = os.urandom(16).hex()
-            
-            with open(path, 'rb') as f:
-                chunk_num = 0
-                while True:
-                    data = f.read(self.chunk_size)
-                    if not data:
-                        break
-                    
-                    chunk = {
-                        'transfer_id': transfer_id,
-                        'filename': path.name,
-                        'chunk_num': chunk_num,
-                        'total_chunks': -1,  # Will be set later
-                        'data': base64.b64encode(data).decode('utf-8')
-                    }
-                    chunks.append(chunk)
-                    chunk_num += 1
-            
-            # Set total chunks
-            for chunk in chunks:
-                chunk['total_chunks'] = len(chunks)
+            chunk_hashes = [
+                hash_chunk(data) for _, data in self.read_chunks(path, self.chunk_size)
+            ]
+            file_hash = hashlib.sha256(
+                build_manifest_blob(file_size, self.chunk_size, chunk_hashes)
+            ).hexdigest()
             
-            print(f"Prepared {len(chunks)} chunks for {path.name}")
-            return chunks
+            return {
+                'transfer_id': transfer_id_for(file_hash),
+                'file_hash': file_hash,
+                'filename': path.name,
+                'size': file_size,
+                'chunk_size': self.chunk_size,
+                'total_chunks': len(chunk_hashes),
+                'chunk_hashes': chunk_hashes
+            }
             
         except Exception as e:
             print(f"Error preparing file: {e}")
             return None
     
+    def read_chunks(self, file_path, chunk_size, chunk_nums=None):
+        """Yield (chunk_num, data) straight from disk, one chunk in memory at a time"""
+        with open(file_path, 'rb') as f:
+            if chunk_nums is not None:
+                for chunk_num in chunk_nums:
+                    f.seek(chunk_num * chunk_size)
+                    yield chunk_num, f.read(chunk_size)
+                return
+            
+            chunk_num = 0
+            while True:
+                data = f.read(chunk_size)
+                if not data and chunk_num > 0:
+                    break
+                yield chunk_num, data
+                chunk_num += 1
+                if len(data) < chunk_size:
+                    break
+    
+    def start_transfer(self, metadata):
+        """Open a preallocated .part file that chunks are written into as they arrive"""
+        transfer_id = metadata.get('transfer_id')
+        if not isinstance(transfer_id, str) or not _TRANSFER_ID.fullmatch(transfer_id):
+            print(f"Ignoring file transfer with invalid id {transfer_id!r}")
+            return None
+        if transfer_id in self.active_transfers:
+            return self.active_transfers[transfer_id]
+        
+        total_chunks = metadata['total_chunks']
+        # Chunks from senders that predate the start message are 4 KB, and carry no size
+        chunk_size = metadata.get('chunk_size', 4096)
+        size = metadata.get('size')
+        if size is not None and (type(size) is not int or not 0 <= size <= self.max_file_size):
+            print(f"Ignoring {metadata['filename']}: invalid size ({size} bytes)")
+            return None
+        # The chunks must fit the size, or max_file_size if there is none
+        limit = self.max_file_size if size is None else size
+        if (type(chunk_size) is not int or chunk_size <= 0 or type(total_chunks) is not int
+                or not 0 <= total_chunks <= limit // chunk_size + 1):
+            print(f"Ignoring {metadata['filename']}: invalid chunking")
+            return None
+        
+        part_path = self.download_dir / f".{transfer_id}.part"
+        f = open(part_path, 'wb+')
+        if size is not None:
+            f.truncate(size)
+        
+        transfer = self.active_transfers[transfer_id] = {
+            'filename': Path(metadata['filename']).name,
+            'file_hash': metadata.get('file_hash'),
+            'chunk_hashes': metadata.get('chunk_hashes'),
+            'file': f,
+            'part_path': part_path,
+            'chunk_size': chunk_size,
+            'total_chunks': total_chunks,
+            'received': bytearray((total_chunks + 7) // 8),  # bitmap, one bit per chunk
+            'received_count': 0,
+            'last_activity': time.monotonic()
+        }
+        return transfer
+    
     def receive_chunk(self, chunk_data):
-        transfer_id = chunk_data['transfer_id']
+        if self.start_transfer(chunk_data) is None:
+            return False
+        data = chunk_data['data']
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        return self.receive_stream_chunk(chunk_data['transfer_id'], chunk_data['chunk_num'], data)
+    
+    def receive_stream_chunk(self, transfer_id, chunk_num, data):
+        transfer = self.active_transfers.get(transfer_id)
+        if transfer is None or not 0 <= chunk_num < transfer['total_chunks']:
+            return False
         
-        if transfer_id not in self.active_transfers:
-            self.active_transfers[transfer_id] = {
-                'filename': chunk_data['filename'],
-                'chunks': {},
-                'total_chunks': chunk_data['total_chunks']
-            }
+        transfer['last_activity'] = time.monotonic()
+        byte_index, bit = divmod(chunk_num, 8)
+        if transfer['received'][byte_index] & (1 << bit):
+            return False  # duplicate
+        if transfer['chunk_hashes'] and hash_chunk(data) != transfer['chunk_hashes'][chunk_num]:
+            print(f"Discarding corrupt chunk {chunk_num} of {transfer['filename']}")
+            return False  # left missing, so it is fetched again
         
-        transfer = self.active_transfers[transfer_id]
-        transfer['chunks'][chunk_data['chunk_num']] = base64.b64decode(chunk_data['data'])
+        try:
+            f = transfer['file']
+            f.seek(chunk_num * transfer['chunk_size'])
+            f.write(data)
+        except Exception as e:
+            print(f"Error writing chunk: {e}")
+            self._discard_transfer(transfer_id)
+            return False
+        
+        transfer['received'][byte_index] |= 1 << bit
+        transfer['received_count'] += 1
         
         # Check if transfer is complete
-        if len(transfer['chunks']) == transfer['total_chunks']:
+        if transfer['received_count'] == transfer['total_chunks']:
             return self._complete_transfer(transfer_id)
         
         return False
     
     def _complete_transfer(self, transfer_id):
-        transfer = self.active_transfers[transfer_id]
+        transfer = self.active_transfers.pop(transfer_id)
         
-        # Reassemble file
         file_path = self.download_dir / transfer['filename']
         
         # Add number if file exists
@@ -88,14 +171,50 @@ class FileManager:
                 counter += 1
         
         try:
-            with open(file_path, 'wb') as f:
-                for i in range(transfer['total_chunks']):
-                    f.write(transfer['chunks'][i])
-            
-            del self.active_transfers[transfer_id]
+            f = transfer['file']
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            # The file only appears under its real name once it is complete
+            os.replace(transfer['part_path'], file_path)
             print(f"File saved: {file_path}")
             return True
             
         except Exception as e:
             print(f"Error saving file: {e}")
+            transfer['part_path'].unlink(missing_ok=True)
             return False
+    
+    def missing_chunks(self, transfer_id):
+        transfer = self.active_transfers[transfer_id]
+        received = transfer['received']
+        return [
+            chunk_num for chunk_num in range(transfer['total_chunks'])
+            if not received[chunk_num >> 3] & (1 << (chunk_num & 7))
+        ]
+    
+    def stalled_transfers(self, min_idle):
+        """Transfers that stopped receiving chunks; they can be topped up with a fetch"""
+        now = time.monotonic()
+        return [
+            transfer_id for transfer_id, transfer in self.active_transfers.items()
+            if transfer['file_hash'] and now - transfer['last_activity'] > min_idle
+        ]
+    
+    def _discard_transfer(self, transfer_id):
+        transfer = self.active_transfers.pop(transfer_id, None)
+        if transfer:
+            transfer['file'].close()
+            transfer['part_path'].unlink(missing_ok=True)
+    
+    def evict_idle_transfers(self, max_idle=300):
+        """Drop transfers that have not received a chunk for max_idle seconds"""
+        now = time.monotonic()
+        idle = [
+            transfer_id for transfer_id, transfer in self.active_transfers.items()
+            if now - transfer['last_activity'] > max_idle
+        ]
+        for transfer_id in idle:
+            print(f"Abandoning incomplete transfer of {self.active_transfers[transfer_id]['filename']}")
+            self._discard_transfer(transfer_id)
+        return len(idle)
@@ -0,0 +1,129 @@
+import struct
+
+# Compact tagged encoding for message payloads (MessagePack-style).
+# Every value starts with a one-byte tag; containers carry their length.
+T_NONE = 0x00
+T_FALSE = 0x01
+T_TRUE = 0x02
+T_INT8 = 0x03
+T_INT64 = 0x04
+T_FLOAT = 0x05
+T_STR8 = 0x06
+T_STR32 = 0x07
+T_BYTES = 0x08
+T_LIST = 0x09
+T_DICT = 0x0A
+
+_pack_b = struct.Struct('!Bb').pack
+_pack_q = struct.Struct('!Bq').pack
+_pack_d = struct.Struct('!Bd').pack
+_pack_len8 = struct.Struct('!BB').pack
+_pack_len32 = struct.Struct('!BI').pack
+_unpack_b = struct.Struct('!b').unpack_from
+_unpack_q = struct.Struct('!q').unpack_from
+_unpack_d = struct.Struct('!d').unpack_from
+_unpack_I = struct.Struct('!I').unpack_from
+
+def _pack_str(value, out):
+    raw = value.encode('utf-8')
+    if len(raw) < 256:
+        out.append(_pack_len8(T_STR8, len(raw)))
+    else:
+        out.append(_pack_len32(T_STR32, len(raw)))
+    out.append(raw)
+
+def _pack(value, out):
+    if value is None:
+        out.append(b'\x00')
+    elif value is True:
+        out.append(b'\x02')
+    elif value is False:
+        out.append(b'\x01')
+    elif isinstance(value, str):
+        _pack_str(value, out)
+    elif isinstance(value, int):
+        if -128 <= value < 128:
+            out.append(_pack_b(T_INT8, value))
+        else:
+            out.append(_pack_q(T_INT64, value))
+    elif isinstance(value, float):
+        out.append(_pack_d(T_FLOAT, value))
+    elif isinstance(value, dict):
+        out.append(_pack_len32(T_DICT, len(value)))
+        for key, item in value.items():
+            _pack_str(key, out)
+            _pack(item, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(_pack_len32(T_LIST, len(value)))
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(_pack_len32(T_BYTES, len(value)))
+        out.append(value)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+def pack_value(value):
+    out = []
+    _pack(value, out)
+    return b''.join(out)
+
+def _unpack(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag == T_STR8:
+        end = pos + 1 + buf[pos]
+        return str(buf[pos + 1:end], 'utf-8'), end
+    if tag == T_DICT:
+        count = _unpack_I(buf, pos)[0]
+        pos += 4
+        result = {}
+        for _ in range(count):
+            if buf[pos] == T_STR8:
+                # Short keys are the common case; skip the recursive call
+                end = pos + 2 + buf[pos + 1]
+                key = str(buf[pos + 2:end], 'utf-8')
+                pos = end
+            else:
+                key, pos = _unpack(buf, pos)
+            result[key], pos = _unpack(buf, pos)
+        return result, pos
+    if tag == T_INT8:
+        return _unpack_b(buf, pos)[0], pos + 1
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_INT64:
+        return _unpack_q(buf, pos)[0], pos + 8
+    if tag == T_FLOAT:
+        return _unpack_d(buf, pos)[0], pos + 8
+    if tag == T_STR32:
+        length = _unpack_I(buf, pos)[0]
+        pos += 4
+        return str(buf[pos:pos + length], 'utf-8'), pos + length
+    if tag == T_BYTES:
+        length = _unpack_I(buf, pos)[0]
+        pos += 4
+        return bytes(buf[pos:pos + length]), pos + length
+    if tag == T_LIST:
+        count = _unpack_I(buf, pos)[0]
+        pos += 4
+        result = []
+        append = result.append
+        for _ in range(count):
+            if buf[pos] == T_STR8:
+                end = pos + 2 + buf[pos + 1]
+                append(str(buf[pos + 2:end], 'utf-8'))
+                pos = end
+            else:
+                item, pos = _unpack(buf, pos)
+                append(item)
+        return result, pos
+    raise ValueError(f"Unknown value tag {tag:#x}")
+
+def unpack_value(buf, pos=0):
+    """Decode one value from buf (bytes or memoryview); returns (value, next_pos)"""
+    return _unpack(buf, pos)
@@ -0,0 +1,206 @@
+import asyncio
+import struct
+
+# Every frame on a client connection: [4 bytes length][body]
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+class FrameTooLarge(ValueError):
+    """A length prefix above the connection's max_frame_size"""
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """Length-prefixed frames over one connection, read without per-frame copies.
+
+    The transport receives straight into a reusable bytearray, grown only
+    for frames larger than it. read_frame() returns the next frame body as
+    a memoryview into that buffer, valid until the following read_frame()
+    call; frames already received are returned without going back to the
+    event loop. A length prefix above max_frame_size raises FrameTooLarge
+    before any of the body is buffered. Reading pauses while more than
+    high_water bytes of complete frames wait to be read.
+
+    The same object writes to the connection, with the StreamWriter calls
+    ConnectionWriter and ChatClient use. If on_connection is given, it is
+    started as a task with the protocol once the connection is made, as
+    asyncio.start_server does with its callback.
+    """
+    def __init__(self, on_connection=None, max_frame_size=MAX_FRAME_SIZE, buffer_size=64 * 1024,
+                 high_water=256 * 1024):
+        self.on_connection = on_connection
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self.high_water = high_water
+        self.min_read = 16 * 1024  # free space asked of the buffer for each receive
+        self.transport = None
+        self.stats = {
+            'reads': 0,
+            'frames': 0,
+            'bytes': 0,
+            'buffer_growths': 0
+        }
+        self._buffer = bytearray(buffer_size)
+        self._start = 0  # first byte not yet handed out
+        self._end = 0  # end of the bytes received
+        self._frame_size = 0  # header + body of the frame being received, once its header is in
+        self._lent = False  # a frame view into _buffer may still be in use
+        self._eof = False
+        self._exception = None
+        self._reading_paused = False
+        self._read_waiter = None
+        self._writing_paused = False
+        self._drain_waiters = []
+        self._closed = None
+        self._task = None
+    
+    # Transport side
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        self._closed = loop.create_future()
+        if self.on_connection is not None:
+            self._task = loop.create_task(self.on_connection(self))
+    
+    def get_buffer(self, sizehint):
+        if len(self._buffer) - self._end < self.min_read:
+            self._make_room()
+        return memoryview(self._buffer)[self._end:]
+    
+    def _make_room(self):
+        pending = self._end - self._start
+        size = max(self.buffer_size, pending + self.min_read, self._frame_size)
+        if self._lent or size != len(self._buffer):
+            # A fresh buffer: a frame view handed out keeps the old one alive
+            buffer = bytearray(size)
+            buffer[:pending] = self._buffer[self._start:self._end]
+            if size > self.buffer_size:
+                self.stats['buffer_growths'] += 1
+            self._buffer = buffer
+            self._lent = False
+        else:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start, self._end = 0, pending
+    
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        self.stats['reads'] += 1
+        self.stats['bytes'] += nbytes
+        
+        available = self._end - self._start
+        if available < max(FRAME_HEADER.size, self._frame_size):
+            return
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+        if available > self.high_water and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+    
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+    
+    def connection_lost(self, exc):
+        self._eof = True
+        self._exception = exc
+        self._wake_reader()
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+    
+    def pause_writing(self):
+        self._writing_paused = True
+    
+    def resume_writing(self):
+        self._writing_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+    
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+    
+    # Reading
+    
+    def _next_frame(self):
+        available = self._end - self._start
+        if available < FRAME_HEADER.size:
+            return None
+        length = FRAME_HEADER.unpack_from(self._buffer, self._start)[0]
+        if length > self.max_frame_size:
+            raise FrameTooLarge(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+        
+        self._frame_size = FRAME_HEADER.size + length
+        if available < self._frame_size:
+            return None
+        
+        start = self._start + FRAME_HEADER.size
+        self._start += self._frame_size
+        self._frame_size = 0
+        self._lent = True
+        self.stats['frames'] += 1
+        return memoryview(self._buffer)[start:start + length]
+    
+    async def read_frame(self):
+        """Next frame body as a memoryview; raises IncompleteReadError at end of stream"""
+        self._lent = False  # the previous frame is done with
+        while True:
+            frame = self._next_frame()
+            if frame is not None:
+                if self._reading_paused and self._end - self._start <= self.high_water // 2:
+                    self._resume_reading()
+                return frame
+            
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                partial = bytes(self._buffer[self._start:self._end])
+                raise asyncio.IncompleteReadError(partial, self._frame_size or None)
+            
+            if self._reading_paused:
+                self._resume_reading()
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+    
+    def _resume_reading(self):
+        self._reading_paused = False
+        self.transport.resume_reading()
+    
+    # Writing
+    
+    def write(self, data):
+        self.transport.write(data)
+    
+    async def drain(self):
+        if self.transport.is_closing():
+            # Let connection_lost run, as StreamWriter.drain does
+            await asyncio.sleep(0)
+        if self._closed.done():
+            raise ConnectionResetError('Connection lost')
+        if not self._writing_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+        if self._closed.done():
+            raise ConnectionResetError('Connection lost')
+    
+    def is_closing(self):
+        return self.transport.is_closing()
+    
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+    
+    def close(self):
+        self.transport.close()
+    
+    async def wait_closed(self):
+        await self._closed
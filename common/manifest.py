@@ -0,0 +1,25 @@
+import hashlib
+import struct
+
+# A file is identified by the hash of its manifest blob:
+# [size: u64][chunk size: u32][sha256 of each chunk, 32 bytes apiece].
+# Verifying every chunk against the manifest therefore verifies the file.
+MANIFEST_HEADER = struct.Struct('!QI')
+
+def hash_chunk(data):
+    return hashlib.sha256(data).hexdigest()
+
+def build_manifest_blob(size, chunk_size, chunk_hashes):
+    return MANIFEST_HEADER.pack(size, chunk_size) + b''.join(
+        bytes.fromhex(chunk_hash) for chunk_hash in chunk_hashes
+    )
+
+def parse_manifest_blob(blob):
+    size, chunk_size = MANIFEST_HEADER.unpack_from(blob)
+    digests = memoryview(blob)[MANIFEST_HEADER.size:]
+    chunk_hashes = [digests[i:i + 32].hex() for i in range(0, len(digests), 32)]
+    return size, chunk_size, chunk_hashes
+
+def transfer_id_for(file_hash):
+    # Transfer ids are 16 bytes on the wire; a hash prefix keeps them content-addressed
+    return file_hash[:32]
@@ -1,7 +1,11 @@
 import json
 import struct
+import time
+import uuid
+import base64
 from enum import Enum
 from datetime import datetime
+from common.codec import pack_value, unpack_value
 
 class MessageType(Enum):
     # Authentication
@@ -9,6 +13,9 @@ class MessageType(Enum):
     AUTH_RESPONSE = "auth_response"
     REGISTER_REQUEST = "register_request"
     REGISTER_RESPONSE = "register_response"
+    RESUME_REQUEST = "resume_request"
+    RESUME_RESPONSE = "resume_response"
+    LOGOUT = "logout"
     
     # Room Management
     CREATE_ROOM = "create_room"
@@ -21,6 +28,11 @@ class MessageType(Enum):
     TEXT_MESSAGE = "text_message"
     FILE_TRANSFER = "file_transfer"
     FILE_CHUNK = "file_chunk"
+    FILE_ACK = "file_ack"
+    FILE_NEED = "file_need"
+    FILE_FETCH = "file_fetch"
+    HISTORY = "history"
+    TRACE_RECEIPT = "trace_receipt"
     
     # System
     USER_LIST = "user_list"
@@ -35,16 +47,147 @@ class Priority(Enum):
     HIGH = 3
     CRITICAL = 4
 
+# Plain dicts: much cheaper per decoded frame than MessageType(value) / Priority(value)
+TYPES_BY_VALUE = {msg_type.value: msg_type for msg_type in MessageType}
+PRIORITIES_BY_VALUE = {priority.value: priority for priority in Priority}
+
+# Wire codecs. JSON is always understood; binary is used once both peers
+# have agreed on it through a SERVER_INFO exchange.
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]
+
+# Binary frame: [magic][type][priority][flags][id: f64][timestamp: f64][room][payload]
+BINARY_MAGIC = 0xB1
+BINARY_HEADER = struct.Struct('!BBBBdd')
+FLAG_ROOM_UUID = 0x01  # room id follows as 16 raw uuid bytes
+FLAG_ROOM_STR = 0x02   # room id follows as a length-prefixed string
+
+# Stable type codes; append new types, never renumber
+TYPE_CODES = {
+    MessageType.AUTH_REQUEST: 1,
+    MessageType.AUTH_RESPONSE: 2,
+    MessageType.REGISTER_REQUEST: 3,
+    MessageType.REGISTER_RESPONSE: 4,
+    MessageType.CREATE_ROOM: 5,
+    MessageType.JOIN_ROOM: 6,
+    MessageType.LEAVE_ROOM: 7,
+    MessageType.LIST_ROOMS: 8,
+    MessageType.ROOM_INFO: 9,
+    MessageType.TEXT_MESSAGE: 10,
+    MessageType.FILE_TRANSFER: 11,
+    MessageType.FILE_CHUNK: 12,
+    MessageType.USER_LIST: 13,
+    MessageType.SERVER_INFO: 14,
+    MessageType.HEARTBEAT: 15,
+    MessageType.ERROR: 16,
+    MessageType.SUCCESS: 17,
+    MessageType.RESUME_REQUEST: 18,
+    MessageType.RESUME_RESPONSE: 19,
+    MessageType.FILE_ACK: 20,
+    MessageType.FILE_NEED: 21,
+    MessageType.FILE_FETCH: 22,
+    MessageType.HISTORY: 23,
+    MessageType.TRACE_RECEIPT: 24,
+    MessageType.LOGOUT: 25,
+}
+TYPES_BY_CODE = {code: msg_type for msg_type, code in TYPE_CODES.items()}
+
+# File stream frame: [magic][transfer id: 16 bytes][chunk number: u32][raw chunk bytes]
+# Only sent between binary-codec peers; the server relays it without decoding
+FILE_STREAM_MAGIC = 0xF5
+FILE_STREAM_HEADER = struct.Struct('!B16sI')
+
+def pack_file_chunk(transfer_id, chunk_num, payload):
+    header = FILE_STREAM_HEADER.pack(FILE_STREAM_MAGIC, bytes.fromhex(transfer_id), chunk_num)
+    return struct.pack('!I', len(header) + len(payload)) + header + payload
+
+def unpack_file_chunk(data):
+    """Split a file stream frame (without its length prefix) into
+    (transfer_id, chunk_num, payload); payload is a memoryview into data"""
+    _, transfer_id, chunk_num = FILE_STREAM_HEADER.unpack_from(data)
+    return transfer_id.hex(), chunk_num, memoryview(data)[FILE_STREAM_HEADER.size:]
+
+_room_ids = {}  # {16 uuid bytes: room id} of rooms seen lately; few rooms carry most frames
+
+def _room_id_from_bytes(raw):
+    room_id = _room_ids.get(raw)
+    if room_id is None:
+        if len(_room_ids) >= 4096:
+            _room_ids.clear()
+        room_id = _room_ids[raw] = str(uuid.UUID(bytes=raw))
+    return room_id
+
+def _json_default(value):
+    # Raw bytes (file chunks) travel as base64 in JSON frames only
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
 class Message:
+    """One protocol message.
+
+    Decoded messages skip __init__. A binary frame's payload stays raw
+    until data is first read, so frames that are only routed, queued or
+    dropped never decode it, and re-encoding an untouched message to
+    binary reuses the bytes. The ISO timestamp is only formatted when
+    read.
+    """
+    __slots__ = ('id', 'type', 'priority', 'room_id', 'received', '_data', '_payload', '_time', '_timestamp')
+    
     def __init__(self, msg_type, data=None, priority=Priority.NORMAL, room_id=None):
-        self.id = datetime.now().timestamp()
+        now = time.time()
+        self.id = now
         self.type = msg_type
-        self.data = data or {}
         self.priority = priority
         self.room_id = room_id
-        self.timestamp = datetime.now().isoformat()
+        self.received = None  # monotonic ns when read off a connection, if the reader noted it; not sent
+        self._data = data or {}
+        self._payload = None  # packed binary payload not decoded yet
+        self._time = now  # epoch seconds, or None when only _timestamp is known
+        self._timestamp = None  # ISO text, formatted on first use
+    
+    @property
+    def data(self):
+        if self._payload is not None:
+            self._data = unpack_value(self._payload, 0)[0] or {}
+            self._payload = None
+        return self._data
+    
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._payload = None
+    
+    @property
+    def timestamp(self):
+        if self._timestamp is None:
+            self._timestamp = datetime.fromtimestamp(self._time).isoformat()
+        return self._timestamp
     
-    def to_bytes(self):
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
+        self._time = None
+    
+    @classmethod
+    def _decoded(cls, msg_type, priority, room_id, msg_id):
+        msg = cls.__new__(cls)
+        msg.id = msg_id
+        msg.type = msg_type
+        msg.priority = priority
+        msg.room_id = room_id
+        msg.received = None
+        msg._data = None
+        msg._payload = None
+        msg._time = None
+        msg._timestamp = None
+        return msg
+    
+    def to_bytes(self, codec=CODEC_JSON):
+        if codec == CODEC_BINARY:
+            return self._to_binary()
+        
         json_data = json.dumps({
             'id': self.id,
             'type': self.type.value,
@@ -52,7 +195,7 @@ class Message:
             'priority': self.priority.value,
             'room_id': self.room_id,
             'timestamp': self.timestamp
-        })
+        }, default=_json_default)
         
         json_bytes = json_data.encode('utf-8')
         length = len(json_bytes)
@@ -60,15 +203,78 @@ class Message:
         # Protocol: [4 bytes length][json data]
         return struct.pack('!I', length) + json_bytes
     
+    def _to_binary(self):
+        flags = 0
+        room = b''
+        if self.room_id:
+            try:
+                room_uuid = uuid.UUID(self.room_id)
+            except ValueError:
+                room_uuid = None
+            
+            # Only canonical uuids round-trip through the 16-byte form
+            if room_uuid is not None and str(room_uuid) == self.room_id:
+                room = room_uuid.bytes
+                flags |= FLAG_ROOM_UUID
+            else:
+                raw = self.room_id.encode('utf-8')
+                room = struct.pack('!H', len(raw)) + raw
+                flags |= FLAG_ROOM_STR
+        
+        timestamp = self._time
+        if timestamp is None:
+            timestamp = datetime.fromisoformat(self._timestamp).timestamp()
+        
+        body = b''.join([
+            BINARY_HEADER.pack(
+                BINARY_MAGIC,
+                TYPE_CODES[self.type],
+                self.priority.value,
+                flags,
+                self.id,
+                timestamp
+            ),
+            room,
+            self._payload if self._payload is not None else pack_value(self._data)
+        ])
+        
+        # Protocol: [4 bytes length][binary frame]
+        return struct.pack('!I', len(body)) + body
+    
     @staticmethod
     def from_bytes(data):
-        json_data = json.loads(data.decode('utf-8'))
-        msg = Message(
-            MessageType(json_data['type']),
-            json_data['data'],
-            Priority(json_data['priority']),
-            json_data.get('room_id')
+        # Codec is detected per frame: JSON always starts with '{'.
+        # File stream frames never get here; see unpack_file_chunk
+        if data[0] == BINARY_MAGIC:
+            return Message._from_binary(data)
+        
+        json_data = json.loads(str(data, 'utf-8'))
+        msg = Message._decoded(
+            TYPES_BY_VALUE[json_data['type']],
+            PRIORITIES_BY_VALUE[json_data['priority']],
+            json_data.get('room_id'),
+            json_data['id']
         )
-        msg.id = json_data['id']
-        msg.timestamp = json_data['timestamp']
+        msg._data = json_data['data'] or {}
+        msg._timestamp = json_data['timestamp']
+        return msg
+    
+    @staticmethod
+    def _from_binary(data):
+        _, type_code, priority, flags, msg_id, timestamp = BINARY_HEADER.unpack_from(data)
+        pos = BINARY_HEADER.size
+        
+        room_id = None
+        if flags & FLAG_ROOM_UUID:
+            room_id = _room_id_from_bytes(bytes(data[pos:pos + 16]))
+            pos += 16
+        elif flags & FLAG_ROOM_STR:
+            length = struct.unpack_from('!H', data, pos)[0]
+            room_id = str(data[pos + 2:pos + 2 + length], 'utf-8')
+            pos += 2 + length
+        
+        msg = Message._decoded(TYPES_BY_CODE[type_code], PRIORITIES_BY_VALUE[priority], room_id, msg_id)
+        # Copied out: data may be a view into a read buffer that gets reused
+        msg._payload = bytes(data[pos:])
+        msg._time = timestamp
         return msg
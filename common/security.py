@@ -1,5 +1,10 @@
 import bcrypt
 import os
+import hmac
+import json
+import time
+import base64
+import hashlib
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding
@@ -13,6 +18,34 @@ class SecurityManager:
     def verify_password(password, hashed):
         return bcrypt.checkpw(password.encode('utf-8'), hashed)
     
+    @staticmethod
+    def sign_token(payload, key):
+        body = base64.urlsafe_b64encode(
+            json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        ).rstrip(b'=')
+        signature = hmac.new(key, body, hashlib.sha256).hexdigest()
+        return f"{body.decode('ascii')}.{signature}"
+    
+    @staticmethod
+    def verify_token(token, key):
+        # Returns the payload of a well-signed, unexpired token, else None
+        try:
+            body, signature = token.encode('ascii').rsplit(b'.', 1)
+        except (AttributeError, UnicodeEncodeError, ValueError):
+            return None
+        
+        expected = hmac.new(key, body, hashlib.sha256).hexdigest().encode('ascii')
+        if not hmac.compare_digest(signature, expected):
+            return None
+        
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(body + b'=' * (-len(body) % 4)))
+        except ValueError:
+            return None
+        if payload.get('exp', 0) < time.time():
+            return None
+        return payload
+    
     @staticmethod
     def generate_key():
         return os.urandom(32)  # 256-bit key
@@ -0,0 +1,128 @@
+"""Renders performance graphs from the server's time series (logs/metrics.jsonl).
+
+Runs offline, apart from the server, which only writes the series:
+
+    python3 monitoring/report.py [logs/metrics.jsonl] [--out monitoring/graphs] [--hours 24]
+"""
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')  # files only, no display needed
+import matplotlib.pyplot as plt
+
+def load_series(path, since=None):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            if since is None or row['time'] >= since:
+                rows.append(row)
+    return rows
+
+def merge_buckets(bucket_lists):
+    """Adds up the [lowest, highest, count] buckets of several rows"""
+    merged = defaultdict(int)
+    for buckets in bucket_lists:
+        for low, high, count in buckets:
+            merged[(low, high)] += count
+    return [(low, high, count) for (low, high), count in sorted(merged.items())]
+
+def quantile(buckets, q):
+    total = sum(count for _, _, count in buckets)
+    seen = 0
+    for low, high, count in buckets:
+        seen += count
+        if seen >= q * total:
+            return (low + high) / 2
+    return 0
+
+def plot_processing_times(rows, out):
+    buckets = merge_buckets(row['processing_ns'] for row in rows)
+    if not buckets:
+        return False
+    plt.figure(figsize=(10, 6))
+    plt.bar(
+        [low / 1e6 for low, _, _ in buckets],
+        [count for _, _, count in buckets],
+        width=[(high + 1 - low) / 1e6 for low, high, _ in buckets],
+        align='edge'
+    )
+    plt.xscale('log')
+    plt.title('Message Processing Time Distribution')
+    plt.xlabel('Processing Time (ms)')
+    plt.ylabel('Frequency')
+    plt.savefig(out / 'processing_times.png')
+    plt.close()
+    return True
+
+def plot_latency(rows, out):
+    rows = [row for row in rows if row['latency_ns']]
+    if not rows:
+        return False
+    times = [datetime.fromtimestamp(row['time']) for row in rows]
+    plt.figure(figsize=(10, 6))
+    for name, q in [('p50', 0.5), ('p99', 0.99)]:
+        plt.plot(times, [quantile(row['latency_ns'], q) / 1e6 for row in rows], label=name)
+    plt.title('Message Latency Over Time')
+    plt.xlabel('Time')
+    plt.ylabel('Latency (ms)')
+    plt.legend()
+    plt.gcf().autofmt_xdate()
+    plt.savefig(out / 'latency_timeline.png')
+    plt.close()
+    return True
+
+def plot_hourly_messages(rows, out):
+    hourly = defaultdict(int)
+    for row in rows:
+        hourly[datetime.fromtimestamp(row['time']).strftime('%Y-%m-%d %H:00')] += row['messages']
+    if not hourly:
+        return False
+    hours = sorted(hourly)
+    plt.figure(figsize=(12, 6))
+    plt.bar(range(len(hours)), [hourly[h] for h in hours])
+    plt.title('Messages Per Hour')
+    plt.xlabel('Hour')
+    plt.ylabel('Message Count')
+    plt.xticks(range(len(hours)), hours, rotation=45)
+    plt.tight_layout()
+    plt.savefig(out / 'hourly_messages.png')
+    plt.close()
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Render performance graphs from a metrics time series')
+    parser.add_argument('series', nargs='?', default='logs/metrics.jsonl')
+    parser.add_argument('--out', default='monitoring/graphs', help='directory for the PNG files')
+    parser.add_argument('--hours', type=float, help='only the last N hours')
+    args = parser.parse_args()
+    
+    since = time.time() - args.hours * 3600 if args.hours else None
+    try:
+        rows = load_series(args.series, since)
+    except FileNotFoundError:
+        sys.exit(f"No time series at {args.series}; the server writes one row a minute")
+    
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    drawn = [
+        name for name, plot in [
+            ('processing_times.png', plot_processing_times),
+            ('latency_timeline.png', plot_latency),
+            ('hourly_messages.png', plot_hourly_messages)
+        ]
+        if plot(rows, out)
+    ]
+    print(f"{len(rows)} rows from {args.series}; wrote {', '.join(drawn) or 'nothing'} to {out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+import itertools
+import logging
+import secrets
+from room_bus import SessionTable, pack_bus_frame, read_bus_frame
+
+def parse_cluster_nodes(spec):
+    """'a=10.0.0.1:9001,b=10.0.0.2:9001' -> {'a': ('10.0.0.1', 9001), ...}"""
+    nodes = {}
+    for item in spec.split(','):
+        node_id, address = item.strip().split('=')
+        host, port = address.rsplit(':', 1)
+        nodes[node_id] = (host, int(port))
+    return nodes
+
+class HashRing:
+    """Consistent hash ring over node ids.
+
+    Each node is placed at `replicas` points, so keys spread evenly and a
+    node joining or leaving only moves the keys next to its own points,
+    about 1/N of them.
+    """
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self.points = []  # sorted point hashes
+        self.owners = {}  # {point hash: node_id}
+        for node_id in nodes:
+            self.add(node_id)
+    
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    def add(self, node_id):
+        for i in range(self.replicas):
+            point = self._hash(f"{node_id}#{i}")
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = node_id
+    
+    def remove(self, node_id):
+        self.points = [point for point in self.points if self.owners[point] != node_id]
+        self.owners = {point: owner for point, owner in self.owners.items() if owner != node_id}
+    
+    def owner(self, key):
+        if not self.points:
+            return None
+        position = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[self.points[position]]
+    
+    @property
+    def nodes(self):
+        return set(self.owners.values())
+    
+    def copy(self):
+        ring = HashRing(replicas=self.replicas)
+        ring.points = list(self.points)
+        ring.owners = dict(self.owners)
+        return ring
+
+class NodeLink:
+    """Persistent TCP link to one peer node.
+
+    Frames sent during one pass of the event loop are joined and written
+    together, so a burst of broadcasts costs one write, not one per frame.
+    """
+    def __init__(self, node_id, writer):
+        self.node_id = node_id
+        self.writer = writer
+        self.buffer = []
+        self.flush_scheduled = False
+        self.frames = 0
+        self.writes = 0
+    
+    def send(self, frame):
+        self.buffer.append(frame)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+    
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.writer.is_closing():
+            self.buffer.clear()
+            return
+        self.frames += len(self.buffer)
+        self.writes += 1
+        self.writer.write(b''.join(self.buffer))
+        self.buffer.clear()
+
+class Cluster:
+    """This node's view of a cluster of chat nodes, one ChatServer each.
+
+    Every room is owned by one node, picked by a HashRing over the nodes
+    currently reachable. The owner numbers the room's messages and keeps
+    its history and log; other nodes hand it their members' messages and
+    get the encoded frames back for their own members. Room and
+    membership changes are announced to every node, so each one can list
+    all rooms and members. Sessions are held by the node owning
+    'user:<name>' on the same ring.
+
+    Nodes link over persistent TLS connections, the lower node id dialing
+    the higher one. With ssl_contexts (server side, client side) both ends
+    present and verify the shared certificate; then each proves it holds
+    the shared token key by signing a fresh nonce of the other's, so a
+    recorded handshake cannot be replayed. When a
+    link comes up the peer joins the ring and rooms that now belong to it
+    are handed over with their history; when it drops, its rooms pass to
+    the next nodes on the ring. Offers the same interface to ChatServer
+    as room_bus.RoomBus.
+    """
+    # Owners forward room messages to the nodes holding members
+    delivers_room_messages = False
+    
+    def __init__(self, node_id, nodes, handlers, secret, replicas=128, request_timeout=5,
+                 reconnect_delay=1.0, ssl_contexts=(None, None)):
+        self.node_id = node_id
+        self.nodes = nodes  # {node_id: (host, port)} of the cluster links, this node's included
+        self.handlers = handlers
+        self.secret = secret
+        self.server_ssl, self.client_ssl = ssl_contexts
+        self.request_timeout = request_timeout
+        self.reconnect_delay = reconnect_delay
+        self.ring = HashRing([node_id], replicas)
+        self.links = {}  # {node_id: NodeLink}
+        self.member_nodes = {}  # {client_id: (node_id, room_id)} of members connected elsewhere
+        self.sessions = SessionTable()
+        self.pending = {}  # {request_id: (node_id, Future)}
+        self.request_ids = itertools.count(1)
+        self.lost = asyncio.Event()  # never set: a node keeps serving whoever it can reach
+        self.logger = logging.getLogger(__name__)
+        self.stats = {
+            'frames_in': 0,
+            'handoffs': 0
+        }
+        self._owners = {}  # owner lookup cache, cleared whenever the ring changes
+        self._internal = {
+            'claim': self._on_claim,
+            'release': self._on_release,
+            'sessions': self._on_sessions
+        }
+        self._server = None
+        self._tasks = []
+    
+    async def start(self):
+        host, port = self.nodes[self.node_id]
+        self._server = await asyncio.start_server(self._accept, host, port, ssl=self.server_ssl)
+        for peer in self.nodes:
+            if peer > self.node_id:
+                self._tasks.append(asyncio.create_task(self._dial(peer)))
+        self.logger.info(f"Node {self.node_id} listening for cluster links on {host}:{port}")
+    
+    async def close(self):
+        if self._server:
+            self._server.close()
+        for task in self._tasks:
+            task.cancel()
+        for link in list(self.links.values()):
+            link.writer.close()
+    
+    def _proof(self, role, prover, verifier, nonce):
+        """HMAC showing prover holds the shared key, bound to the verifier's nonce.
+        The role keeps a dialer's proof from being obtained by dialing the
+        prover and having it answer as the accepting side."""
+        message = f"{role}|{prover}|{verifier}|{nonce}".encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+    
+    def _check_proof(self, frame, role, prover, verifier, nonce):
+        proof = frame.get('proof')
+        return isinstance(proof, str) and hmac.compare_digest(proof, self._proof(role, prover, verifier, nonce))
+    
+    async def _read_handshake(self, reader):
+        frame = await asyncio.wait_for(read_bus_frame(reader), self.request_timeout)
+        return frame if isinstance(frame, dict) else {}
+    
+    async def _dial_handshake(self, peer, reader, writer):
+        nonce = secrets.token_hex(16)
+        writer.write(pack_bus_frame('hello', {'node': self.node_id, 'nonce': nonce}))
+        frame = await self._read_handshake(reader)
+        if (frame.get('node') != peer or not isinstance(frame.get('nonce'), str)
+                or not self._check_proof(frame, 'accept', peer, self.node_id, nonce)):
+            return False
+        writer.write(pack_bus_frame('proof', {'proof': self._proof('dial', self.node_id, peer, frame['nonce'])}))
+        return True
+    
+    async def _accept_handshake(self, reader, writer):
+        """The authenticated peer's node id, or None"""
+        hello = await self._read_handshake(reader)
+        peer = hello.get('node')
+        if peer not in self.nodes or peer == self.node_id or not isinstance(hello.get('nonce'), str):
+            return None
+        nonce = secrets.token_hex(16)
+        writer.write(pack_bus_frame('hello', {
+            'node': self.node_id,
+            'nonce': nonce,
+            'proof': self._proof('accept', self.node_id, peer, hello['nonce'])
+        }))
+        if not self._check_proof(await self._read_handshake(reader), 'dial', peer, self.node_id, nonce):
+            return None
+        return peer
+    
+    async def _dial(self, peer):
+        host, port = self.nodes[peer]
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port, ssl=self.client_ssl)
+                if not await self._dial_handshake(peer, reader, writer):
+                    self.logger.warning(f"Node {peer} failed to authenticate")
+                    writer.close()
+                else:
+                    await self._run_link(peer, reader, writer)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(self.reconnect_delay)
+    
+    async def _accept(self, reader, writer):
+        try:
+            peer = await self._accept_handshake(reader, writer)
+            if peer is None or peer in self.links:
+                writer.close()
+                return
+            await self._run_link(peer, reader, writer)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+    
+    async def _run_link(self, peer, reader, writer):
+        link = self.links[peer] = NodeLink(peer, writer)
+        previous = self._change_ring(lambda ring: ring.add(peer))
+        self.logger.info(f"Node {peer} joined the cluster")
+        
+        # Sessions keyed to the newcomer move over; rooms are the server's business
+        moved = {
+            username: holder for username, holder in self.sessions.sessions.items()
+            if self.owner(f"user:{username}") == peer
+        }
+        for username in moved:
+            del self.sessions.sessions[username]
+        if moved:
+            self.send(peer, 'sessions', sessions=moved)
+        await self._call(self.handlers['node_joined'], peer, previous)
+        
+        try:
+            while True:
+                await self._dispatch(peer, await read_bus_frame(reader))
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.links.get(peer) is link:
+                await self._drop_link(peer)
+            writer.close()
+    
+    async def _drop_link(self, peer):
+        del self.links[peer]
+        previous = self._change_ring(lambda ring: ring.remove(peer))
+        self.logger.warning(f"Node {peer} left the cluster")
+        
+        lost = [
+            (client_id, room_id) for client_id, (node_id, room_id) in self.member_nodes.items()
+            if node_id == peer
+        ]
+        for client_id, _ in lost:
+            del self.member_nodes[client_id]
+        self.sessions.drop(peer)
+        for request_id, (node_id, future) in list(self.pending.items()):
+            if node_id == peer and not future.done():
+                future.set_result(None)
+        await self._call(self.handlers['node_left'], peer, previous, lost)
+    
+    def _change_ring(self, change):
+        previous = self.ring.copy()
+        change(self.ring)
+        self._owners.clear()
+        return previous
+    
+    async def _call(self, handler, *args):
+        result = handler(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+    
+    async def _dispatch(self, peer, frame):
+        self.stats['frames_in'] += 1
+        op = frame['op']
+        if op == 'reply':
+            entry = self.pending.get(frame['request_id'])
+            if entry and not entry[1].done():
+                entry[1].set_result(frame['result'])
+            return
+        
+        # Track where remote members live, for forwarding and for cleanup if the node goes
+        if op == 'member_joined':
+            self.member_nodes[frame['client_id']] = (peer, frame['room_id'])
+        elif op == 'member_left':
+            self.member_nodes.pop(frame['client_id'], None)
+        elif op == 'snapshot':
+            for room_id, room in frame['rooms'].items():
+                for client_id in room['members']:
+                    self.member_nodes[client_id] = (peer, room_id)
+        
+        frame['node'] = peer
+        handler = self._internal.get(op) or self.handlers.get(op)
+        if handler is None:
+            return
+        if 'request_id' in frame:
+            # Requests may wait (history reads from disk); answer them on the side
+            asyncio.create_task(self._answer(peer, handler, frame))
+            return
+        try:
+            await self._call(handler, frame)
+        except Exception as e:
+            self.logger.error(f"Error handling cluster frame '{op}' from node {peer}: {e}")
+    
+    async def _answer(self, peer, handler, frame):
+        try:
+            result = await self._call(handler, frame)
+        except Exception as e:
+            self.logger.error(f"Error answering cluster request '{frame['op']}' from node {peer}: {e}")
+            result = None
+        self.send(peer, 'reply', request_id=frame['request_id'], result=result)
+    
+    def owner(self, key):
+        owner = self._owners.get(key)
+        if owner is None:
+            owner = self._owners[key] = self.ring.owner(key)
+        return owner
+    
+    def send(self, node_id, op, **fields):
+        link = self.links.get(node_id)
+        if link is not None:
+            link.send(pack_bus_frame(op, fields))
+    
+    async def request(self, node_id, op, **fields):
+        """Ask another node; None if it cannot be reached or does not answer in time"""
+        if node_id not in self.links:
+            return None
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (node_id, future)
+        self.send(node_id, op, request_id=request_id, **fields)
+        try:
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.pending.pop(request_id, None)
+    
+    def announce(self, op, **fields):
+        frame = pack_bus_frame(op, fields)
+        for link in self.links.values():
+            link.send(frame)
+    
+    def forward(self, member_ids, **fields):
+        nodes = {self.member_nodes[member][0] for member in member_ids if member in self.member_nodes}
+        if not nodes:
+            return
+        frame = pack_bus_frame('forward', fields)
+        for node_id in nodes:
+            link = self.links.get(node_id)
+            if link is not None:
+                link.send(frame)
+    
+    def publish(self, room_id, message, exclude):
+        """Send a room message to the room's owner; False if that is this node"""
+        owner = self.owner(room_id)
+        if owner == self.node_id:
+            return False
+        self.send(owner, 'publish', room_id=room_id, message=message, exclude=exclude)
+        return True
+    
+    def owns(self, room_id):
+        return self.owner(room_id) == self.node_id
+    
+    def writes_room_log(self, room_id):
+        return True  # only the owner numbers, and logs, a room's messages
+    
+    async def fetch_history(self, room_id, codec, since, limit):
+        result = await self.request(
+            self.owner(room_id), 'history', room_id=room_id, codec=codec, since=since, limit=limit
+        )
+        if result is None:
+            return [], None, None, False
+        return result['frames'], result['first_id'], result['last_id'], result['more']
+    
+    async def claim_session(self, username, client_id, session_id, takeover=False, new_session_id=None):
+        owner = self.owner(f"user:{username}")
+        if owner == self.node_id:
+            return self._claim(self.node_id, username, client_id, session_id, takeover, new_session_id)
+        result = await self.request(
+            owner, 'claim', username=username, client_id=client_id, session_id=session_id, takeover=takeover,
+            new_session_id=new_session_id
+        )
+        # Refused if the owner cannot be asked: better than a second session
+        return bool(result)
+    
+    def release_session(self, username, client_id, ended=False):
+        owner = self.owner(f"user:{username}")
+        if owner == self.node_id:
+            self.sessions.release(username, self.node_id, client_id, ended)
+        else:
+            self.send(owner, 'release', username=username, client_id=client_id, ended=ended)
+    
+    def _claim(self, holder, username, client_id, session_id, takeover, new_session_id=None):
+        granted, revoked = self.sessions.claim(username, holder, client_id, session_id, takeover, new_session_id)
+        if revoked:
+            frame = {'username': username, 'client_id': revoked[1]}
+            if revoked[0] == self.node_id:
+                self.handlers['revoke'](frame)
+            else:
+                self.send(revoked[0], 'revoke', **frame)
+        return granted
+    
+    def _on_claim(self, frame):
+        return self._claim(
+            frame['node'], frame['username'], frame['client_id'], frame['session_id'], frame['takeover'],
+            frame.get('new_session_id')
+        )
+    
+    def _on_release(self, frame):
+        self.sessions.release(frame['username'], frame['node'], frame['client_id'], frame.get('ended', False))
+    
+    def _on_sessions(self, frame):
+        for username, holder in frame['sessions'].items():
+            self.sessions.sessions.setdefault(username, tuple(holder))
+    
+    def get_stats(self):
+        return dict(
+            self.stats,
+            node=self.node_id,
+            ring=sorted(self.ring.nodes),
+            links={
+                node_id: {'frames': link.frames, 'writes': link.writes}
+                for node_id, link in self.links.items()
+            },
+            remote_members=len(self.member_nodes),
+            sessions=len(self.sessions)
+        )
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from common.protocol import Priority, CODEC_JSON
+
+@dataclass
+class SlowConsumerPolicy:
+    # Once this many bytes are queued, LOW priority frames (file chunks) are dropped
+    low_priority_limit: int = 1024 * 1024
+    # Crossing the high-water mark disconnects the connection
+    high_water_bytes: int = 4 * 1024 * 1024
+    max_frames: int = 10000
+
+class ConnectionWriter:
+    """Bounded outbound queue for one connection, drained by its own writer task.
+
+    send() never blocks, so a slow reader cannot hold up a broadcast.
+    Frames queued while the writer task waits are written together, up to
+    max_batch_bytes per write, so a burst costs one write (and, under TLS,
+    a few large records) rather than one per frame. While more frames keep
+    arriving the writer waits for them a loop pass at a time, but never
+    longer than max_delay seconds.
+    """
+    def __init__(self, client_id, writer, policy=None, monitor=None, max_batch_bytes=64 * 1024,
+                 max_delay=0.0005):
+        self.client_id = client_id
+        self.writer = writer
+        self.policy = policy or SlowConsumerPolicy()
+        self.monitor = monitor
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay
+        self.codec = CODEC_JSON  # switched by SERVER_INFO negotiation
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.dropped_frames = 0
+        self.closed = False
+        self.logger = logging.getLogger(__name__)
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()  # set whenever a frame leaves the queue
+        self._task = asyncio.create_task(self._writer_loop())
+    
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+    
+    def send(self, frame, priority=Priority.NORMAL):
+        if self.closed:
+            return False
+        
+        size = len(frame)
+        if priority == Priority.LOW and self.queued_bytes + size > self.policy.low_priority_limit:
+            self.dropped_frames += 1
+            if self.monitor:
+                self.monitor.record_dropped_frame()
+            return False
+        
+        if (self.queued_bytes + size > self.policy.high_water_bytes
+                or len(self.queue) >= self.policy.max_frames):
+            self.logger.warning(
+                f"Slow consumer {self.client_id}: {self.queued_bytes} bytes queued, disconnecting"
+            )
+            if self.monitor:
+                self.monitor.record_slow_consumer()
+            self.abort()
+            return False
+        
+        self.queue.append(frame)
+        self.queued_bytes += size
+        if self.monitor:
+            self.monitor.record_send_queue(self.client_id, len(self.queue))
+            self.monitor.record_outbound(size)
+        self._wakeup.set()
+        return True
+    
+    async def _gather(self):
+        # Let handlers still running in this stretch of the loop add their frames
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while self.queued_bytes < self.max_batch_bytes and not self.closed:
+            queued = len(self.queue)
+            await asyncio.sleep(0)
+            if len(self.queue) == queued or loop.time() >= deadline:
+                break
+    
+    async def _writer_loop(self):
+        try:
+            while True:
+                if not self.queue:
+                    if self.closed:
+                        break
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                
+                if self.max_delay:
+                    await self._gather()
+                
+                batch = [self.queue.popleft()]
+                size = len(batch[0])
+                while self.queue and size + len(self.queue[0]) <= self.max_batch_bytes:
+                    frame = self.queue.popleft()
+                    batch.append(frame)
+                    size += len(frame)
+                self.queued_bytes -= size
+                if self.monitor:
+                    self.monitor.record_send_queue(self.client_id, len(self.queue))
+                    self.monitor.record_outbound(-size)
+                    self.monitor.record_write(len(batch), size)
+                
+                self.writer.write(batch[0] if len(batch) == 1 else b''.join(batch))
+                await self.writer.drain()
+                self._drained.set()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.error(f"Error sending to {self.client_id}: {e}")
+            self.abort()
+    
+    async def wait_below(self, limit):
+        """Wait until no more than limit bytes are queued (or the connection closes).
+
+        Lets relays of bulk data apply backpressure instead of having
+        LOW priority frames dropped.
+        """
+        while self.queued_bytes > limit and not self.closed:
+            self._drained.clear()
+            await self._drained.wait()
+    
+    def abort(self):
+        """Drop everything still queued and tear the connection down"""
+        self.closed = True
+        self.queue.clear()
+        if self.monitor:
+            self.monitor.record_outbound(-self.queued_bytes)
+        self.queued_bytes = 0
+        self._wakeup.set()
+        self._drained.set()
+        self._task.cancel()
+        transport = self.writer.transport
+        if transport and not transport.is_closing():
+            transport.abort()
+    
+    async def close(self):
+        """Flush what is queued, then close the underlying stream"""
+        if not self.closed:
+            self.closed = True
+            self._wakeup.set()
+            self._drained.set()
+        
+        await asyncio.wait({self._task}, timeout=5)
+        if not self._task.done():
+            self._task.cancel()
+        
+        if self.monitor:
+            self.monitor.remove_send_queue(self.client_id)
+            # Whatever the writer did not get to before giving up
+            self.monitor.record_outbound(-self.queued_bytes)
+        self.queued_bytes = 0
+        
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+_HASH = re.compile(r'[0-9a-f]{64}')
+
+class ContentStore:
+    """Size-bounded, LRU-evicted blob cache on disk, keyed by sha256.
+
+    Holds file chunks and manifests so a file posted again, or a receiver
+    catching up, is served from here instead of being uploaded again.
+    Blobs are verified against their hash before they are stored, and
+    written to a temp file that is renamed into place. The LRU order is
+    rebuilt from file access times on startup. Worker processes can share
+    one directory: a blob another process stored is picked up on a miss.
+    get() and put() hash and touch the disk, so the server runs them in an
+    executor; the index is locked, the hashing and file I/O are not.
+    """
+    def __init__(self, root='content_store', max_bytes=1024 * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {hash: size}, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self._load()
+    
+    def _path(self, blob_hash):
+        return self.root / blob_hash[:2] / blob_hash
+    
+    def _load(self):
+        found = []
+        for path in self.root.glob('*/*'):
+            if path.suffix == '.tmp':
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            found.append((stat.st_atime, path.name, stat.st_size))
+        
+        for _, blob_hash, size in sorted(found):
+            self.entries[blob_hash] = size
+            self.total_bytes += size
+        self._evict()
+    
+    def has(self, blob_hash):
+        with self.lock:
+            return blob_hash in self.entries or self._adopt(blob_hash)
+    
+    def _adopt(self, blob_hash):
+        # Hashes can come from clients; only ever look at our own layout
+        if not isinstance(blob_hash, str) or not _HASH.fullmatch(blob_hash):
+            return False
+        try:
+            size = self._path(blob_hash).stat().st_size
+        except OSError:
+            return False
+        
+        self.entries[blob_hash] = size
+        self.total_bytes += size
+        self._evict()
+        return blob_hash in self.entries
+    
+    def get(self, blob_hash):
+        if not self.has(blob_hash):
+            self.misses += 1
+            return None
+        
+        try:
+            data = self._path(blob_hash).read_bytes()
+        except OSError:
+            with self.lock:
+                self._forget(blob_hash)
+                self.misses += 1
+            return None
+        
+        with self.lock:
+            if blob_hash in self.entries:
+                self.entries.move_to_end(blob_hash)
+            self.hits += 1
+        return data
+    
+    def put(self, blob_hash, data):
+        """Store data under its sha256; returns False if it does not match"""
+        if hashlib.sha256(data).hexdigest() != blob_hash:
+            return False
+        with self.lock:
+            if blob_hash in self.entries:
+                self.entries.move_to_end(blob_hash)
+                return True
+        
+        path = self._path(blob_hash)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        
+        with self.lock:
+            if blob_hash not in self.entries:
+                self.entries[blob_hash] = len(data)
+                self.total_bytes += len(data)
+                self._evict()
+        return True
+    
+    def _forget(self, blob_hash):
+        if blob_hash in self.entries:
+            self.total_bytes -= self.entries.pop(blob_hash)
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            blob_hash, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self._path(blob_hash).unlink(missing_ok=True)
+    
+    def get_stats(self):
+        return {
+            'blobs': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,76 @@
+import math
+import time
+
+class IdleTimer:
+    """Hashed timing wheel of connection idle deadlines.
+
+    The wheel has one slot per `precision` seconds of the timeout, and a
+    connection sits in the slot of the deadline it had when it was last
+    placed. touch() only records the time, so refreshing on every inbound
+    frame is a dict lookup and a store. When a slot comes due, connections
+    idle for the whole timeout are expired and the others move on to the
+    slot of their current deadline. Each live connection is looked at about
+    once per timeout, and expire() costs O(expired) otherwise. Every timeout
+    is the same, so one level of wheel is enough. Deadlines are honoured to
+    within `precision`.
+    """
+    def __init__(self, timeout=60, precision=1.0):
+        self.timeout = timeout
+        self.precision = precision
+        self.slots = [{} for _ in range(math.ceil(timeout / precision) + 2)]  # {key: entry}
+        self.entries = {}  # {key: [last activity (monotonic), value]}
+        self.next_tick = int(time.monotonic() / precision)  # first slot not yet expired
+        self.stats = {
+            'expired': 0,
+            'rescheduled': 0
+        }
+    
+    def _place(self, key, entry, deadline):
+        tick = max(math.ceil(deadline / self.precision), self.next_tick)
+        self.slots[tick % len(self.slots)][key] = entry
+    
+    def add(self, key, value=None, now=None):
+        entry = self.entries[key] = [time.monotonic() if now is None else now, value]
+        self._place(key, entry, entry[0] + self.timeout)
+    
+    def touch(self, key, now=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] = time.monotonic() if now is None else now
+    
+    def remove(self, key):
+        # Its slot entry stays behind and is skipped when the slot comes due
+        self.entries.pop(key, None)
+    
+    def expire(self, now=None):
+        """Returns [(key, value)] of everything idle for at least the timeout"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        last_tick = int(now / self.precision)
+        # After a long stall, one turn of the wheel visits every slot
+        self.next_tick = max(self.next_tick, last_tick - len(self.slots) + 1)
+        while self.next_tick <= last_tick:
+            slot = self.slots[self.next_tick % len(self.slots)]
+            self.next_tick += 1
+            entries = list(slot.items())
+            slot.clear()
+            # Entries are checked against their current deadline, so one
+            # placed a turn ahead and met early is only moved on again
+            for key, entry in entries:
+                if self.entries.get(key) is not entry:
+                    continue  # removed, or added again since
+                deadline = entry[0] + self.timeout
+                if deadline <= now:
+                    del self.entries[key]
+                    expired.append((key, entry[1]))
+                else:
+                    self._place(key, entry, deadline)
+                    self.stats['rescheduled'] += 1
+        self.stats['expired'] += len(expired)
+        return expired
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get_stats(self):
+        return dict(self.stats, tracked=len(self.entries), precision=self.precision)
@@ -0,0 +1,381 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+# Record: [message id: u64][frame], where the frame is a wire frame with its
+# own 4-byte length prefix, so replay hands out stored bytes unchanged
+RECORD_HEADER = struct.Struct('!QI')
+INDEX_ENTRY = struct.Struct('!QQ')  # (message id, byte offset) every index_interval bytes
+
+class _Segment:
+    def __init__(self, path, first_id):
+        self.path = path
+        self.index_path = path.with_suffix('.idx')
+        self.first_id = first_id
+        self.last_id = first_id - 1
+        self.size = 0  # bytes flushed; readers never look past this
+        self.index = []  # [(message id, offset)], sparse
+        self.index_ids = []
+        self.next_index_at = 0
+
+class _RoomLog:
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []  # oldest first; the last one is written to
+        self.file = None
+        self.index_file = None
+
+class MessageLog:
+    """Durable, append-only log of room messages, one segmented log per room.
+
+    append() only queues the record; a writer thread batches everything
+    queued into one write per room and one fsync per touched file
+    (group commit), every flush_interval seconds or as soon as
+    flush_bytes are waiting. Each segment has a sparse index from message
+    id to file offset, so read() seeks close to the first record wanted
+    and walks the mmapped segment from there without decoding any message.
+    Old segments are deleted once a room's log exceeds retention_bytes or
+    they are older than retention_seconds: after each write to the room,
+    and every retention_interval seconds for every room on disk, so rooms
+    that went quiet and logs left by an earlier run are trimmed as well.
+    
+    A room's log is opened for writing on its first append. Rooms this
+    instance has not written to (logs from an earlier run, or rooms another
+    worker process writes) are read straight from the files on disk.
+    """
+    def __init__(self, root='logs/rooms', segment_bytes=16 * 1024 * 1024, flush_interval=0.05,
+                 flush_bytes=1024 * 1024, index_interval=64 * 1024, retention_bytes=256 * 1024 * 1024,
+                 retention_seconds=7 * 24 * 3600, retention_interval=60, fsync=True):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.index_interval = index_interval
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.retention_interval = retention_interval
+        self.fsync = fsync
+        self.logger = logging.getLogger(__name__)
+        
+        self.rooms = {}  # {room_id: _RoomLog}
+        self.lock = threading.Lock()  # guards segment lists shared with readers
+        self.pending = deque()  # (room_id, message_id, frame) from the event loop
+        # Each counter has a single writing thread, so no lock is needed
+        self.queued_bytes = 0
+        self.taken_bytes = 0
+        self.stats = {
+            'appended': 0,
+            'written': 0,
+            'flushes': 0,
+            'fsyncs': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0
+        }
+        
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._next_retention = time.monotonic() + retention_interval
+        self._writer = threading.Thread(target=self._writer_loop, name='message-log', daemon=True)
+        self._writer.start()
+    
+    def append(self, room_id, message_id, frame):
+        """Queue a record; never blocks on disk"""
+        self.pending.append((room_id, message_id, frame))
+        self.queued_bytes += len(frame)
+        self.stats['appended'] += 1
+        if self.queued_bytes - self.taken_bytes >= self.flush_bytes:
+            self._wakeup.set()
+    
+    def _writer_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.monotonic() >= self._next_retention:
+                    self._next_retention = time.monotonic() + self.retention_interval
+                    self.apply_retention()
+            except Exception as e:
+                self.logger.error(f"Error writing message log: {e}")
+    
+    def flush(self):
+        start = time.perf_counter()
+        batches = {}
+        pending = self.pending
+        while pending:
+            room_id, message_id, frame = pending.popleft()
+            self.taken_bytes += len(frame)
+            batches.setdefault(room_id, []).append((message_id, frame))
+        if not batches:
+            return
+        
+        touched = []
+        for room_id, records in batches.items():
+            room = self._room(room_id)
+            touched.extend(self._write_records(room, records))
+        
+        # Group commit: one fsync per segment written in this round. Index
+        # files are only flushed; a lost entry just means a longer scan
+        for f in touched:
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+                self.stats['fsyncs'] += 1
+        for room_id in batches:
+            self.rooms[room_id].index_file.flush()
+        
+        with self.lock:
+            for room_id in batches:
+                room = self.rooms[room_id]
+                segment = room.segments[-1]
+                segment.size = room.file.tell()
+                self._apply_retention(room)
+        
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stats['flushes'] += 1
+        self.stats['written'] += sum(len(records) for records in batches.values())
+        self.stats['last_flush_ms'] = elapsed
+        self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed)
+    
+    def _write_records(self, room, records):
+        buf = bytearray()
+        segment = room.segments[-1] if room.segments else None
+        offset = room.file.tell() if room.file else 0
+        new_entries = []
+        
+        for message_id, frame in records:
+            if segment is None or offset + len(buf) >= self.segment_bytes:
+                if buf:
+                    # Rolling over flushes and syncs the full segment
+                    room.file.write(buf)
+                    self._write_index(room, segment, new_entries)
+                    buf = bytearray()
+                    new_entries = []
+                segment = self._roll_segment(room, message_id)
+                offset = 0
+            
+            position = offset + len(buf)
+            if position >= segment.next_index_at:
+                new_entries.append((message_id, position))
+                segment.next_index_at = position + self.index_interval
+            buf += struct.pack('!Q', message_id)
+            buf += frame
+            segment.last_id = message_id
+        
+        room.file.write(buf)
+        self._write_index(room, segment, new_entries)
+        return [room.file]
+    
+    def _write_index(self, room, segment, entries):
+        if not entries:
+            return
+        room.index_file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        with self.lock:
+            segment.index.extend(entries)
+            segment.index_ids.extend(entry[0] for entry in entries)
+    
+    def _roll_segment(self, room, first_id):
+        if room.file:
+            room.file.flush()
+            if self.fsync:
+                os.fsync(room.file.fileno())
+                self.stats['fsyncs'] += 1
+            with self.lock:
+                room.segments[-1].size = room.file.tell()
+            room.file.close()
+            room.index_file.close()
+        
+        segment = _Segment(room.directory / f"{first_id:020d}.log", first_id)
+        room.file = open(segment.path, 'ab')
+        room.index_file = open(segment.index_path, 'ab')
+        with self.lock:
+            room.segments.append(segment)
+        return segment
+    
+    def _room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = _RoomLog(self.root / room_id)
+            room.directory.mkdir(exist_ok=True)
+            self._load_segments(room)
+            with self.lock:
+                self.rooms[room_id] = room
+        return room
+    
+    def _load_segments(self, room):
+        """Pick up segments left by an earlier run, trimming a torn last record"""
+        for path in sorted(room.directory.glob('*.log')):
+            segment = _Segment(path, int(path.stem))
+            size = path.stat().st_size
+            segment.index = self._read_index(segment.index_path, size)
+            segment.index_ids = [entry[0] for entry in segment.index]
+            
+            offset = segment.index[-1][1] if segment.index else 0
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            good = 0
+            while good + RECORD_HEADER.size <= len(data):
+                message_id, frame_length = RECORD_HEADER.unpack_from(data, good)
+                end = good + 8 + 4 + frame_length
+                if end > len(data):
+                    break
+                segment.last_id = message_id
+                good = end
+            if offset + good < size:
+                self.logger.warning(f"Truncating torn record at the end of {path}")
+                os.truncate(path, offset + good)
+                if good == 0 and segment.index:
+                    # The indexed record itself was torn
+                    segment.last_id = segment.index[-1][0] - 1
+                    segment.index.pop()
+                    segment.index_ids.pop()
+            segment.size = offset + good
+            segment.next_index_at = (segment.index[-1][1] + self.index_interval) if segment.index else 0
+            room.segments.append(segment)
+        
+        if room.segments:
+            segment = room.segments[-1]
+            room.file = open(segment.path, 'ab')
+            room.index_file = open(segment.index_path, 'ab')
+    
+    def _read_index(self, index_path, size):
+        try:
+            raw = index_path.read_bytes()
+        except FileNotFoundError:
+            return []
+        raw = raw[:len(raw) - len(raw) % INDEX_ENTRY.size]
+        # Entries can outlive a segment tail that never reached the disk
+        return [entry for entry in INDEX_ENTRY.iter_unpack(raw) if entry[1] < size]
+    
+    def _scan_segments(self, room_id):
+        """Segments of a room log this instance does not write, as read() wants them.
+        Never repairs anything: the writer may be in the middle of a record."""
+        paths = sorted((self.root / room_id).glob('*.log'))
+        segments = []
+        for i, path in enumerate(paths):
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                continue
+            index = self._read_index(path.with_suffix('.idx'), size)
+            last_id = int(paths[i + 1].stem) - 1 if i + 1 < len(paths) else sys.maxsize
+            segments.append((path, size, index, [entry[0] for entry in index], last_id))
+        return segments
+    
+    def _segments_to_drop(self, segments):
+        """How many of the oldest [(path, size)] retention deletes; never the newest,
+        which is the one being written"""
+        now = time.time()
+        total = sum(size for _, size in segments)
+        drop = 0
+        while drop < len(segments) - 1:
+            path, size = segments[drop]
+            try:
+                expired = now - path.stat().st_mtime > self.retention_seconds
+            except FileNotFoundError:
+                expired = True  # already deleted by another worker sharing the directory
+            if total <= self.retention_bytes and not expired:
+                break
+            total -= size
+            drop += 1
+        return drop
+    
+    def _apply_retention(self, room):
+        drop = self._segments_to_drop([(segment.path, segment.size) for segment in room.segments])
+        for segment in room.segments[:drop]:
+            segment.path.unlink(missing_ok=True)
+            segment.index_path.unlink(missing_ok=True)
+        del room.segments[:drop]
+    
+    def apply_retention(self):
+        """Trim every room log on disk, whether or not it was written to lately.
+        Runs on the writer thread, which is the only one changing segment lists."""
+        with self.lock:
+            for room in self.rooms.values():
+                self._apply_retention(room)
+            opened = set(self.rooms)
+        
+        for directory in self.root.iterdir():
+            if directory.name in opened or not directory.is_dir():
+                continue
+            segments = []
+            for path in sorted(directory.glob('*.log')):
+                try:
+                    segments.append((path, path.stat().st_size))
+                except FileNotFoundError:
+                    continue
+            for path, _ in segments[:self._segments_to_drop(segments)]:
+                path.unlink(missing_ok=True)
+                path.with_suffix('.idx').unlink(missing_ok=True)
+    
+    def read(self, room_id, since=0, limit=100):
+        """(message id, frame) of up to limit flushed messages with ids greater than since.
+
+        Safe to call from any thread; meant to run in an executor.
+        """
+        with self.lock:
+            room = self.rooms.get(room_id)
+            segments = [
+                (segment.path, segment.size, list(segment.index), list(segment.index_ids), segment.last_id)
+                for segment in room.segments
+            ] if room else None
+        if segments is None:
+            segments = self._scan_segments(room_id)
+        
+        frames = []
+        for path, size, index, index_ids, last_id in segments:
+            if last_id <= since or size == 0:
+                continue
+            
+            # Start at the last indexed record at or before the first one wanted
+            position = bisect.bisect_right(index_ids, since + 1) - 1
+            offset = index[position][1] if position >= 0 else 0
+            try:
+                with open(path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as view:
+                    while offset + RECORD_HEADER.size <= size and len(frames) < limit:
+                        message_id, frame_length = RECORD_HEADER.unpack_from(view, offset)
+                        end = offset + 8 + 4 + frame_length
+                        if end > size:
+                            break  # still being written by another process
+                        if message_id > since:
+                            frames.append((message_id, view[offset + 8:end]))
+                        offset = end
+            except FileNotFoundError:
+                continue  # removed by retention while we were reading
+            if len(frames) >= limit:
+                break
+        return frames
+    
+    def get_stats(self):
+        with self.lock:
+            disk_bytes = sum(
+                segment.size for room in self.rooms.values() for segment in room.segments
+            )
+            segments = sum(len(room.segments) for room in self.rooms.values())
+        return dict(
+            self.stats,
+            pending=len(self.pending),
+            pending_bytes=self.queued_bytes - self.taken_bytes,
+            rooms=len(self.rooms),
+            segments=segments,
+            disk_bytes=disk_bytes
+        )
+    
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        for room in self.rooms.values():
+            if room.file:
+                room.file.close()
+                room.index_file.close()
@@ -0,0 +1,190 @@
+import asyncio
+import time
+
+PRECISION_BITS = 7  # values kept to within 2**-(PRECISION_BITS - 1), 1.6%
+SUB_BUCKETS = 1 << (PRECISION_BITS - 1)
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99, 'p999': 0.999}
+
+def _bucket_index(value):
+    shift = value.bit_length() - PRECISION_BITS
+    if shift > 0:
+        return (shift << (PRECISION_BITS - 1)) + (value >> shift)
+    return value
+
+class Histogram:
+    """Fixed-memory log-linear histogram of non-negative integers, HDR style.
+
+    Values below 2**PRECISION_BITS get a bucket each; above that, every
+    power of two is split into SUB_BUCKETS equal buckets. Values at or
+    above max_value are counted in the last bucket. record() is a
+    bit_length, a shift and a list increment; counts, means and quantiles
+    are worked out from the buckets only when read.
+    """
+    __slots__ = ('max_value', 'counts')
+    
+    def __init__(self, max_value=1 << 40):
+        self.max_value = max_value
+        self.counts = [0] * (_bucket_index(max_value - 1) + 1)
+    
+    def record(self, value):
+        shift = value.bit_length() - 7  # PRECISION_BITS, spelled out for speed
+        if shift > 0:
+            value = (shift << 6) + (value >> shift)
+        try:
+            self.counts[value] += 1
+        except IndexError:
+            self.counts[-1] += 1
+    
+    def bucket_range(self, index):
+        """(lowest, highest) value counted in a bucket"""
+        if index < 2 * SUB_BUCKETS:
+            return index, index
+        shift = index // SUB_BUCKETS - 1
+        low = (index - shift * SUB_BUCKETS) << shift
+        return low, low + (1 << shift) - 1
+    
+    def copy(self):
+        other = Histogram.__new__(Histogram)
+        other.max_value = self.max_value
+        other.counts = self.counts.copy()
+        return other
+    
+    def since(self, earlier):
+        """What was recorded after `earlier`, a copy() of this histogram"""
+        other = Histogram.__new__(Histogram)
+        other.max_value = self.max_value
+        other.counts = [now - before for now, before in zip(self.counts, earlier.counts)]
+        return other
+    
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+    
+    def count(self):
+        return sum(self.counts)
+    
+    def buckets(self):
+        """[(lowest, highest, count)] of the buckets that have values"""
+        return [self.bucket_range(index) + (count,) for index, count in enumerate(self.counts) if count]
+    
+    def summary(self, scale=1.0):
+        """Count, mean, max and QUANTILES, with values multiplied by scale.
+        Each value is taken to be the middle of its bucket."""
+        buckets = self.buckets()
+        count = sum(bucket_count for _, _, bucket_count in buckets)
+        stats = {'count': count, 'mean': 0, 'max': 0}
+        stats.update(dict.fromkeys(QUANTILES, 0))
+        if not count:
+            return stats
+        
+        total = sum((low + high) / 2 * bucket_count for low, high, bucket_count in buckets)
+        stats['mean'] = total / count * scale
+        stats['max'] = buckets[-1][1] * scale
+        seen = 0
+        remaining = list(QUANTILES.items())
+        for low, high, bucket_count in buckets:
+            seen += bucket_count
+            while remaining and seen >= remaining[0][1] * count:
+                stats[remaining.pop(0)[0]] = (low + high) / 2 * scale
+        return stats
+
+# Upper bounds, in seconds, of the buckets a Histogram of nanoseconds is exposed with
+SECONDS_BOUNDS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class MetricFamily:
+    """One metric in the Prometheus text format: a name, a type ('counter',
+    'gauge' or 'histogram'), a help line, and a sample per label set.
+    Histogram samples are Histograms of nanoseconds, exposed in seconds."""
+    __slots__ = ('name', 'kind', 'help', 'samples')
+    
+    def __init__(self, name, kind, help_text, value=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.samples = []  # [(labels, value)]
+        if value is not None:
+            self.samples.append(({}, value))
+    
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+        return self
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(labels, extra=None):
+    pairs = list(labels.items())
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    count = total = 0
+    bounds = iter(SECONDS_BOUNDS)
+    bound = next(bounds)
+    for low, high, bucket_count in histogram.buckets():
+        # A bucket is counted under the first bound its values all fit below
+        while bound is not None and high / 1e9 > bound:
+            lines.append(f"{name}_bucket{_label_text(labels, ('le', bound))} {count}")
+            bound = next(bounds, None)
+        count += bucket_count
+        total += (low + high) / 2 * bucket_count
+    while bound is not None:
+        lines.append(f"{name}_bucket{_label_text(labels, ('le', bound))} {count}")
+        bound = next(bounds, None)
+    lines.append(f"{name}_bucket{_label_text(labels, ('le', '+Inf'))} {count}")
+    lines.append(f"{name}_sum{_label_text(labels)} {total / 1e9}")
+    lines.append(f"{name}_count{_label_text(labels)} {count}")
+    return lines
+
+def render_prometheus(families):
+    """Text exposition format 0.0.4 of a list of MetricFamily"""
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        for labels, value in family.samples:
+            if family.kind == 'histogram':
+                lines.extend(_histogram_lines(family.name, labels, value))
+            else:
+                lines.append(f"{family.name}{_label_text(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+class LoopLagProbe:
+    """How late the event loop wakes a task that asked to sleep `interval`
+    seconds: the time ready callbacks wait behind whatever is running"""
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.lag = Histogram()  # ns
+        self.last_lag = 0.0  # seconds, latest sample
+        self.last_tick = time.perf_counter()  # when the probe last ran; read by SlowHandlerWatchdog's thread
+        self._task = None
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_tick = time.perf_counter()
+            self.last_lag = max(0.0, loop.time() - start - self.interval)
+            self.lag.record(int(self.last_lag * 1e9))
+    
+    def get_stats(self):
+        summary = self.lag.summary(scale=1e-6)
+        return {'last_ms': self.last_lag * 1000, 'p99_ms': summary['p99'], 'max_ms': summary['max']}
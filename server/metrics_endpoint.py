@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import os
+from metrics import render_prometheus
+
+class MetricsEndpoint:
+    """Serves GET /metrics in the Prometheus text format, on the server's own
+    event loop, over TCP (host, port) or a Unix socket (path).
+
+    Each scrape renders what collect() returns, a list of MetricFamily,
+    so its cost follows the number of metrics and not the number of
+    clients. Requests are read with a size limit and a timeout, and
+    every connection is closed after its response.
+    """
+    def __init__(self, collect, host='127.0.0.1', port=None, path=None, timeout=5):
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.server = None
+        self.stats = {
+            'scrapes': 0,
+            'errors': 0
+        }
+        self.logger = logging.getLogger(__name__)
+    
+    async def start(self):
+        if self.path:
+            if os.path.exists(self.path):
+                os.unlink(self.path)  # left behind by a previous run
+            self.server = await asyncio.start_unix_server(self._handle, path=self.path, limit=8192)
+            self.logger.info(f"Metrics endpoint on unix:{self.path}")
+        else:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=8192)
+            self.port = self.server.sockets[0].getsockname()[1]
+            self.logger.info(f"Metrics endpoint on http://{self.host}:{self.port}/metrics")
+    
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+    
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            method, target = head.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', 'Only GET is supported\n'
+            elif target.split(b'?')[0] != b'/metrics':
+                status, body = '404 Not Found', 'Metrics are at /metrics\n'
+            else:
+                status, body = '200 OK', render_prometheus(self.collect())
+                self.stats['scrapes'] += 1
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            self.stats['errors'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+    
+    def get_stats(self):
+        return dict(self.stats)
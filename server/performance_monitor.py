@@ -1,29 +1,58 @@
 import asyncio
 import time
 import json
-from collections import deque, defaultdict
 from datetime import datetime
-import matplotlib.pyplot as plt
 from pathlib import Path
+from metrics import Histogram, MetricFamily
 
 class PerformanceMonitor:
-    def __init__(self, window_size=1000):
-        self.window_size = window_size
+    """Server counters and timing histograms.
+
+    Recording is kept to an integer increment or a Histogram.record():
+    no clock reads, no formatting and no averaging on the hot path. Rates,
+    means and quantiles are worked out when stats are read. Everything
+    runs on the event loop thread, so the counters need no locks.
+
+    report_stats() appends one line per interval to a time-series file
+    (logs/metrics.jsonl): what happened during the interval, histograms
+    included. Graphs are drawn from it offline by monitoring/report.py;
+    the server itself never imports a plotting library.
+    """
+    def __init__(self):
         self.metrics = {
             'connections': 0,
             'messages_sent': 0,
             'bytes_transferred': 0,
-            'processing_times': deque(maxlen=window_size),
-            'message_latencies': deque(maxlen=window_size),
             'concurrent_users': 0,
-            'bandwidth_usage': deque(maxlen=60)  # Last 60 seconds
+            'dropped_frames': 0,
+            'slow_consumer_disconnects': 0,
+            'socket_writes': 0,
+            'frames_written': 0,
+            'bytes_written': 0,
+            'outbound_queued_bytes': 0
         }
-        self.hourly_stats = defaultdict(lambda: {
-            'messages': 0,
-            'bytes': 0,
-            'avg_latency': 0
-        })
+        self.processing_time = Histogram()  # ns per handled message
+        self.latency = Histogram()  # ns from client send to delivery
+        # Bound straight to the histograms, so recording is a single call
+        self.record_processing_time = self.processing_time.record
+        self.record_latency = self.latency.record
+        self.handler_times = {}  # {(MessageType, Priority): Histogram of ns}
+        self.send_queue_depths = {}  # {client_id: frames waiting in its outbound queue}
+        # {depth: connections at it}, so the deepest queue is known without a pass over every client
+        self.send_queue_depth_counts = {}
+        self.max_send_queue_depth = 0
+        self.stats_sources = {}  # {name: callable returning a dict for get_current_stats}
+        self.metric_sources = []  # callables returning a list of MetricFamily for metric_families
+        self.series_path = Path('logs/metrics.jsonl')
         self.start_time = time.time()
+        self.start_monotonic = time.monotonic()
+        self._sampled = self._totals()  # totals as of the last time-series row
+    
+    def register_stats_source(self, name, callback):
+        self.stats_sources[name] = callback
+    
+    def register_metric_source(self, callback):
+        self.metric_sources.append(callback)
     
     def record_connection(self):
         self.metrics['connections'] += 1
@@ -35,25 +64,92 @@ class PerformanceMonitor:
     def record_message(self, size_bytes):
         self.metrics['messages_sent'] += 1
         self.metrics['bytes_transferred'] += size_bytes
-        
-        # Update hourly stats
-        hour_key = datetime.now().strftime('%Y-%m-%d %H:00')
-        self.hourly_stats[hour_key]['messages'] += 1
-        self.hourly_stats[hour_key]['bytes'] += size_bytes
     
-    def record_processing_time(self, time_seconds):
-        self.metrics['processing_times'].append(time_seconds)
+    def record_handled(self, message_type, priority, elapsed_ns):
+        """One message through its handler, timed overall and by type and priority"""
+        self.processing_time.record(elapsed_ns)
+        histogram = self.handler_times.get((message_type, priority))
+        if histogram is None:
+            histogram = self.handler_times[(message_type, priority)] = Histogram()
+        histogram.record(elapsed_ns)
     
-    def record_latency(self, latency_ms):
-        self.metrics['message_latencies'].append(latency_ms)
-        
-        # Update hourly average
-        hour_key = datetime.now().strftime('%Y-%m-%d %H:00')
-        stats = self.hourly_stats[hour_key]
-        if stats['avg_latency'] == 0:
-            stats['avg_latency'] = latency_ms
-        else:
-            stats['avg_latency'] = (stats['avg_latency'] + latency_ms) / 2
+    def record_send_queue(self, client_id, depth):
+        previous = self.send_queue_depths.get(client_id)
+        if previous == depth:
+            return
+        self.send_queue_depths[client_id] = depth
+        if previous is not None:
+            self._forget_send_queue_depth(previous)
+        counts = self.send_queue_depth_counts
+        counts[depth] = counts.get(depth, 0) + 1
+        if depth > self.max_send_queue_depth:
+            self.max_send_queue_depth = depth
+    
+    def _forget_send_queue_depth(self, depth):
+        counts = self.send_queue_depth_counts
+        left = counts[depth] - 1
+        if left:
+            counts[depth] = left
+            return
+        del counts[depth]
+        if depth == self.max_send_queue_depth:
+            # The deepest queue drained: step down to the next depth in use, a
+            # walk bounded by the slow consumer policy's max_frames
+            while depth > 0 and depth not in counts:
+                depth -= 1
+            self.max_send_queue_depth = depth
+    
+    def record_outbound(self, size_bytes):
+        """Bytes added to connection send queues, or taken off them when negative"""
+        self.metrics['outbound_queued_bytes'] += size_bytes
+    
+    def remove_send_queue(self, client_id):
+        depth = self.send_queue_depths.pop(client_id, None)
+        if depth is not None:
+            self._forget_send_queue_depth(depth)
+    
+    def record_write(self, frames, size_bytes):
+        """One write of a connection's outbound frames, batched by its ConnectionWriter"""
+        self.metrics['socket_writes'] += 1
+        self.metrics['frames_written'] += frames
+        self.metrics['bytes_written'] += size_bytes
+    
+    def record_dropped_frame(self):
+        self.metrics['dropped_frames'] += 1
+    
+    def record_slow_consumer(self):
+        self.metrics['slow_consumer_disconnects'] += 1
+    
+    # record_processing_time(ns) and record_latency(ns) are the histograms' record()
+    
+    def _totals(self):
+        return (
+            self.metrics['messages_sent'],
+            self.metrics['bytes_transferred'],
+            self.processing_time.copy(),
+            self.latency.copy()
+        )
+    
+    def sample(self):
+        """One time-series row: activity since the previous row, on the
+        monotonic clock, with the wall-clock time to label it by"""
+        messages, size, processing, latency = self._sampled
+        self._sampled = self._totals()
+        return {
+            'time': round(time.time(), 3),
+            'uptime': round(time.monotonic() - self.start_monotonic, 3),
+            'messages': self.metrics['messages_sent'] - messages,
+            'bytes': self.metrics['bytes_transferred'] - size,
+            'concurrent_users': self.metrics['concurrent_users'],
+            # [lowest, highest, count] of each bucket that has values
+            'processing_ns': self.processing_time.since(processing).buckets(),
+            'latency_ns': self.latency.since(latency).buckets()
+        }
+    
+    def export_sample(self):
+        # One write per row, so worker processes sharing the file never split a line
+        with open(self.series_path, 'a') as f:
+            f.write(json.dumps(self.sample(), separators=(',', ':')) + '\n')
     
     async def report_stats(self):
         """Periodically report and save statistics"""
@@ -70,65 +166,68 @@ class PerformanceMonitor:
                 }, f)
                 f.write('\n')
             
-            # Generate graphs every 5 minutes
-            if int(time.time()) % 300 == 0:
-                self.generate_performance_graphs()
+            # Time series for monitoring/report.py
+            self.export_sample()
     
     def get_current_stats(self):
-        uptime = time.time() - self.start_time
-        
-        avg_processing = sum(self.metrics['processing_times']) / len(self.metrics['processing_times']) \
-                        if self.metrics['processing_times'] else 0
+        uptime = time.monotonic() - self.start_monotonic
+        processing = self.processing_time.summary(scale=1e-6)
+        latency = self.latency.summary(scale=1e-6)
         
-        avg_latency = sum(self.metrics['message_latencies']) / len(self.metrics['message_latencies']) \
-                     if self.metrics['message_latencies'] else 0
-        
-        return {
+        writes = self.metrics['socket_writes']
+        stats = {
             'uptime_seconds': uptime,
             'total_connections': self.metrics['connections'],
             'concurrent_users': self.metrics['concurrent_users'],
             'messages_sent': self.metrics['messages_sent'],
             'bytes_transferred': self.metrics['bytes_transferred'],
-            'avg_processing_time_ms': avg_processing * 1000,
-            'avg_latency_ms': avg_latency,
+            'avg_processing_time_ms': processing['mean'],
+            'avg_latency_ms': latency['mean'],
+            'processing_time_ms': processing,
+            'latency_ms': latency,
             'messages_per_second': self.metrics['messages_sent'] / uptime if uptime > 0 else 0,
-            'bandwidth_mbps': (self.metrics['bytes_transferred'] * 8) / (uptime * 1_000_000) if uptime > 0 else 0
+            'bandwidth_mbps': (self.metrics['bytes_transferred'] * 8) / (uptime * 1_000_000) if uptime > 0 else 0,
+            'max_send_queue_depth': self.max_send_queue_depth,
+            'dropped_frames': self.metrics['dropped_frames'],
+            'slow_consumer_disconnects': self.metrics['slow_consumer_disconnects'],
+            'socket_writes': writes,
+            'frames_per_write': self.metrics['frames_written'] / writes if writes else 0,
+            'bytes_per_write': self.metrics['bytes_written'] / writes if writes else 0
         }
+        for name, source in self.stats_sources.items():
+            stats[name] = source()
+        return stats
     
-    def generate_performance_graphs(self):
-        Path('monitoring/graphs').mkdir(parents=True, exist_ok=True)
-        
-        # Processing time distribution
-        if self.metrics['processing_times']:
-            plt.figure(figsize=(10, 6))
-            plt.hist(self.metrics['processing_times'], bins=50, edgecolor='black')
-            plt.title('Message Processing Time Distribution')
-            plt.xlabel('Processing Time (seconds)')
-            plt.ylabel('Frequency')
-            plt.savefig('monitoring/graphs/processing_times.png')
-            plt.close()
-        
-        # Latency over time
-        if self.metrics['message_latencies']:
-            plt.figure(figsize=(10, 6))
-            plt.plot(self.metrics['message_latencies'])
-            plt.title('Message Latency Over Time')
-            plt.xlabel('Message Index')
-            plt.ylabel('Latency (ms)')
-            plt.savefig('monitoring/graphs/latency_timeline.png')
-            plt.close()
-        
-        # Hourly message volume
-        if self.hourly_stats:
-            hours = sorted(self.hourly_stats.keys())
-            messages = [self.hourly_stats[h]['messages'] for h in hours]
-            
-            plt.figure(figsize=(12, 6))
-            plt.bar(range(len(hours)), messages)
-            plt.title('Messages Per Hour')
-            plt.xlabel('Hour')
-            plt.ylabel('Message Count')
-            plt.xticks(range(len(hours)), hours, rotation=45)
-            plt.tight_layout()
-            plt.savefig('monitoring/graphs/hourly_messages.png')
-            plt.close()
+    def metric_families(self):
+        """The monitor's own metrics and those of every metric source, for
+        the metrics endpoint. The cost depends on the number of message
+        types and histogram buckets, never on the number of clients."""
+        m = self.metrics
+        families = [
+            MetricFamily('chat_uptime_seconds', 'gauge', 'Seconds since the server started',
+                         time.monotonic() - self.start_monotonic),
+            MetricFamily('chat_connections_total', 'counter', 'Client connections accepted', m['connections']),
+            MetricFamily('chat_connections_open', 'gauge', 'Client connections open', m['concurrent_users']),
+            MetricFamily('chat_frames_received_total', 'counter', 'Frames read from clients', m['messages_sent']),
+            MetricFamily('chat_received_bytes_total', 'counter', 'Bytes of frames read from clients',
+                         m['bytes_transferred']),
+            MetricFamily('chat_socket_writes_total', 'counter', 'Writes to client connections', m['socket_writes']),
+            MetricFamily('chat_frames_written_total', 'counter', 'Frames written to clients', m['frames_written']),
+            MetricFamily('chat_written_bytes_total', 'counter', 'Bytes written to clients', m['bytes_written']),
+            MetricFamily('chat_outbound_queued_bytes', 'gauge', 'Bytes waiting in connection send queues',
+                         m['outbound_queued_bytes']),
+            MetricFamily('chat_dropped_frames_total', 'counter', 'Low priority frames dropped for slow consumers',
+                         m['dropped_frames']),
+            MetricFamily('chat_slow_consumer_disconnects_total', 'counter',
+                         'Connections dropped for letting their send queue fill', m['slow_consumer_disconnects'])
+        ]
+        handlers = MetricFamily('chat_handler_seconds', 'histogram',
+                                'Time to handle a message, by message type and priority')
+        for (message_type, priority), histogram in self.handler_times.items():
+            handlers.add(histogram, type=message_type.value, priority=priority.name)
+        families.append(handlers)
+        families.append(MetricFamily('chat_message_latency_seconds', 'histogram',
+                                     'Time from a client sending a message to its delivery', self.latency))
+        for source in self.metric_sources:
+            families.extend(source())
+        return families
@@ -0,0 +1,208 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from pathlib import Path
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+def thread_stack(thread_id, limit=40):
+    """Innermost-last [name] of what a thread is running now"""
+    frame = sys._current_frames().get(thread_id)
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return names[::-1]
+
+def coroutine_stack(coro, limit=40):
+    """Outermost-first [name] of where a suspended coroutine is waiting,
+    following the chain of awaited coroutines"""
+    names = []
+    while coro is not None and len(names) < limit:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        names.append(f"{_frame_name(frame)} line {frame.f_lineno}")
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return names
+
+class SlowHandlerWatchdog:
+    """Reports message handlers that run past `threshold` seconds.
+
+    begin()/end() bracket each handler coroutine on the event loop: a dict
+    store and a pop. A thread wakes every threshold / 2 and looks at what is in
+    flight. A handler executing past the threshold, so blocking the loop,
+    is reported once as a warning with its name, message type and the loop
+    thread's stack. With a LoopLagProbe, a loop stall no handler accounts
+    for is reported too. The latest reports are kept for get_stats().
+
+    Handlers that are only suspended (password hashing in the executor, a
+    relay waiting on a slow receiver) cost the loop nothing, and some are
+    slow by design. They are logged at DEBUG, with the chain of coroutines
+    they wait in, once past wait_threshold, and counted apart in `waits`.
+    """
+    def __init__(self, threshold=0.1, probe=None, keep=20, wait_threshold=5.0):
+        self.threshold = threshold
+        self.wait_threshold = wait_threshold
+        self.probe = probe  # LoopLagProbe, whose ticks tell a stalled loop from a waiting handler
+        self.reports = deque(maxlen=keep)
+        self.counts = Counter()  # {(handler, message type value): runs blocking the loop}
+        self.waits = Counter()  # {(handler, message type value): runs waiting past wait_threshold}
+        self.logger = logging.getLogger(__name__)
+        self._running = {}  # {handler coroutine: (start ns, handler name, MessageType)}
+        self._reported = set()
+        self._waits_reported = set()
+        self._loop_thread = None
+        self._stalled_since = None  # probe tick of a stall already reported
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        if self._thread is None:
+            self._loop_thread = threading.get_ident()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name='slow-handler-watchdog', daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+    
+    def begin(self, coro, message_type, start_ns):
+        self._running[coro] = (start_ns, coro.__name__, message_type)
+    
+    def end(self, coro):
+        del self._running[coro]
+        if self._reported:
+            self._reported.discard(coro)
+        if self._waits_reported:
+            self._waits_reported.discard(coro)
+    
+    def _loop_stalled(self):
+        if self.probe is None:
+            return False
+        return time.perf_counter() - self.probe.last_tick > self.probe.interval + self.threshold
+    
+    def _watch(self):
+        threshold_ns = int(self.threshold * 1e9)
+        wait_threshold_ns = int(self.wait_threshold * 1e9)
+        while not self._stop.wait(self.threshold / 2):
+            now = time.perf_counter_ns()
+            for coro, (start, handler_name, message_type) in self._running.copy().items():
+                if now - start < threshold_ns or coro in self._reported:
+                    continue
+                # A running coroutine is the one the loop is executing right now
+                if coro.cr_running:
+                    self._reported.add(coro)
+                    if self.probe:
+                        self._stalled_since = self.probe.last_tick  # this handler accounts for the stall
+                    self._report(handler_name, message_type.value, (now - start) / 1e6, thread_stack(self._loop_thread))
+                elif now - start >= wait_threshold_ns and coro not in self._waits_reported:
+                    self._waits_reported.add(coro)
+                    self._report_wait(handler_name, message_type.value, (now - start) / 1e6, coroutine_stack(coro))
+            # A stall outside any handler: a callback, a timer, the server's own tasks
+            if self._loop_stalled() and self._stalled_since != self.probe.last_tick:
+                self._stalled_since = self.probe.last_tick
+                self._report(None, None, (time.perf_counter() - self.probe.last_tick) * 1000,
+                             thread_stack(self._loop_thread))
+    
+    def _report(self, handler_name, message_type, elapsed_ms, stack):
+        self.counts[(handler_name, message_type)] += 1
+        self.reports.append({
+            'time': datetime.now().isoformat(),
+            'handler': handler_name,
+            'type': message_type,
+            'elapsed_ms': round(elapsed_ms, 1),
+            'blocking_loop': True,
+            'stack': stack
+        })
+        what = f"Handler {handler_name} ({message_type}) blocking" if handler_name else "Stall of"
+        self.logger.warning(
+            f"{what} the event loop for {elapsed_ms:.0f} ms, in:\n    " + '\n    '.join(stack[-12:])
+        )
+    
+    def _report_wait(self, handler_name, message_type, elapsed_ms, stack):
+        self.waits[(handler_name, message_type)] += 1
+        self.logger.debug(
+            f"Handler {handler_name} ({message_type}) waiting for {elapsed_ms:.0f} ms, in:\n    "
+            + '\n    '.join(stack[-12:])
+        )
+    
+    def get_stats(self):
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'wait_threshold_ms': self.wait_threshold * 1000,
+            'in_flight': len(self._running),
+            'slow': sum(self.counts.values()),
+            'long_waits': sum(self.waits.values()),
+            'latest': list(self.reports)[-3:]
+        }
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack every `interval` seconds while on,
+    and writes the counts as folded stacks (one "outer;...;inner count"
+    line per stack), the input of flamegraph.pl, speedscope and friends.
+
+    Nothing runs while it is off. toggle() is meant for a signal handler:
+    the server switches it with SIGUSR1.
+    """
+    def __init__(self, interval=0.005, out_dir='logs'):
+        self.interval = interval
+        self.out_dir = Path(out_dir)
+        self.last_path = None
+        self.logger = logging.getLogger(__name__)
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+    
+    @property
+    def running(self):
+        return self._thread is not None
+    
+    def start(self, thread_id=None):
+        if self._thread is None:
+            self._target = thread_id or threading.get_ident()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+            self._thread.start()
+            self.logger.info(f"Sampling profiler started, every {self.interval * 1000:.0f} ms")
+    
+    def stop(self):
+        """Stops sampling; returns the path of the folded stacks file"""
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self.last_path
+    
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+    
+    def _sample(self):
+        stacks = Counter()
+        started = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            stack = thread_stack(self._target, limit=200)
+            if stack:
+                stacks[';'.join(name.replace(';', ':') for name in stack)] += 1
+        
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        path = self.out_dir / f"profile-{os.getpid()}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.last_path = path
+        self.logger.info(
+            f"Sampling profiler wrote {sum(stacks.values())} samples over "
+            f"{time.perf_counter() - started:.1f}s to {path}"
+        )
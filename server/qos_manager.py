@@ -1,64 +1,142 @@
 import asyncio
-import heapq
-from dataclasses import dataclass, field
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
 from typing import Any
 from common.protocol import Priority
 
-@dataclass(order=True)
+PRIORITY_ORDER = [Priority.CRITICAL, Priority.HIGH, Priority.NORMAL, Priority.LOW]
+
+@dataclass
 class PriorityItem:
-    priority: int
-    count: int = field(compare=False)
-    func: Any = field(compare=False)
-    args: Any = field(compare=False)
-    kwargs: Any = field(compare=False)
+    priority: Priority
+    func: Any
+    args: Any
+    kwargs: Any
+    enqueued_at: float
+    key: Any = None
+    background: bool = False
 
 class QoSManager:
-    def __init__(self, max_concurrent=10):
-        self.queues = {
-            Priority.CRITICAL: [],
-            Priority.HIGH: [],
-            Priority.NORMAL: [],
-            Priority.LOW: []
-        }
+    """Strict-priority scheduler with aging, run by a fixed pool of workers.
+
+    No task is created per message: max_concurrent long-lived workers pull
+    from the priority queues. enqueue() waits once max_backlog items are
+    pending, which pushes back on the reading side of the connection.
+
+    Items enqueued with the same key run one at a time in FIFO order,
+    while different keys run in parallel. Background items (handlers that
+    mostly wait on an executor, like password hashing) run as their own
+    task so they do not pin a worker; their key stays held until they finish.
+    """
+    def __init__(self, max_concurrent=10, max_backlog=10000, aging_threshold=0.5):
+        self.queues = {priority: deque() for priority in PRIORITY_ORDER}
         self.max_concurrent = max_concurrent
+        self.max_backlog = max_backlog
+        self.aging_threshold = aging_threshold  # seconds before a lower priority item may jump ahead
         self.current_tasks = 0
-        self.counter = 0
-        self.lock = asyncio.Lock()
+        self.backlog = 0
+        self.logger = logging.getLogger(__name__)
+        self._slots = asyncio.Semaphore(max_backlog)
+        self._items = asyncio.Semaphore(0)
+        self._workers = []
+        self._keyed = {}  # {key: deque of items waiting behind the one queued or running}
+        self._background = set()
     
-    async def enqueue(self, func, *args, priority=Priority.NORMAL, **kwargs):
-        async with self.lock:
-            self.counter += 1
-            item = PriorityItem(
-                priority=-priority.value,  # Higher priority = lower number
-                count=self.counter,
-                func=func,
-                args=args,
-                kwargs=kwargs
-            )
-            heapq.heappush(self.queues[priority], item)
-        
-        asyncio.create_task(self._process_queue())
+    def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker())
+                for _ in range(self.max_concurrent)
+            ]
     
-    async def _process_queue(self):
-        async with self.lock:
-            if self.current_tasks >= self.max_concurrent:
+    async def stop(self):
+        tasks = self._workers + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+    
+    async def enqueue(self, func, *args, priority=Priority.NORMAL, key=None, background=False, **kwargs):
+        if not self._workers:
+            self.start()
+        
+        # Backpressure: wait for room in the backlog
+        await self._slots.acquire()
+        
+        item = PriorityItem(priority, func, args, kwargs, time.monotonic(), key, background)
+        self.backlog += 1
+        
+        if key is not None:
+            waiting = self._keyed.get(key)
+            if waiting is not None:
+                # An item with this key is already queued or running
+                waiting.append(item)
                 return
-            
-            # Find highest priority non-empty queue
-            for priority in [Priority.CRITICAL, Priority.HIGH, Priority.NORMAL, Priority.LOW]:
-                if self.queues[priority]:
-                    item = heapq.heappop(self.queues[priority])
-                    self.current_tasks += 1
-                    
-                    asyncio.create_task(self._execute_task(item))
-                    break
+            self._keyed[key] = deque()
+        
+        self.queues[priority].append(item)
+        self._items.release()
+    
+    def _next_item(self):
+        now = time.monotonic()
+        selected = None
+        for priority in PRIORITY_ORDER:
+            queue = self.queues[priority]
+            if not queue:
+                continue
+            if selected is None:
+                selected = queue
+            elif (now - queue[0].enqueued_at > self.aging_threshold
+                    and queue[0].enqueued_at < selected[0].enqueued_at):
+                # Aged lower priority work goes ahead so it cannot starve
+                selected = queue
+        
+        self.backlog -= 1
+        return selected.popleft()
+    
+    async def _worker(self):
+        while True:
+            await self._items.acquire()
+            item = self._next_item()
+            if item.background:
+                task = asyncio.create_task(self._run(item))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            else:
+                await self._run(item)
     
-    async def _execute_task(self, item):
+    async def _run(self, item):
+        self.current_tasks += 1
         try:
             await item.func(*item.args, **item.kwargs)
+        except Exception as e:
+            self.logger.error(f"Error processing {item.priority.name} task: {e}")
         finally:
-            async with self.lock:
-                self.current_tasks -= 1
-            
-            # Process next item
-            asyncio.create_task(self._process_queue())
+            self.current_tasks -= 1
+            self._slots.release()
+            if item.key is not None:
+                self._release_key(item.key)
+    
+    def _release_key(self, key):
+        waiting = self._keyed[key]
+        if not waiting:
+            del self._keyed[key]
+            return
+        
+        # Hand the next item for this key back to the scheduler so it
+        # competes with other keys at its own priority
+        item = waiting.popleft()
+        self.queues[item.priority].append(item)
+        self._items.release()
+    
+    def get_stats(self):
+        return {
+            'backlog': self.backlog,
+            'running': self.current_tasks,
+            'active_keys': len(self._keyed),
+            'queue_depths': {
+                priority.name: len(queue) for priority, queue in self.queues.items()
+            }
+        }
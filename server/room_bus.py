@@ -0,0 +1,339 @@
+import asyncio
+import itertools
+import logging
+import struct
+import zlib
+from common.codec import pack_value, unpack_value
+
+# Bus frame: [4 bytes length][tagged dict, see common.codec]; every frame has an 'op'
+_LENGTH = struct.Struct('!I')
+
+def pack_bus_frame(op, fields):
+    body = pack_value(dict(fields, op=op))
+    return _LENGTH.pack(len(body)) + body
+
+async def read_bus_frame(reader):
+    length = _LENGTH.unpack(await reader.readexactly(4))[0]
+    data = await reader.readexactly(length)
+    return unpack_value(data, 0)[0]
+
+class SessionTable:
+    """Who holds each user's session: {username: (holder, client_id, session_id)},
+    where holder is the worker or node the connection lives on.
+
+    A session whose connection went away stays as (None, None, session_id),
+    for the resume token carrying that id only; a logged out one stays as
+    (None, None, None), which no token resumes. A new login takes either.
+    """
+    def __init__(self):
+        self.sessions = {}
+    
+    def claim(self, username, holder, client_id, session_id, takeover=False, new_session_id=None):
+        """Returns (granted, (holder, client_id) to revoke or None). A takeover
+        moves the session to new_session_id, spending the token it came with."""
+        current = self.sessions.get(username)
+        if takeover:
+            # Resuming takes over the session it was issued for, wherever it lives now
+            granted = current is None or current[2] == session_id
+        else:
+            granted = current is None or current[0] is None
+        if not granted:
+            return False, None
+        
+        self.sessions[username] = (holder, client_id, new_session_id or session_id)
+        if current is not None and current[0] is not None and current[:2] != (holder, client_id):
+            return True, current[:2]
+        return True, None
+    
+    def release(self, username, holder, client_id, ended=False):
+        current = self.sessions.get(username)
+        if current is not None and current[:2] == (holder, client_id):
+            self.sessions[username] = (None, None, None if ended else current[2])
+    
+    def drop(self, holder):
+        # Its connections are gone, but their sessions can be resumed elsewhere
+        for username, current in list(self.sessions.items()):
+            if current[0] == holder:
+                self.sessions[username] = (None, None, current[2])
+    
+    def __len__(self):
+        return sum(1 for current in self.sessions.values() if current[0] is not None)
+
+class RoomBusBroker:
+    """Hub of the workers of one server, listening on a Unix socket.
+
+    Workers report room and membership changes, which the broker applies
+    to its own copy of the room table and passes on to every other worker,
+    so all of them see the same rooms and members. It numbers each room
+    message and hands it to every worker, so message ids and history agree
+    everywhere. Frames for other workers' members only go to workers that
+    have a member in the room. Sessions are claimed here, so a user is
+    logged in on one worker at most.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.workers = {}  # {worker_id: StreamWriter}
+        self.rooms = {}  # {room_id: {'name', 'created', 'members': {client_id: [worker_id, username]}, 'message_count'}}
+        self.sessions = SessionTable()
+        self.logger = logging.getLogger(__name__)
+        self.stats = {
+            'frames_in': 0,
+            'frames_out': 0,
+            'room_messages': 0
+        }
+        self._server = None
+    
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle_worker, self.path)
+        self.logger.info(f"Room bus listening on {self.path}")
+    
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    async def _handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            hello = await read_bus_frame(reader)
+            worker_id = hello['worker']
+            self.workers[worker_id] = writer
+            # A (re)started worker catches up on the current rooms first
+            self._send(worker_id, 'snapshot', {'rooms': self.rooms})
+            self.logger.info(f"Worker {worker_id} joined the room bus")
+            
+            while True:
+                frame = await read_bus_frame(reader)
+                self.stats['frames_in'] += 1
+                handler = getattr(self, f"_on_{frame['op']}", None)
+                if handler:
+                    handler(worker_id, frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.error(f"Error on room bus link of worker {worker_id}: {e}")
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self._drop_worker(worker_id)
+            writer.close()
+    
+    def _send(self, worker_id, op, fields):
+        writer = self.workers.get(worker_id)
+        if writer is not None:
+            writer.write(pack_bus_frame(op, fields))
+            self.stats['frames_out'] += 1
+    
+    def _send_others(self, origin, op, fields):
+        frame = pack_bus_frame(op, fields)
+        for worker_id, writer in self.workers.items():
+            if worker_id != origin:
+                writer.write(frame)
+                self.stats['frames_out'] += 1
+    
+    def _room(self, room_id, name, created):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = {
+                'name': name,
+                'created': created,
+                'members': {},
+                'message_count': 0
+            }
+        return room
+    
+    def _on_room_created(self, worker_id, frame):
+        self._room(frame['room_id'], frame['name'], frame['created'])
+        self._send_others(worker_id, 'room_created', frame)
+    
+    def _on_member_joined(self, worker_id, frame):
+        room = self._room(frame['room_id'], frame['name'], frame['created'])
+        room['members'][frame['client_id']] = [worker_id, frame['username']]
+        self._send_others(worker_id, 'member_joined', frame)
+    
+    def _on_member_left(self, worker_id, frame):
+        room = self.rooms.get(frame['room_id'])
+        if room is not None:
+            room['members'].pop(frame['client_id'], None)
+            if not room['members']:
+                del self.rooms[frame['room_id']]
+        self._send_others(worker_id, 'member_left', frame)
+    
+    def _on_forward(self, worker_id, frame):
+        room = self.rooms.get(frame['room_id'])
+        if room is None:
+            return
+        
+        data = pack_bus_frame('forward', frame)
+        targets = {member[0] for member in room['members'].values()}
+        targets.discard(worker_id)
+        for target in targets:
+            writer = self.workers.get(target)
+            if writer is not None:
+                writer.write(data)
+                self.stats['frames_out'] += 1
+    
+    def _on_publish(self, worker_id, frame):
+        room = self.rooms.get(frame['room_id'])
+        if room is None:
+            return
+        
+        # Numbered here, in one order for everybody; the sender's worker gets it back too
+        room['message_count'] += 1
+        frame['message_id'] = room['message_count']
+        self.stats['room_messages'] += 1
+        self._send_others(None, 'room_message', frame)
+    
+    def _on_claim(self, worker_id, frame):
+        granted, revoked = self.sessions.claim(
+            frame['username'], worker_id, frame['client_id'], frame['session_id'], frame['takeover'],
+            frame.get('new_session_id')
+        )
+        if revoked:
+            self._send(revoked[0], 'revoke', {'username': frame['username'], 'client_id': revoked[1]})
+        self._send(worker_id, 'reply', {'request_id': frame['request_id'], 'ok': granted})
+    
+    def _on_release(self, worker_id, frame):
+        self.sessions.release(frame['username'], worker_id, frame['client_id'], frame.get('ended', False))
+    
+    def _drop_worker(self, worker_id):
+        """A worker went away: its connections are gone, and so are their memberships"""
+        for room_id, room in list(self.rooms.items()):
+            for client_id, member in list(room['members'].items()):
+                if member[0] == worker_id:
+                    self._on_member_left(worker_id, {'room_id': room_id, 'client_id': client_id})
+        self.sessions.drop(worker_id)
+        self.logger.warning(f"Worker {worker_id} left the room bus")
+    
+    def get_stats(self):
+        return dict(
+            self.stats,
+            workers=len(self.workers),
+            rooms=len(self.rooms),
+            sessions=len(self.sessions)
+        )
+
+class RoomBus:
+    """One worker's link to the RoomBusBroker.
+
+    send() queues a frame without waiting. Frames from the broker are
+    handled in the order they arrive by handlers[op]; coroutine handlers
+    are awaited before the next frame is read. ChatServer uses the same
+    interface for a cluster of nodes (see cluster.Cluster).
+    """
+    # The broker hands every room message to every worker, so each keeps the
+    # whole history itself and nobody forwards room messages on
+    delivers_room_messages = True
+    
+    def __init__(self, path, worker_id, num_workers, handlers):
+        self.path = str(path)
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.handlers = handlers
+        self.writer = None
+        self.pending = {}  # {request_id: Future} of claims awaiting the broker's reply
+        self.request_ids = itertools.count(1)
+        self.logger = logging.getLogger(__name__)
+        self.stats = {
+            'frames_in': 0,
+            'frames_out': 0
+        }
+        self.lost = asyncio.Event()
+        self._task = None
+    
+    async def connect(self, attempts=50, delay=0.1):
+        # The broker may still be starting up
+        for attempt in range(attempts):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(delay)
+        
+        self.writer.write(pack_bus_frame('hello', {'worker': self.worker_id}))
+        self._task = asyncio.create_task(self._read_loop(reader))
+    
+    def send(self, op, **fields):
+        self.writer.write(pack_bus_frame(op, fields))
+        self.stats['frames_out'] += 1
+    
+    def announce(self, op, **fields):
+        """Room and membership changes, replayed by every other worker"""
+        self.send(op, **fields)
+    
+    def forward(self, member_ids, **fields):
+        # The broker knows which workers hold members of the room
+        self.send('forward', **fields)
+    
+    def publish(self, room_id, message, exclude):
+        """Hand a room message to the broker to be numbered; it comes back
+        as 'room_message'. Returns whether it was handed off."""
+        self.send('publish', room_id=room_id, message=message, exclude=exclude)
+        return True
+    
+    def owns(self, room_id):
+        return True  # every worker has the room's history
+    
+    def writes_room_log(self, room_id):
+        # One writer per room log, spread over the workers
+        return zlib.crc32(room_id.encode()) % self.num_workers == self.worker_id
+    
+    async def claim_session(self, username, client_id, session_id, takeover=False, new_session_id=None):
+        request_id = next(self.request_ids)
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        self.send(
+            'claim',
+            request_id=request_id,
+            username=username,
+            client_id=client_id,
+            session_id=session_id,
+            takeover=takeover,
+            new_session_id=new_session_id
+        )
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+    
+    def release_session(self, username, client_id, ended=False):
+        self.send('release', username=username, client_id=client_id, ended=ended)
+    
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                frame = await read_bus_frame(reader)
+                self.stats['frames_in'] += 1
+                op = frame['op']
+                if op == 'reply':
+                    future = self.pending.get(frame['request_id'])
+                    if future and not future.done():
+                        future.set_result(frame['ok'])
+                    continue
+                
+                handler = self.handlers.get(op)
+                if handler is None:
+                    continue
+                try:
+                    result = handler(frame)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    self.logger.error(f"Error handling room bus frame '{op}': {e}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.logger.error("Lost the room bus")
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(False)
+            self.lost.set()
+    
+    def get_stats(self):
+        return dict(self.stats, worker=self.worker_id, claims_pending=len(self.pending))
+    
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self.writer:
+            self.writer.close()
@@ -0,0 +1,56 @@
+from collections import deque
+from common.protocol import Message
+
+class RoomHistory:
+    """Ring buffer of a room's recent messages, kept as encoded frames.
+
+    Bounded both by message count and by the bytes of the frames held.
+    Frames are stored per codec as they were sent, so replaying history
+    to a joining member costs a join of byte strings, not a re-encode.
+    A codec nobody in the room used yet is encoded once, on first replay.
+    """
+    def __init__(self, max_messages=200, max_bytes=256 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()  # [(message_id, {codec: frame})], oldest first
+        self.bytes = 0
+    
+    def append(self, message_id, frames):
+        frames = dict(frames)
+        self.entries.append((message_id, frames))
+        self.bytes += sum(len(frame) for frame in frames.values())
+        self._trim()
+    
+    def _trim(self):
+        while self.entries and (len(self.entries) > self.max_messages or self.bytes > self.max_bytes):
+            _, frames = self.entries.popleft()
+            self.bytes -= sum(len(frame) for frame in frames.values())
+    
+    def _frame(self, frames, codec):
+        frame = frames.get(codec)
+        if frame is None:
+            # Re-encode from a frame we already hold; cached for later joins
+            stored = next(iter(frames.values()))
+            frame = frames[codec] = Message.from_bytes(stored[4:]).to_bytes(codec)
+            self.bytes += len(frame)
+        return frame
+    
+    def since(self, message_id, codec, limit):
+        """Frames of up to limit messages newer than message_id (None: the latest
+        limit messages), the first and last id sent, and whether more follow.
+        Returns None if messages after message_id have already been dropped."""
+        if message_id is None:
+            selected = list(self.entries)[-limit:] if limit else []
+            more = False
+        elif self.entries and self.entries[0][0] > message_id + 1:
+            return None
+        else:
+            newer = [entry for entry in self.entries if entry[0] > message_id]
+            selected = newer[:limit]
+            more = len(newer) > limit
+        
+        frames = [self._frame(entry_frames, codec) for _, entry_frames in selected]
+        self._trim()
+        first_id = selected[0][0] if selected else None
+        last_id = selected[-1][0] if selected else None
+        return frames, first_id, last_id, more
@@ -2,37 +2,54 @@ import uuid
 from datetime import datetime
 from collections import defaultdict
 import threading
+from room_history import RoomHistory
 
 class RoomManager:
-    def __init__(self):
-        self.rooms = {}  # {room_id: {'name': str, 'users': set, 'created': datetime}}
+    def __init__(self, history_messages=200, history_bytes=256 * 1024):
+        self.rooms = {}  # {room_id: {'name': str, 'members': {client_id: username}, 'created': datetime, 'history': RoomHistory}}
         self.lock = threading.RLock()
+        self.history_messages = history_messages
+        self.history_bytes = history_bytes
     
-    def create_room(self, name):
+    def create_room(self, name, room_id=None, created=None):
+        """New room; room_id and created are given when replicating a room made elsewhere"""
         with self.lock:
-            room_id = str(uuid.uuid4())
-            self.rooms[room_id] = {
-                'name': name,
-                'users': set(),
-                'created': datetime.now(),
-                'message_count': 0
-            }
+            room_id = room_id or str(uuid.uuid4())
+            if room_id not in self.rooms:
+                self.rooms[room_id] = {
+                    'name': name,
+                    'members': {},
+                    'created': created or datetime.now(),
+                    'message_count': 0,
+                    'history': RoomHistory(self.history_messages, self.history_bytes)
+                }
             return room_id
     
-    def join_room(self, room_id, username):
+    def get_room(self, room_id):
         with self.lock:
             if room_id in self.rooms:
-                self.rooms[room_id]['users'].add(username)
+                info = self.rooms[room_id]
+                return {
+                    'name': info['name'],
+                    'created': info['created'].isoformat(),
+                    'message_count': info['message_count']
+                }
+            return None
+    
+    def join_room(self, room_id, client_id, username):
+        with self.lock:
+            if room_id in self.rooms:
+                self.rooms[room_id]['members'][client_id] = username
                 return True
             return False
     
-    def leave_room(self, room_id, username):
+    def leave_room(self, room_id, client_id):
         with self.lock:
             if room_id in self.rooms:
-                self.rooms[room_id]['users'].discard(username)
+                self.rooms[room_id]['members'].pop(client_id, None)
                 
                 # Remove empty rooms
-                if not self.rooms[room_id]['users']:
+                if not self.rooms[room_id]['members']:
                     del self.rooms[room_id]
                 return True
             return False
@@ -40,7 +57,25 @@ class RoomManager:
     def get_room_users(self, room_id):
         with self.lock:
             if room_id in self.rooms:
-                return list(self.rooms[room_id]['users'])
+                return list(self.rooms[room_id]['members'].values())
+            return []
+    
+    def get_members(self, room_id):
+        """{client_id: username} of the room's members"""
+        with self.lock:
+            if room_id in self.rooms:
+                return dict(self.rooms[room_id]['members'])
+            return {}
+    
+    def room_ids(self):
+        with self.lock:
+            return list(self.rooms)
+    
+    def get_room_members(self, room_id):
+        """Connection ids in the room; cost is O(room size), not O(connections)"""
+        with self.lock:
+            if room_id in self.rooms:
+                return list(self.rooms[room_id]['members'])
             return []
     
     def list_rooms(self):
@@ -49,12 +84,75 @@ class RoomManager:
                 {
                     'id': room_id,
                     'name': info['name'],
-                    'user_count': len(info['users']),
+                    'user_count': len(info['members']),
                     'created': info['created'].isoformat()
                 }
                 for room_id, info in self.rooms.items()
             ]
     
+    def next_message_id(self, room_id):
+        """Room-local sequence number, used as the id of messages kept in history"""
+        with self.lock:
+            if room_id in self.rooms:
+                self.rooms[room_id]['message_count'] += 1
+                return self.rooms[room_id]['message_count']
+            return None
+    
+    def set_message_id(self, room_id, message_id):
+        """Adopt an id handed out elsewhere, e.g. by the room bus"""
+        with self.lock:
+            if room_id in self.rooms:
+                info = self.rooms[room_id]
+                info['message_count'] = max(info['message_count'], message_id)
+    
+    def add_history(self, room_id, message_id, frames):
+        with self.lock:
+            if room_id in self.rooms:
+                self.rooms[room_id]['history'].append(message_id, frames)
+    
+    def get_history_entries(self, room_id):
+        """[(message_id, {codec: frame})] kept for the room, oldest first"""
+        with self.lock:
+            if room_id in self.rooms:
+                return list(self.rooms[room_id]['history'].entries)
+            return []
+    
+    def import_history(self, room_id, entries):
+        """Merge entries from the room's previous owner with any already held"""
+        with self.lock:
+            if room_id not in self.rooms:
+                return
+            history = RoomHistory(self.history_messages, self.history_bytes)
+            merged = {message_id: frames for message_id, frames in entries}
+            merged.update(self.rooms[room_id]['history'].entries)
+            for message_id in sorted(merged):
+                history.append(message_id, merged[message_id])
+            self.rooms[room_id]['history'] = history
+    
+    def get_history(self, room_id, codec, since=None, limit=50):
+        with self.lock:
+            if room_id in self.rooms:
+                return self.rooms[room_id]['history'].since(since, codec, limit)
+            return [], None, None, False
+    
+    def get_history_stats(self):
+        with self.lock:
+            histories = [info['history'] for info in self.rooms.values()]
+            return {
+                'rooms': len(histories),
+                'messages': sum(len(history.entries) for history in histories),
+                'bytes': sum(history.bytes for history in histories),
+                'max_bytes_per_room': self.history_bytes
+            }
+    
+    def get_room_counts(self):
+        """[(room_id, name, members, messages)] of every room"""
+        with self.lock:
+            return [
+                (room_id, info['name'], len(info['members']), info['message_count'])
+                for room_id, info in self.rooms.items()
+            ]
+    
     def room_exists(self, room_id):
         with self.lock:
             return room_id in self.rooms
@@ -1,6 +1,9 @@
+import argparse
 import asyncio
+import signal
 import ssl
 import json
+import base64
 import logging
 import time
 from datetime import datetime
@@ -11,24 +14,103 @@ import sys
 # Add parent directory to path
 sys.path.append(str(Path(__file__).parent.parent))
 
-from common.protocol import Message, MessageType, Priority
+from common.protocol import (
+    Message, MessageType, Priority, SUPPORTED_CODECS, CODEC_JSON, CODEC_BINARY, BINARY_MAGIC,
+    FILE_STREAM_MAGIC, pack_file_chunk, unpack_file_chunk
+)
+from common.framing import FrameProtocol, FRAME_HEADER, MAX_FRAME_SIZE
+from common.manifest import build_manifest_blob, parse_manifest_blob, transfer_id_for
 from common.security import SecurityManager
 
 # Import from current directory
 from room_manager import RoomManager
-from user_manager import UserManager
+from user_manager import UserManager, load_token_key
 from qos_manager import QoSManager
 from performance_monitor import PerformanceMonitor
+from connection_writer import ConnectionWriter, SlowConsumerPolicy
+from content_store import ContentStore
+from message_log import MessageLog
+from room_bus import RoomBus
+from idle_timer import IdleTimer
+from metrics import MetricFamily, LoopLagProbe
+from profiler import SlowHandlerWatchdog, SamplingProfiler
+from tracer import MessageTracer
+from metrics_endpoint import MetricsEndpoint
+from cluster import Cluster, parse_cluster_nodes
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=8888):
+    def __init__(self, host='0.0.0.0', port=8888, slow_consumer_policy=None, ordering='connection',
+                 worker_id=None, num_workers=1, bus_path=None, node_id=None, cluster_nodes=None,
+                 idle_timeout=60, idle_precision=1.0, metrics_port=None, metrics_path=None,
+                 slow_handler_threshold=0.1, trace_sample_rate=0.01):
         self.host = host
         self.port = port
+        # Set when running as one of several worker processes (see supervisor.py):
+        # the port is shared with SO_REUSEPORT and rooms span workers over the room bus
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.bus_path = bus_path
+        # Set when running as one node of a cluster (see cluster.py): {node_id: (host, port)} of the node links
+        self.node_id = node_id
+        self.cluster_nodes = cluster_nodes
+        self.bus = None  # RoomBus or Cluster, whichever links this server to the others
         self.clients = {}  # {client_id: {'writer': writer, 'user': user_info, 'room_id': room_id}}
+        # Room membership itself (room -> connection ids) lives in RoomManager
+        self.user_connections = {}  # {username: client_id} of the connection owning the session
         self.room_manager = RoomManager()
         self.user_manager = UserManager()
         self.qos_manager = QoSManager()
         self.performance_monitor = PerformanceMonitor()
+        self.slow_consumer_policy = slow_consumer_policy or SlowConsumerPolicy()
+        self.max_frame_size = MAX_FRAME_SIZE  # larger length prefixes drop the connection
+        self.performance_monitor.register_stats_source('qos', self.qos_manager.get_stats)
+        self.performance_monitor.register_stats_source('password_hashing', self.user_manager.get_hash_stats)
+        self.content_store = ContentStore()
+        self.performance_monitor.register_stats_source('content_store', self.content_store.get_stats)
+        self.performance_monitor.register_stats_source('room_history', self.room_manager.get_history_stats)
+        # Nodes sharing a disk (a cluster on one host) keep their room logs apart
+        self.message_log = MessageLog(Path('logs/nodes') / node_id / 'rooms' if node_id else 'logs/rooms')
+        self.performance_monitor.register_stats_source('message_log', self.message_log.get_stats)
+        self.history_on_join = 50  # recent messages replayed to a member joining a room
+        # 'connection': frames from one client are handled in order
+        # 'room': frames from all members of a room are handled in order
+        self.ordering = ordering
+        self.file_transfers = {}  # {(sender client_id, transfer_id): manifest and chunks still to upload}
+        # Uploads one client may have in progress, and how long one may go without a chunk
+        self.max_transfers_per_client = 8
+        self.file_transfer_timeout = 60
+        # Files announced in each room, which its members may fetch again; oldest first
+        self.shared_files = {}  # {room_id: {file_hash: None}}
+        self.max_shared_files = 1000  # per room
+        # How long a file relay waits for a slow member's queue before dropping a chunk for it
+        self.file_relay_timeout = 10
+        # Raw file chunks one connection may have queued or relaying; past it, its socket is not read
+        self.max_stream_chunks_in_flight = 32
+        # Connections that send no frame for idle_timeout seconds are dropped, give or take idle_precision
+        self.idle_timer = IdleTimer(idle_timeout, idle_precision)
+        self.performance_monitor.register_stats_source('idle', self.idle_timer.get_stats)
+        self.loop_probe = LoopLagProbe()
+        self.performance_monitor.register_stats_source('event_loop', self.loop_probe.get_stats)
+        # Handlers blocking the loop past slow_handler_threshold seconds are logged with a stack sample (None: off)
+        self.watchdog = None
+        if slow_handler_threshold:
+            self.watchdog = SlowHandlerWatchdog(slow_handler_threshold, self.loop_probe)
+            self.performance_monitor.register_stats_source('slow_handlers', self.watchdog.get_stats)
+        # Folded stacks of the event loop thread, switched on and off with SIGUSR1
+        self.profiler = SamplingProfiler()
+        # Share of text messages clients trace from send to delivery (0: none)
+        self.tracer = None
+        if trace_sample_rate:
+            self.tracer = MessageTracer(trace_sample_rate, self.performance_monitor)
+            self.performance_monitor.register_stats_source('tracing', self.tracer.get_stats)
+            self.performance_monitor.register_metric_source(self.tracer.metric_families)
+        self.performance_monitor.register_metric_source(self._metric_families)
+        # Prometheus-style /metrics on a local TCP port or Unix socket, if either is given
+        self.metrics_endpoint = None
+        if metrics_port is not None or metrics_path:
+            self.metrics_endpoint = MetricsEndpoint(
+                self.performance_monitor.metric_families, port=metrics_port, path=metrics_path
+            )
         
         # Create logs directory if it doesn't exist
         Path('logs').mkdir(exist_ok=True)
@@ -55,47 +137,97 @@ class ChatServer:
         )
         return ssl_context
     
-    async def handle_client(self, reader, writer):
-        client_addr = writer.get_extra_info('peername')
+    def _create_cluster_ssl_contexts(self):
+        """(server side, client side) of cluster links: every node presents the
+        shared certificate and accepts only peers presenting it too"""
+        cert_file, key_file = 'certificates/server-cert.pem', 'certificates/server-key.pem'
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=cert_file)
+        server_context.load_cert_chain(cert_file, key_file)
+        server_context.verify_mode = ssl.CERT_REQUIRED
+        client_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cert_file)
+        client_context.load_cert_chain(cert_file, key_file)
+        # Peers are dialed by address; the pinned certificate is what identifies them
+        client_context.check_hostname = False
+        return server_context, client_context
+    
+    async def handle_client(self, stream):
+        # stream: the connection's FrameProtocol, which both reads and writes
+        client_addr = stream.get_extra_info('peername')
         client_id = f"{client_addr[0]}:{client_addr[1]}_{time.time()}"
         
         self.logger.info(f"New connection from {client_addr}")
         self.performance_monitor.record_connection()
         
+        # Outbound frames go through a per-connection queue and writer task
+        connection = ConnectionWriter(
+            client_id,
+            stream,
+            policy=self.slow_consumer_policy,
+            monitor=self.performance_monitor
+        )
+        self.idle_timer.add(client_id, connection)
+        
         try:
-            await self._client_loop(client_id, reader, writer)
+            await self._client_loop(client_id, stream, connection)
         except asyncio.CancelledError:
             pass
         except Exception as e:
             self.logger.error(f"Error handling client {client_id}: {e}")
         finally:
+            self.idle_timer.remove(client_id)
+            if self.tracer:
+                self.tracer.forget(client_id)
             await self._disconnect_client(client_id)
+            await connection.close()
     
     async def _client_loop(self, client_id, reader, writer):
+        stream_credits = asyncio.Semaphore(self.max_stream_chunks_in_flight)
         while True:
             try:
-                # Read message length
-                length_data = await reader.readexactly(4)
-                if not length_data:
-                    break
-                
-                import struct
-                length = struct.unpack('!I', length_data)[0]
-                
-                # Read message data
-                data = await reader.readexactly(length)
-                message = Message.from_bytes(data)
+                # A view into the connection's read buffer, reused once we ask for the next frame
+                data = await reader.read_frame()
+                # Any frame counts as activity, not only heartbeats
+                self.idle_timer.touch(client_id)
                 
                 # Record metrics
                 self.performance_monitor.record_message(len(data))
                 
+                if data[0] == FILE_STREAM_MAGIC:
+                    # Raw file chunk: relayed as opaque bytes, never decoded, in
+                    # order behind the sender's other frames. It may wait on slow
+                    # receivers, so it runs in the background rather than holding
+                    # a worker; a sender with too many chunks waiting is not read
+                    # until one is relayed
+                    await stream_credits.acquire()
+                    await self.qos_manager.enqueue(
+                        self._handle_file_stream,
+                        client_id,
+                        FRAME_HEADER.pack(len(data)) + data,
+                        writer,
+                        stream_credits,
+                        priority=Priority.LOW,
+                        key=self._ordering_key(client_id),
+                        background=True
+                    )
+                    continue
+                
+                message = Message.from_bytes(data)
+                if self.tracer:
+                    message.received = time.monotonic_ns()
+                
                 # Process message with QoS
                 await self.qos_manager.enqueue(
                     self._process_message,
                     client_id,
                     message,
                     writer,
-                    priority=message.priority
+                    priority=message.priority,
+                    key=self._ordering_key(client_id),
+                    # Password hashing waits on the bcrypt executor and fetches wait on
+                    # the receiver's queue; keep them off the workers
+                    background=message.type in (
+                        MessageType.AUTH_REQUEST, MessageType.REGISTER_REQUEST, MessageType.FILE_FETCH
+                    )
                 )
                 
             except asyncio.IncompleteReadError:
@@ -104,47 +236,80 @@ class ChatServer:
                 self.logger.error(f"Error reading from client {client_id}: {e}")
                 break
     
+    def _ordering_key(self, client_id):
+        if self.ordering == 'room':
+            client_info = self.clients.get(client_id)
+            if client_info and client_info['room_id']:
+                return client_info['room_id']
+        return client_id
+    
     async def _process_message(self, client_id, message, writer):
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
         
         handlers = {
             MessageType.AUTH_REQUEST: self._handle_auth,
             MessageType.REGISTER_REQUEST: self._handle_register,
+            MessageType.RESUME_REQUEST: self._handle_resume,
+            MessageType.LOGOUT: self._handle_logout,
             MessageType.CREATE_ROOM: self._handle_create_room,
             MessageType.JOIN_ROOM: self._handle_join_room,
             MessageType.LEAVE_ROOM: self._handle_leave_room,
             MessageType.LIST_ROOMS: self._handle_list_rooms,
             MessageType.TEXT_MESSAGE: self._handle_text_message,
             MessageType.FILE_TRANSFER: self._handle_file_transfer,
+            MessageType.FILE_FETCH: self._handle_file_fetch,
+            MessageType.HISTORY: self._handle_history,
             MessageType.USER_LIST: self._handle_user_list,
             MessageType.HEARTBEAT: self._handle_heartbeat,
+            MessageType.SERVER_INFO: self._handle_server_info,
+            MessageType.TRACE_RECEIPT: self._handle_trace_receipt,
         }
         
         handler = handlers.get(message.type)
         if handler:
-            await handler(client_id, message, writer)
+            if self.watchdog:
+                coro = handler(client_id, message, writer)
+                self.watchdog.begin(coro, message.type, start_time)
+                try:
+                    await coro
+                finally:
+                    self.watchdog.end(coro)
+            else:
+                await handler(client_id, message, writer)
         
         # Record processing time
-        processing_time = time.time() - start_time
-        self.performance_monitor.record_processing_time(processing_time)
+        processing_time = time.perf_counter_ns() - start_time
+        self.performance_monitor.record_handled(message.type, message.priority, processing_time)
     
     async def _handle_auth(self, client_id, message, writer):
         username = message.data.get('username')
         password = message.data.get('password')
         
-        success, user_data = self.user_manager.authenticate(username, password)
+        success, user_data = await self.user_manager.authenticate_async(username, password)
+        
+        if success and self.bus:
+            # The user may be logged in on another worker
+            session_id = self.user_manager.get_session_id(username)
+            if not await self.bus.claim_session(username, client_id, session_id):
+                self.user_manager.drop_session(username)
+                success = False
         
         if success:
             self.clients[client_id] = {
                 'writer': writer,
                 'user': user_data,
-                'room_id': None,
-                'last_heartbeat': time.time()
+                'room_id': None
             }
+            self.user_connections[username] = client_id
             
             response = Message(
                 MessageType.AUTH_RESPONSE,
-                {'success': True, 'user_id': user_data['id'], 'username': username}
+                {
+                    'success': True,
+                    'user_id': user_data['id'],
+                    'username': username,
+                    'resume_token': self.user_manager.issue_resume_token(username)
+                }
             )
             self.logger.info(f"User {username} authenticated")
         else:
@@ -155,11 +320,87 @@ class ChatServer:
         
         await self._send_message(writer, response)
     
+    async def _handle_resume(self, client_id, message, writer):
+        payload = self.user_manager.check_resume_token(message.data.get('token'))
+        if payload is None or client_id in self.clients:
+            await self._send_message(writer, Message(
+                MessageType.RESUME_RESPONSE,
+                {'success': False, 'error': 'Invalid or expired session'}
+            ))
+            return
+        
+        # The old connection may not have noticed the network blip yet. Torn down
+        # at once: flushing what it still has queued could take seconds
+        username = payload['user']
+        stale_client = self.user_connections.get(username)
+        if stale_client is not None and stale_client != client_id:
+            self.clients[stale_client]['writer'].abort()
+            await self._disconnect_client(stale_client)
+        
+        success, user_data = self.user_manager.resume_session(payload)
+        if success and self.bus:
+            # Takes the session over from whichever worker holds it, unless a new login replaced it
+            success = await self.bus.claim_session(
+                username, client_id, payload['sid'], takeover=True,
+                new_session_id=self.user_manager.get_session_id(username)
+            )
+            if not success:
+                self.user_manager.drop_session(username)
+        if not success:
+            await self._send_message(writer, Message(
+                MessageType.RESUME_RESPONSE,
+                {'success': False, 'error': 'Session superseded'}
+            ))
+            return
+        
+        self.clients[client_id] = {
+            'writer': writer,
+            'user': user_data,
+            'room_id': None
+        }
+        self.user_connections[username] = client_id
+        
+        # Rejoin the room the client was in, if it still exists
+        room_id = message.data.get('room_id')
+        if room_id and self._join_room(room_id, client_id, username):
+            self.clients[client_id]['room_id'] = room_id
+            await self._broadcast_to_room(
+                room_id,
+                Message(
+                    MessageType.USER_LIST,
+                    {'action': 'join', 'username': username},
+                    room_id=room_id
+                ),
+                exclude_client=client_id
+            )
+        else:
+            room_id = None
+        
+        await self._send_message(writer, Message(
+            MessageType.RESUME_RESPONSE,
+            {
+                'success': True,
+                'user_id': user_data['id'],
+                'username': username,
+                'room_id': room_id,
+                'resume_token': self.user_manager.issue_resume_token(username)
+            }
+        ))
+        if room_id:
+            # Catch up on what was said while the connection was down
+            await self._replay_history(writer, room_id, since=message.data.get('last_message_id'))
+        self.logger.info(f"User {username} resumed session")
+    
+    async def _handle_logout(self, client_id, message, writer):
+        # Unlike a dropped connection, this ends the session: its resume token is spent
+        if client_id in self.clients:
+            await self._disconnect_client(client_id, logged_out=True)
+    
     async def _handle_register(self, client_id, message, writer):
         username = message.data.get('username')
         password = message.data.get('password')
         
-        success, user_data = self.user_manager.register(username, password)
+        success, user_data = await self.user_manager.register_async(username, password)
         
         if success:
             response = Message(
@@ -181,6 +422,8 @@ class ChatServer:
         
         room_name = message.data.get('name')
         room_id = self.room_manager.create_room(room_name)
+        if self.bus:
+            self.bus.announce('room_created', room_id=room_id, **self.room_manager.get_room(room_id))
         
         response = Message(
             MessageType.SUCCESS,
@@ -197,7 +440,12 @@ class ChatServer:
         room_id = message.data.get('room_id')
         user_info = self.clients[client_id]['user']
         
-        if self.room_manager.join_room(room_id, user_info['username']):
+        # A connection is in at most one room; switching rooms leaves the old one
+        current_room = self.clients[client_id]['room_id']
+        if current_room and current_room != room_id and self.room_manager.room_exists(room_id):
+            await self._leave_current_room(client_id)
+        
+        if self._join_room(room_id, client_id, user_info['username']):
             self.clients[client_id]['room_id'] = room_id
             
             # Notify other users in room
@@ -215,17 +463,78 @@ class ChatServer:
                 MessageType.SUCCESS,
                 {'room_id': room_id}
             )
+            await self._send_message(writer, response)
+            await self._replay_history(writer, room_id)
         else:
             response = Message(
                 MessageType.ERROR,
                 {'error': 'Failed to join room'}
             )
+            await self._send_message(writer, response)
+    
+    def _join_room(self, room_id, client_id, username):
+        if not self.room_manager.join_room(room_id, client_id, username):
+            return False
+        if self.bus:
+            # Carries the room itself, in case a worker has not heard of it yet
+            self.bus.announce(
+                'member_joined',
+                room_id=room_id,
+                client_id=client_id,
+                username=username,
+                **self.room_manager.get_room(room_id)
+            )
+        return True
+    
+    async def _handle_leave_room(self, client_id, message, writer):
+        if client_id not in self.clients:
+            return
+        
+        room_id = await self._leave_current_room(client_id)
+        if room_id:
+            response = Message(
+                MessageType.SUCCESS,
+                {'left_room': room_id}
+            )
+        else:
+            response = Message(
+                MessageType.ERROR,
+                {'error': 'Not in a room'}
+            )
         
         await self._send_message(writer, response)
     
-    async def _handle_leave_room(self, client_id, message, writer):
-        # Implementation for leaving room
-        pass
+    def _leave_room(self, room_id, client_id):
+        self.room_manager.leave_room(room_id, client_id)
+        # The last member out deletes the room, and with it the room's latency
+        # figures and the files shared there
+        if not self.room_manager.room_exists(room_id):
+            self.shared_files.pop(room_id, None)
+            if self.tracer:
+                self.tracer.forget_room(room_id)
+    
+    async def _leave_current_room(self, client_id):
+        client_info = self.clients[client_id]
+        room_id = client_info['room_id']
+        if not room_id:
+            return None
+        
+        username = client_info['user']['username']
+        self._leave_room(room_id, client_id)
+        client_info['room_id'] = None
+        if self.bus:
+            self.bus.announce('member_left', room_id=room_id, client_id=client_id)
+        
+        # Notify others
+        await self._broadcast_to_room(
+            room_id,
+            Message(
+                MessageType.USER_LIST,
+                {'action': 'leave', 'username': username},
+                room_id=room_id
+            )
+        )
+        return room_id
     
     async def _handle_text_message(self, client_id, message, writer):
         if client_id not in self.clients:
@@ -251,8 +560,119 @@ class ChatServer:
             },
             room_id=room_id
         )
+        trace = message.data.get('trace') if self.tracer and message.received else None
+        if trace is not None:
+            handled = time.monotonic_ns()
+            trace = self.tracer.begin(client_id, trace, message.received, handled)
+            if trace:
+                broadcast_msg.data['trace'] = trace
+        
+        # With a bus, numbered by the broker or by the node owning the room, and delivered from there
+        if not (self.bus and self.bus.publish(room_id, broadcast_msg.data, client_id)):
+            broadcast_msg.id = self.room_manager.next_message_id(room_id)
+            await self._deliver_room_message(broadcast_msg, client_id)
+        if trace:
+            self.tracer.delivered(handled, time.monotonic_ns())
+    
+    async def _deliver_room_message(self, message, exclude_client):
+        room_id = message.room_id
+        frames = await self._broadcast_to_room(
+            room_id,
+            message,
+            exclude_client=exclude_client,
+            local_only=self.bus is not None and self.bus.delivers_room_messages
+        )
+        if 'trace' in message.data:
+            if self.tracer:
+                self.tracer.expect(room_id, message.data['trace'], exclude_client)
+            # Stored without it: a replayed message must not be taken for a live delivery
+            message.data = {key: value for key, value in message.data.items() if key != 'trace'}
+            frames = {codec: message.to_bytes(codec) for codec in frames}
+        if not frames:
+            frames[CODEC_JSON] = message.to_bytes(CODEC_JSON)
+        self.room_manager.add_history(room_id, message.id, frames)
+        if self._writes_room_log(room_id):
+            # Any codec will do for the log: replay re-encodes it for peers speaking the other
+            self.message_log.append(room_id, message.id, next(iter(frames.values())))
+    
+    def _writes_room_log(self, room_id):
+        return self.bus is None or self.bus.writes_room_log(room_id)
+    
+    async def _handle_history(self, client_id, message, writer):
+        if client_id not in self.clients:
+            return
+        
+        room_id = self.clients[client_id]['room_id']
+        if not room_id:
+            await self._send_message(writer, Message(
+                MessageType.ERROR,
+                {'error': 'Not in a room'}
+            ))
+            return
+        
+        # A page is at most what a room keeps in memory; older pages come from the log
+        since = message.data.get('since')
+        limit = self._whole_number(message.data.get('limit', self.history_on_join))
+        if since is not None:
+            since = self._whole_number(since)
+        if since is False or limit is False:
+            await self._send_message(writer, Message(
+                MessageType.ERROR,
+                {'error': 'Invalid history request: since and limit must be non-negative integers'}
+            ))
+            return
+        limit = min(limit, self.room_manager.history_messages)
+        await self._replay_history(writer, room_id, since=since, limit=limit)
+    
+    def _whole_number(self, value):
+        """value as a non-negative int, or False. Message ids travel as f64 in
+        binary frame headers, so a client may well ask for 5.0; it means 5"""
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if type(value) is not int or value < 0:
+            return False
+        return value
+    
+    async def _replay_history(self, writer, room_id, since=None, limit=None):
+        """Send stored frames as a single write, then a HISTORY summary for paging"""
+        if limit is None:
+            limit = self.history_on_join
+        if self.bus and not self.bus.owns(room_id):
+            # Kept by the node that owns the room
+            frames, first_id, last_id, more = await self.bus.fetch_history(room_id, writer.codec, since, limit)
+        else:
+            frames, first_id, last_id, more = await self._load_history(room_id, writer.codec, since, limit)
+        if frames:
+            self._send_frame(writer, b''.join(frames))
         
-        await self._broadcast_to_room(room_id, broadcast_msg, exclude_client=client_id)
+        await self._send_message(writer, Message(
+            MessageType.HISTORY,
+            {'count': len(frames), 'first_id': first_id, 'last_id': last_id, 'more': more},
+            room_id=room_id
+        ))
+    
+    async def _load_history(self, room_id, codec, since, limit):
+        history = self.room_manager.get_history(room_id, codec, since, limit)
+        if history is not None:
+            return history
+        
+        # Older than what is kept in memory: read the durable log off the loop
+        loop = asyncio.get_running_loop()
+        records = await loop.run_in_executor(None, self._read_room_log, room_id, codec, since, limit)
+        frames = [frame for _, frame in records]
+        first_id = records[0][0] if records else None
+        last_id = records[-1][0] if records else None
+        return frames, first_id, last_id, len(records) == limit
+    
+    def _read_room_log(self, room_id, codec, since, limit):
+        """Logged (message id, frame) in the reader's codec; runs in an executor"""
+        records = self.message_log.read(room_id, since, limit)
+        binary = codec == CODEC_BINARY
+        return [
+            (message_id, frame if (frame[4] == BINARY_MAGIC) == binary
+             else Message.from_bytes(frame[4:]).to_bytes(codec))
+            for message_id, frame in records
+        ]
     
     async def _handle_list_rooms(self, client_id, message, writer):
         rooms = self.room_manager.list_rooms()
@@ -276,7 +696,6 @@ class ChatServer:
             await self._send_message(writer, response)
     
     async def _handle_file_transfer(self, client_id, message, writer):
-        # Implementation for file transfer
         if client_id not in self.clients:
             return
         
@@ -291,111 +710,695 @@ class ChatServer:
             await self._send_message(writer, error_msg)
             return
         
-        # Broadcast file chunk to room
-        file_msg = Message(
+        if 'data' in message.data:
+            transfer_id = message.data['transfer_id']
+            if (client_id, transfer_id) in self.file_transfers:
+                # Chunk of an announced upload from a peer using the JSON codec
+                data = message.data['data']
+                if isinstance(data, str):
+                    data = base64.b64decode(data)
+                await self._accept_file_chunk(client_id, transfer_id, message.data['chunk_num'], data, None, writer)
+                return
+            
+            # Chunk from a client that predates manifests: relay it as a FILE_CHUNK
+            file_msg = Message(
+                MessageType.FILE_CHUNK,
+                message.data,
+                priority=Priority.LOW,
+                room_id=room_id
+            )
+            await self._deliver_file_chunk(self._other_members(room_id, client_id), {}, file_msg)
+            await self._send_file_ack(writer, transfer_id, message.data['chunk_num'])
+            return
+        
+        # Manifest announcing a file; it must hash to the id it claims. A chunk,
+        # base64-encoded for JSON members, must fit well within a member's
+        # LOW priority queue, or relaying it could never wait for room
+        chunk_hashes = message.data.get('chunk_hashes') or []
+        chunk_size = message.data.get('chunk_size')
+        if type(chunk_size) is not int or not 0 < chunk_size <= self.slow_consumer_policy.low_priority_limit // 4:
+            await self._send_message(writer, Message(
+                MessageType.ERROR,
+                {'error': f"Invalid file manifest: chunk size must be 1 to "
+                          f"{self.slow_consumer_policy.low_priority_limit // 4} bytes"}
+            ))
+            return
+        if self._uploads_in_progress(client_id) >= self.max_transfers_per_client:
+            self._expire_stalled_transfers()
+            if self._uploads_in_progress(client_id) >= self.max_transfers_per_client:
+                await self._send_message(writer, Message(
+                    MessageType.ERROR,
+                    {'error': f"Too many file uploads in progress (at most {self.max_transfers_per_client})"}
+                ))
+                return
+        blob = build_manifest_blob(message.data['size'], chunk_size, chunk_hashes)
+        file_hash = message.data.get('file_hash')
+        if (not chunk_hashes or not isinstance(file_hash, str)
+                or message.data['transfer_id'] != transfer_id_for(file_hash)
+                or not await self._store_blob(file_hash, blob)):
+            await self._send_message(writer, Message(
+                MessageType.ERROR,
+                {'error': 'Invalid file manifest'}
+            ))
+            return
+        
+        transfer = {
+            'transfer_id': message.data['transfer_id'],
+            'file_hash': file_hash,
+            'filename': message.data['filename'],
+            'size': message.data['size'],
+            'chunk_size': message.data['chunk_size'],
+            'total_chunks': len(chunk_hashes),
+            'chunk_hashes': chunk_hashes,
+            'username': client_info['user']['username']
+        }
+        self._share_file(room_id, file_hash)
+        await self._broadcast_to_room(
+            room_id,
+            Message(MessageType.FILE_TRANSFER, transfer, priority=Priority.LOW, room_id=room_id),
+            exclude_client=client_id
+        )
+        
+        # Only chunks the content store lacks are uploaded; the rest are served from it
+        missing = [
+            chunk_num for chunk_num, chunk_hash in enumerate(chunk_hashes)
+            if not self.content_store.has(chunk_hash)
+        ]
+        if missing:
+            self.file_transfers[(client_id, transfer['transfer_id'])] = dict(
+                transfer, room_id=room_id, pending=set(missing), last_active=time.monotonic()
+            )
+        await self._send_message(writer, Message(
+            MessageType.FILE_NEED,
+            {'transfer_id': transfer['transfer_id'], 'chunks': missing}
+        ))
+        
+        cached = sorted(set(range(len(chunk_hashes))) - set(missing))
+        if cached:
+            await self.qos_manager.enqueue(
+                self._serve_cached_chunks,
+                dict(transfer, room_id=room_id),
+                cached,
+                self._other_members(room_id, client_id),
+                priority=Priority.LOW,
+                background=True
+            )
+    
+    async def _handle_file_stream(self, client_id, frame, writer, credits):
+        try:
+            transfer_id, chunk_num, payload = unpack_file_chunk(memoryview(frame)[4:])
+            await self._accept_file_chunk(client_id, transfer_id, chunk_num, payload, frame, writer)
+        finally:
+            credits.release()
+    
+    async def _accept_file_chunk(self, client_id, transfer_id, chunk_num, payload, frame, writer):
+        key = (client_id, transfer_id)
+        transfer = self.file_transfers.get(key)
+        if transfer is None or chunk_num not in transfer['pending']:
+            return
+        # Claimed before the hash check yields, so a repeated chunk is not relayed twice
+        transfer['pending'].discard(chunk_num)
+        transfer['last_active'] = time.monotonic()
+        
+        # Chunks are checked against the manifest before anyone sees them
+        if not await self._store_blob(transfer['chunk_hashes'][chunk_num], payload):
+            # The sender has moved on to the next chunk, so the upload can never complete
+            if self.file_transfers.get(key) is transfer:
+                del self.file_transfers[key]
+            await self._send_message(writer, Message(
+                MessageType.ERROR,
+                {'error': f"Chunk {chunk_num} of {transfer['filename']} does not match its manifest; "
+                          f"upload abandoned"}
+            ))
+        else:
+            # Binary peers get the sender's frame as is; JSON peers get the chunk
+            # base64-encoded inside a FILE_CHUNK message
+            await self._deliver_file_chunk(
+                self._other_members(transfer['room_id'], client_id),
+                {CODEC_BINARY: frame or pack_file_chunk(transfer_id, chunk_num, payload)},
+                self._file_chunk_message(transfer, chunk_num, payload)
+            )
+            if not transfer['pending'] and self.file_transfers.get(key) is transfer:
+                del self.file_transfers[key]
+        await self._send_file_ack(writer, transfer_id, chunk_num)
+    
+    def _uploads_in_progress(self, client_id):
+        return sum(1 for sender, _ in self.file_transfers if sender == client_id)
+    
+    def _expire_stalled_transfers(self):
+        cutoff = time.monotonic() - self.file_transfer_timeout
+        for key, transfer in list(self.file_transfers.items()):
+            if transfer['last_active'] < cutoff:
+                del self.file_transfers[key]
+                self.logger.info(f"Upload {transfer['transfer_id']} from {key[0]} stalled, forgotten")
+    
+    async def expire_stalled_transfers(self):
+        """Forget uploads that have gone file_transfer_timeout seconds without a chunk"""
+        while True:
+            await asyncio.sleep(self.file_transfer_timeout / 4)
+            self._expire_stalled_transfers()
+    
+    def _share_file(self, room_id, file_hash):
+        files = self.shared_files.setdefault(room_id, {})
+        files.pop(file_hash, None)
+        files[file_hash] = None
+        if len(files) > self.max_shared_files:
+            del files[next(iter(files))]
+    
+    async def _store_blob(self, blob_hash, data):
+        # Hashing and the disk write stay off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.content_store.put, blob_hash, data)
+    
+    async def _load_blob(self, blob_hash):
+        return await asyncio.get_running_loop().run_in_executor(None, self.content_store.get, blob_hash)
+    
+    async def _handle_file_fetch(self, client_id, message, writer):
+        if client_id not in self.clients:
+            return
+        
+        # Members of a room the file was shared in may fetch chunks of it, e.g.
+        # to finish a transfer that was interrupted by a disconnect
+        file_hash = message.data.get('file_hash')
+        shared = self.shared_files.get(self.clients[client_id]['room_id'], {})
+        blob = await self._load_blob(file_hash) if isinstance(file_hash, str) and file_hash in shared else None
+        if blob is None:
+            await self._send_message(writer, Message(
+                MessageType.ERROR,
+                {'error': 'File is no longer available'}
+            ))
+            return
+        
+        size, chunk_size, chunk_hashes = parse_manifest_blob(blob)
+        transfer = {
+            'transfer_id': transfer_id_for(file_hash),
+            'filename': message.data.get('filename', file_hash),
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': len(chunk_hashes),
+            'chunk_hashes': chunk_hashes,
+            'room_id': None
+        }
+        chunks = [n for n in message.data.get('chunks', []) if type(n) is int and 0 <= n < len(chunk_hashes)]
+        await self._serve_cached_chunks(transfer, chunks, [client_id])
+    
+    async def _serve_cached_chunks(self, transfer, chunk_nums, member_ids):
+        for chunk_num in chunk_nums:
+            data = await self._load_blob(transfer['chunk_hashes'][chunk_num])
+            if data is None:
+                continue  # evicted, or still being uploaded; the receiver asks again later
+            await self._deliver_file_chunk(
+                member_ids,
+                {CODEC_BINARY: pack_file_chunk(transfer['transfer_id'], chunk_num, data)},
+                self._file_chunk_message(transfer, chunk_num, data)
+            )
+    
+    def _other_members(self, room_id, client_id):
+        return [member for member in self.room_manager.get_room_members(room_id) if member != client_id]
+    
+    def _file_chunk_message(self, transfer, chunk_num, data):
+        # Only encoded if a member speaks JSON
+        return Message(
             MessageType.FILE_CHUNK,
-            message.data,
+            {
+                'transfer_id': transfer['transfer_id'],
+                'filename': transfer['filename'],
+                'size': transfer['size'],
+                'chunk_size': transfer['chunk_size'],
+                'chunk_num': chunk_num,
+                'total_chunks': transfer['total_chunks'],
+                'data': data
+            },
             priority=Priority.LOW,
-            room_id=room_id
+            room_id=transfer['room_id']
         )
+    
+    async def _deliver_file_chunk(self, member_ids, frames, file_msg):
+        """Queue a file chunk on each member. Members with room get it at once;
+        slow members are waited for together, each up to file_relay_timeout,
+        rather than having the chunk dropped from their queue"""
+        limit = self.slow_consumer_policy.low_priority_limit
+        remote = False
+        waits = []
+        for member in member_ids:
+            client_info = self.clients.get(member)
+            if not client_info:
+                remote = True
+                continue
+            
+            connection = client_info['writer']
+            frame = frames.get(connection.codec)
+            if frame is None:
+                frame = frames[connection.codec] = file_msg.to_bytes(connection.codec)
+            if connection.queued_bytes <= limit - len(frame):
+                self._send_frame(connection, frame, Priority.LOW)
+            elif len(frame) < limit:
+                waits.append(self._relay_when_below(connection, frame, limit - len(frame)))
+        if waits:
+            await asyncio.gather(*waits)
         
-        await self._broadcast_to_room(room_id, file_msg, exclude_client=client_id)
+        if remote and self.bus and file_msg.room_id:
+            # Members on other workers: no flow control across the bus, so a
+            # chunk dropped there is fetched again from the shared content store
+            self._forward_frames(file_msg.room_id, frames, file_msg, None)
+    
+    async def _relay_when_below(self, connection, frame, limit):
+        try:
+            await asyncio.wait_for(connection.wait_below(limit), self.file_relay_timeout)
+        except asyncio.TimeoutError:
+            # A laggard: it goes without the chunk and fetches it again from
+            # the content store once its transfer stalls
+            return
+        self._send_frame(connection, frame, Priority.LOW)
+    
+    async def _send_file_ack(self, writer, transfer_id, chunk_num):
+        # Each ack returns one credit to the sender's window
+        await self._send_message(writer, Message(
+            MessageType.FILE_ACK,
+            {'transfer_id': transfer_id, 'chunk_num': chunk_num}
+        ))
     
     async def _handle_heartbeat(self, client_id, message, writer):
-        if client_id in self.clients:
-            self.clients[client_id]['last_heartbeat'] = time.time()
-        
         response = Message(MessageType.HEARTBEAT)
         await self._send_message(writer, response)
     
-    async def _broadcast_to_room(self, room_id, message, exclude_client=None):
-        tasks = []
-        for client_id, client_info in self.clients.items():
-            if client_info['room_id'] == room_id and client_id != exclude_client:
-                tasks.append(
-                    self._send_message(client_info['writer'], message)
+    async def _handle_trace_receipt(self, client_id, message, writer):
+        # Counted for the room the member is in, whatever room id the receipt claims
+        client_info = self.clients.get(client_id)
+        if self.tracer and client_info and client_info['room_id'] and message.received:
+            self.tracer.receipt(client_id, client_info['room_id'], message.data, message.received)
+    
+    async def _handle_server_info(self, client_id, message, writer):
+        # Codec negotiation: pick the first codec we both support
+        offered = message.data.get('codecs', [])
+        codec = next((c for c in SUPPORTED_CODECS if c in offered), CODEC_JSON)
+        
+        response = Message(
+            MessageType.SERVER_INFO,
+            {
+                'codec': codec,
+                'codecs': SUPPORTED_CODECS,
+                'trace_sample_rate': self.tracer.sample_rate if self.tracer else 0
+            }
+        )
+        # The reply still goes out in JSON, which every peer can read
+        await self._send_message(writer, response)
+        writer.codec = codec
+    
+    async def _broadcast_to_room(self, room_id, message, exclude_client=None, local_only=False):
+        # Serialize once per codec; every recipient gets shared frame bytes
+        frames = {}
+        remote = False
+        
+        # Queue on each member's connection without waiting for any of them
+        for client_id in self.room_manager.get_room_members(room_id):
+            client_info = self.clients.get(client_id)
+            if client_info is None:
+                remote = True  # connected to another worker
+            elif client_id != exclude_client:
+                connection = client_info['writer']
+                frame = frames.get(connection.codec)
+                if frame is None:
+                    frame = frames[connection.codec] = message.to_bytes(connection.codec)
+                self._send_frame(connection, frame, message.priority)
+        
+        if remote and self.bus and not local_only:
+            self._forward_frames(room_id, frames, message, exclude_client)
+        return frames
+    
+    def _forward_frames(self, room_id, frames, message, exclude_client):
+        """Hand frames to the workers or nodes holding the room's other members"""
+        if CODEC_JSON not in frames:
+            # Every peer can read JSON, whatever codec its worker has frames for
+            frames[CODEC_JSON] = message.to_bytes(CODEC_JSON)
+        self.bus.forward(
+            self.room_manager.get_room_members(room_id),
+            room_id=room_id,
+            frames=frames,
+            priority=message.priority.value,
+            exclude=exclude_client,
+            # Lets every node follow the room's message ids, in case it takes the room over
+            message_id=message.id if message.type == MessageType.TEXT_MESSAGE else None,
+            # Lets the members' nodes serve the file to them again
+            file_hash=message.data.get('file_hash') if message.type == MessageType.FILE_TRANSFER else None,
+            # Lets the members' nodes take their receipts
+            trace=message.data.get('trace') if self.tracer else None
+        )
+    
+    def _on_bus_forward(self, frame):
+        if frame.get('message_id'):
+            self.room_manager.set_message_id(frame['room_id'], frame['message_id'])
+        if self.tracer and frame.get('trace'):
+            self.tracer.expect(frame['room_id'], frame['trace'], frame['exclude'])
+        if frame.get('file_hash'):
+            self._share_file(frame['room_id'], frame['file_hash'])
+        frames = frame['frames']
+        priority = Priority(frame['priority'])
+        for client_id in self.room_manager.get_room_members(frame['room_id']):
+            client_info = self.clients.get(client_id)
+            if client_info and client_id != frame['exclude']:
+                connection = client_info['writer']
+                self._send_frame(connection, frames.get(connection.codec) or frames[CODEC_JSON], priority)
+    
+    async def _on_bus_room_message(self, frame):
+        room_id = frame['room_id']
+        message = Message(MessageType.TEXT_MESSAGE, frame['message'], room_id=room_id)
+        message.id = frame['message_id']
+        self.room_manager.set_message_id(room_id, message.id)
+        await self._deliver_room_message(message, frame['exclude'])
+    
+    def _on_bus_snapshot(self, frame):
+        for room_id, room in frame['rooms'].items():
+            self._on_bus_room_created(dict(room, room_id=room_id))
+            for client_id, (_, username) in room['members'].items():
+                self.room_manager.join_room(room_id, client_id, username)
+            self.room_manager.set_message_id(room_id, room['message_count'])
+    
+    def _on_bus_room_created(self, frame):
+        self.room_manager.create_room(
+            frame['name'],
+            room_id=frame['room_id'],
+            created=datetime.fromisoformat(frame['created'])
+        )
+    
+    def _on_bus_member_joined(self, frame):
+        self._on_bus_room_created(frame)
+        self.room_manager.join_room(frame['room_id'], frame['client_id'], frame['username'])
+    
+    def _on_bus_member_left(self, frame):
+        self._leave_room(frame['room_id'], frame['client_id'])
+    
+    async def _on_bus_publish(self, frame):
+        # Sent to us as the room's owner, which numbers its messages
+        room_id = frame['room_id']
+        message = Message(MessageType.TEXT_MESSAGE, frame['message'], room_id=room_id)
+        message.id = self.room_manager.next_message_id(room_id)
+        if message.id is not None:
+            await self._deliver_room_message(message, frame['exclude'])
+    
+    async def _on_bus_history(self, frame):
+        frames, first_id, last_id, more = await self._load_history(
+            frame['room_id'], frame['codec'], frame['since'], frame['limit']
+        )
+        return {'frames': frames, 'first_id': first_id, 'last_id': last_id, 'more': more}
+    
+    def _on_bus_handoff(self, frame):
+        room_id = frame['room_id']
+        self.room_manager.set_message_id(room_id, frame['message_count'])
+        self.room_manager.import_history(room_id, frame['history'])
+        self.logger.info(f"Took over room {room_id} from node {frame['node']}")
+    
+    def _on_node_joined(self, node_id, previous_ring):
+        # Our own members are the part of the room table only we can tell the newcomer about
+        rooms = {}
+        for room_id in self.room_manager.room_ids():
+            room = self.room_manager.get_room(room_id)
+            room['members'] = {
+                client_id: [self.node_id, username]
+                for client_id, username in self.room_manager.get_members(room_id).items()
+                if client_id in self.clients
+            }
+            rooms[room_id] = room
+        self.bus.send(node_id, 'snapshot', rooms=rooms)
+        
+        # Only rooms whose ring position now falls to the newcomer move, with their history
+        moved = 0
+        for room_id, room in rooms.items():
+            if previous_ring.owner(room_id) == self.node_id and self.bus.owner(room_id) == node_id:
+                self.bus.send(
+                    node_id,
+                    'handoff',
+                    room_id=room_id,
+                    message_count=room['message_count'],
+                    history=self.room_manager.get_history_entries(room_id)
+                )
+                moved += 1
+        self.bus.stats['handoffs'] += moved
+        self.logger.info(f"Node {node_id} joined: handed off {moved} of {len(rooms)} rooms")
+    
+    async def _on_node_left(self, node_id, previous_ring, lost_members):
+        for client_id, room_id in lost_members:
+            username = self.room_manager.get_members(room_id).get(client_id)
+            self._leave_room(room_id, client_id)
+            if username:
+                await self._broadcast_to_room(
+                    room_id,
+                    Message(
+                        MessageType.USER_LIST,
+                        {'action': 'leave', 'username': username},
+                        room_id=room_id
+                    ),
+                    local_only=True
                 )
         
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        taken = [
+            room_id for room_id in self.room_manager.room_ids()
+            if previous_ring.owner(room_id) == node_id and self.bus.owns(room_id)
+        ]
+        self.logger.warning(
+            f"Node {node_id} left: {len(lost_members)} members gone, took over {len(taken)} rooms"
+        )
+    
+    def _on_bus_revoke(self, frame):
+        # The session was resumed on another worker or node
+        if self.user_connections.get(frame['username']) == frame['client_id']:
+            asyncio.create_task(self._disconnect_client(frame['client_id']))
     
     async def _send_message(self, writer, message):
+        self._send_frame(writer, message.to_bytes(writer.codec), message.priority)
+    
+    def _send_frame(self, connection, frame, priority=Priority.NORMAL):
         try:
-            writer.write(message.to_bytes())
-            await writer.drain()
+            connection.send(frame, priority)
         except Exception as e:
             self.logger.error(f"Error sending message: {e}")
     
-    async def _disconnect_client(self, client_id):
+    async def _disconnect_client(self, client_id, logged_out=False):
         if client_id in self.clients:
             client_info = self.clients[client_id]
-            room_id = client_info['room_id']
             username = client_info['user']['username']
             
-            # Logout user
-            self.user_manager.logout(username)
-            
             # Remove from room
-            if room_id:
-                self.room_manager.leave_room(room_id, username)
-                
-                # Notify others
-                await self._broadcast_to_room(
-                    room_id,
-                    Message(
-                        MessageType.USER_LIST,
-                        {'action': 'leave', 'username': username},
-                        room_id=room_id
-                    )
-                )
+            await self._leave_current_room(client_id)
+            del self.clients[client_id]
+            
+            # Forget transfers this client was still sending
+            for sender, transfer_id in list(self.file_transfers):
+                if sender == client_id:
+                    del self.file_transfers[(sender, transfer_id)]
+            
+            # End the session, unless a resumed connection already took it over. A
+            # dropped connection leaves it to the client's resume token
+            if self.user_connections.get(username) == client_id:
+                del self.user_connections[username]
+                if logged_out:
+                    self.user_manager.logout(username)
+                else:
+                    self.user_manager.detach(username)
+                if self.bus:
+                    self.bus.release_session(username, client_id, ended=logged_out)
             
             # Close connection
             try:
-                client_info['writer'].close()
-                await client_info['writer'].wait_closed()
+                await client_info['writer'].close()
             except:
                 pass
             
-            del self.clients[client_id]
             self.performance_monitor.record_disconnection()
             self.logger.info(f"Client {client_id} disconnected")
     
-    async def cleanup_inactive_clients(self):
-        """Remove inactive clients (no heartbeat for 60 seconds)"""
+    async def expire_idle_clients(self):
+        """Drop connections that have sent nothing for the idle timeout"""
         while True:
-            await asyncio.sleep(30)
-            current_time = time.time()
-            
-            inactive_clients = [
-                client_id for client_id, info in self.clients.items()
-                if current_time - info.get('last_heartbeat', current_time) > 60
-            ]
-            
-            for client_id in inactive_clients:
+            await asyncio.sleep(self.idle_timer.precision)
+            for client_id, connection in self.idle_timer.expire():
                 self.logger.info(f"Removing inactive client: {client_id}")
-                await self._disconnect_client(client_id)
+                # Each connection's own task sees the reset and cleans up, so
+                # the disconnects run side by side instead of one after another
+                connection.abort()
+    
+    def _metric_families(self):
+        """Server-side gauges for the metrics endpoint; O(priorities + rooms)"""
+        qos = self.qos_manager.get_stats()
+        queue_depth = MetricFamily('chat_qos_queue_depth', 'gauge', 'Messages waiting for a QoS worker, by priority')
+        for priority, depth in qos['queue_depths'].items():
+            queue_depth.add(depth, priority=priority)
+        
+        room_members = MetricFamily('chat_room_members', 'gauge', 'Members of each room on this server')
+        room_messages = MetricFamily('chat_room_messages_total', 'counter', 'Messages sent to each room')
+        for room_id, name, members, messages in self.room_manager.get_room_counts():
+            room_members.add(members, room=room_id, name=name)
+            room_messages.add(messages, room=room_id, name=name)
+        
+        return [
+            queue_depth,
+            MetricFamily('chat_qos_backlog', 'gauge', 'Messages accepted by QoS and not yet finished', qos['backlog']),
+            MetricFamily('chat_qos_running', 'gauge', 'Messages being handled by QoS workers', qos['running']),
+            MetricFamily('chat_active_transfers', 'gauge', 'File uploads in progress', len(self.file_transfers)),
+            MetricFamily('chat_authenticated_clients', 'gauge', 'Connections logged in as a user', len(self.clients)),
+            room_members,
+            room_messages,
+            MetricFamily('chat_event_loop_lag_seconds', 'histogram',
+                         'How late the event loop ran a timer', self.loop_probe.lag),
+            MetricFamily('chat_event_loop_lag_last_seconds', 'gauge',
+                         'Event loop lag at the latest probe', self.loop_probe.last_lag)
+        ] + self._slow_handler_families()
+    
+    def _slow_handler_families(self):
+        if not self.watchdog:
+            return []
+        slow = MetricFamily('chat_slow_handlers_total', 'counter',
+                            'Handlers seen blocking the event loop past the slow handler threshold')
+        for (handler, message_type), count in self.watchdog.counts.copy().items():  # the watchdog thread adds to it
+            slow.add(count, handler=handler or 'none', type=message_type or 'none')
+        waiting = MetricFamily('chat_long_waiting_handlers_total', 'counter',
+                               'Handlers seen suspended past the wait threshold, the loop left free')
+        for (handler, message_type), count in self.watchdog.waits.copy().items():
+            waiting.add(count, handler=handler, type=message_type)
+        return [slow, waiting]
     
     async def start(self):
-        server = await asyncio.start_server(
-            self.handle_client,
+        if self.bus_path:
+            self.bus = RoomBus(self.bus_path, self.worker_id, self.num_workers, {
+                'snapshot': self._on_bus_snapshot,
+                'room_created': self._on_bus_room_created,
+                'member_joined': self._on_bus_member_joined,
+                'member_left': self._on_bus_member_left,
+                'forward': self._on_bus_forward,
+                'room_message': self._on_bus_room_message,
+                'revoke': self._on_bus_revoke
+            })
+            await self.bus.connect()
+            self.performance_monitor.register_stats_source('room_bus', self.bus.get_stats)
+        elif self.cluster_nodes:
+            # Nodes authenticate each other with the shared certificate, and with
+            # the key that signs resume tokens
+            self.bus = Cluster(self.node_id, self.cluster_nodes, {
+                'snapshot': self._on_bus_snapshot,
+                'room_created': self._on_bus_room_created,
+                'member_joined': self._on_bus_member_joined,
+                'member_left': self._on_bus_member_left,
+                'forward': self._on_bus_forward,
+                'publish': self._on_bus_publish,
+                'history': self._on_bus_history,
+                'handoff': self._on_bus_handoff,
+                'revoke': self._on_bus_revoke,
+                'node_joined': self._on_node_joined,
+                'node_left': self._on_node_left
+            }, load_token_key(self.user_manager.token_key_file),
+                ssl_contexts=self._create_cluster_ssl_contexts())
+            await self.bus.start()
+            self.performance_monitor.register_stats_source('cluster', self.bus.get_stats)
+        if self.bus:
+            # Sessions move between processes; the bus's session table decides who may resume
+            self.user_manager.remember_ended_sessions = False
+        
+        server = await asyncio.get_running_loop().create_server(
+            lambda: FrameProtocol(self.handle_client, self.max_frame_size),
             self.host,
             self.port,
-            ssl=self.ssl_context
+            ssl=self.ssl_context,
+            reuse_port=self.bus_path is not None
         )
         
-        self.logger.info(f"Server started on {self.host}:{self.port}")
+        if self.bus_path:
+            self.logger.info(f"Worker {self.worker_id} started on {self.host}:{self.port}")
+        elif self.cluster_nodes:
+            self.logger.info(f"Node {self.node_id} started on {self.host}:{self.port}")
+        else:
+            self.logger.info(f"Server started on {self.host}:{self.port}")
         
         # Start background tasks
-        asyncio.create_task(self.cleanup_inactive_clients())
+        self.qos_manager.start()
+        self.loop_probe.start()
+        if self.watchdog:
+            self.watchdog.start()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.profiler.toggle)
+        except (NotImplementedError, AttributeError):
+            pass  # no SIGUSR1 on this platform
+        asyncio.create_task(self.expire_idle_clients())
+        asyncio.create_task(self.expire_stalled_transfers())
         asyncio.create_task(self.performance_monitor.report_stats())
-        # asyncio.create_task(self.performance_monitor.generate_graphs()) # Removed
+        if self.metrics_endpoint:
+            await self.metrics_endpoint.start()
         
         async with server:
-            await server.serve_forever()
+            try:
+                if self.bus:
+                    # Rooms would drift apart without the bus; exit and let the supervisor restart us
+                    await self.bus.lost.wait()
+                else:
+                    await server.serve_forever()
+            finally:
+                if self.bus:
+                    await self.bus.close()
+                if self.metrics_endpoint:
+                    await self.metrics_endpoint.close()
+                if self.watchdog:
+                    self.watchdog.stop()
+                self.profiler.stop()
 
-if __name__ == "__main__":
-    server = ChatServer()
+def run_worker(host, port, worker_id, num_workers, bus_path, **options):
+    """Entry point of one worker process started by the Supervisor; options
+    are passed on to ChatServer"""
+    # Stopping a worker should still flush its message log
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = ChatServer(host, port, worker_id=worker_id, num_workers=num_workers, bus_path=bus_path, **options)
     try:
         asyncio.run(server.start())
     except KeyboardInterrupt:
-        print("\nShutting down server...")
+        pass
+    finally:
+        server.message_log.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port (0: one per CPU)')
+    parser.add_argument('--node-id', help="this node's id in --cluster")
+    parser.add_argument('--cluster', help='node links of every cluster node, as id=host:port,...')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on 127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-socket', help='serve Prometheus metrics over HTTP on this Unix socket')
+    parser.add_argument('--slow-handler-threshold', type=float, default=0.1,
+                        help='log handlers blocking the event loop longer than this many seconds, with a stack sample (0: off)')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.01,
+                        help='share of text messages traced from send to delivery (0: off)')
+    args = parser.parse_args()
+    if args.cluster and (args.workers != 1 or not args.node_id):
+        parser.error('--cluster needs --node-id and runs a single process per node')
+    if args.workers != 1 and (args.metrics_port or args.metrics_socket):
+        parser.error('the metrics endpoint is served by single-process servers and cluster nodes')
+    
+    if args.workers != 1:
+        from supervisor import Supervisor
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            asyncio.run(Supervisor(
+                run_worker, args.host, args.port, args.workers or None,
+                worker_options={
+                    'slow_handler_threshold': args.slow_handler_threshold,
+                    'trace_sample_rate': args.trace_sample_rate
+                }
+            ).run())
+        except KeyboardInterrupt:
+            print("\nShutting down server...")
+    else:
+        server = ChatServer(
+            args.host,
+            args.port,
+            node_id=args.node_id,
+            cluster_nodes=parse_cluster_nodes(args.cluster) if args.cluster else None,
+            metrics_port=args.metrics_port,
+            metrics_path=args.metrics_socket,
+            slow_handler_threshold=args.slow_handler_threshold,
+            trace_sample_rate=args.trace_sample_rate
+        )
+        try:
+            asyncio.run(server.start())
+        except KeyboardInterrupt:
+            print("\nShutting down server...")
+        finally:
+            server.message_log.close()
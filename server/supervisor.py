@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+from room_bus import RoomBusBroker
+from user_manager import load_token_key
+
+class Supervisor:
+    """Runs the server as several worker processes sharing one port.
+
+    Each worker binds the port with SO_REUSEPORT, so the kernel spreads
+    new connections across them, and runs its own event loop on its own
+    core. The supervisor hosts the room bus broker linking the workers and
+    starts a fresh worker whenever one dies.
+    """
+    def __init__(self, worker_target, host='0.0.0.0', port=8888, num_workers=None, bus_path=None,
+                 token_key_file='certificates/session-secret.key', worker_options=None):
+        # worker_target(host, port, worker_id, num_workers, bus_path, **worker_options) runs one worker
+        self.worker_target = worker_target
+        self.worker_options = worker_options or {}
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers or os.cpu_count()
+        self.bus_path = Path(bus_path or f"logs/room-bus-{port}.sock")
+        self.token_key_file = token_key_file
+        self.broker = RoomBusBroker(self.bus_path)
+        self.processes = {}  # {worker_id: Process}
+        self.restarts = 0
+        # Workers start from a clean interpreter rather than a copy of this one
+        self.context = multiprocessing.get_context('spawn')
+        self.logger = logging.getLogger(__name__)
+    
+    def _spawn(self, worker_id):
+        process = self.context.Process(
+            target=self.worker_target,
+            args=(self.host, self.port, worker_id, self.num_workers, str(self.bus_path)),
+            kwargs=self.worker_options,
+            name=f"chat-worker-{worker_id}"
+        )
+        process.start()
+        self.processes[worker_id] = process
+    
+    async def run(self):
+        # Created up front, so resume tokens from any worker are valid on all of them
+        load_token_key(self.token_key_file)
+        
+        self.bus_path.parent.mkdir(parents=True, exist_ok=True)
+        self.bus_path.unlink(missing_ok=True)
+        await self.broker.start()
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        self.logger.info(f"Started {self.num_workers} workers on {self.host}:{self.port}")
+        
+        try:
+            while True:
+                await asyncio.sleep(1)
+                for worker_id, process in list(self.processes.items()):
+                    if not process.is_alive():
+                        self.logger.warning(
+                            f"Worker {worker_id} exited with code {process.exitcode}, restarting"
+                        )
+                        self.restarts += 1
+                        self._spawn(worker_id)
+        finally:
+            await self.stop()
+    
+    async def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        # Joined off the loop, so the broker sees the workers' links close
+        loop = asyncio.get_running_loop()
+        for process in self.processes.values():
+            await loop.run_in_executor(None, process.join, 5)
+        await self.broker.close()
+        self.bus_path.unlink(missing_ok=True)
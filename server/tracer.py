@@ -0,0 +1,123 @@
+from metrics import Histogram, MetricFamily
+
+STAGES = ('queue_wait', 'handler')
+
+class MessageTracer:
+    """Send-to-delivery latency of a sample of room messages.
+
+    Clients stamp the share sample_rate of their text messages with a
+    trace {'id', 'sent': their time.monotonic_ns()}. The server notes
+    when the message was read, when its handler started (the difference
+    is the wait in QoSManager) and when it was queued on the members'
+    connections, then passes the trace on with 'sent' moved to its own
+    clock. Every member receiving it sends back a TRACE_RECEIPT with its
+    own receive time, which gives the send-to-delivery latency of that
+    message in that room.
+
+    Client clocks are mapped to the server's with a per-connection
+    offset: the smallest (server read time - client stamp) seen so far,
+    as in NTP. It includes the connection's fastest one-way trip, so the
+    latency of a receipt is off by the difference between the sender's
+    and the recipient's fastest uplink; clamped at 0. The stamps in a
+    trace make receipts self-contained, so a receipt read by another
+    worker on the same host (one monotonic clock) counts as well.
+
+    A receipt only counts for a trace delivered in the member's room,
+    once per member: each room remembers the ids of its last
+    max_outstanding traces. Latency is kept per room for at most
+    max_rooms rooms at a time; forget_room() drops a deleted room's.
+    """
+    def __init__(self, sample_rate=0.01, monitor=None, max_outstanding=256, max_rooms=1000):
+        self.sample_rate = sample_rate
+        self.monitor = monitor
+        self.max_outstanding = max_outstanding
+        self.max_rooms = max_rooms
+        self.clock_offsets = {}  # {client_id: ns from the client's monotonic clock to ours}
+        self.stages = {stage: Histogram() for stage in STAGES}  # ns
+        self.rooms = {}  # {room_id: Histogram of send-to-delivery ns}
+        self.outstanding = {}  # {room_id: {trace id: {client_id that sent a receipt}}}, oldest first
+        self.stats = {
+            'traced': 0,
+            'receipts': 0,
+            'invalid': 0
+        }
+    
+    def _to_server_clock(self, client_id, client_ns, read_ns):
+        offset = read_ns - client_ns
+        current = self.clock_offsets.get(client_id)
+        if current is None or offset < current:
+            self.clock_offsets[client_id] = current = offset
+        return client_ns + current
+    
+    def forget(self, client_id):
+        self.clock_offsets.pop(client_id, None)
+    
+    def forget_room(self, room_id):
+        self.rooms.pop(room_id, None)
+        self.outstanding.pop(room_id, None)
+    
+    def begin(self, client_id, trace, read_ns, handled_ns):
+        """A traced message from client_id, read at read_ns and handled from
+        handled_ns; returns the trace to pass on to the room, or None if
+        the client sent something that is not a trace"""
+        if not (isinstance(trace, dict) and type(trace.get('sent')) is int
+                and isinstance(trace.get('id'), str) and len(trace['id']) <= 32):
+            self.stats['invalid'] += 1
+            return None
+        
+        self.stats['traced'] += 1
+        self.stages['queue_wait'].record(max(0, handled_ns - read_ns))
+        return {'id': trace['id'], 'sent': self._to_server_clock(client_id, trace['sent'], read_ns)}
+    
+    def delivered(self, handled_ns, queued_ns):
+        """The traced message handled from handled_ns is on its members' connections"""
+        self.stages['handler'].record(max(0, queued_ns - handled_ns))
+    
+    def expect(self, room_id, trace, sender):
+        """A traced message from sender was delivered to this instance's members of room_id"""
+        if not (isinstance(trace, dict) and isinstance(trace.get('id'), str)):
+            return
+        outstanding = self.outstanding.get(room_id)
+        if outstanding is None:
+            outstanding = self.outstanding[room_id] = {}
+        outstanding[trace['id']] = {sender}  # the sender got no copy to acknowledge
+        if len(outstanding) > self.max_outstanding:
+            del outstanding[next(iter(outstanding))]  # receipts still due for it are refused
+    
+    def receipt(self, client_id, room_id, data, read_ns):
+        """A member's TRACE_RECEIPT: {'id', 'sent': server clock, 'received': its clock}"""
+        sent, received, trace_id = data.get('sent'), data.get('received'), data.get('id')
+        receipted = self.outstanding.get(room_id, {}).get(trace_id) if isinstance(trace_id, str) else None
+        if type(sent) is not int or type(received) is not int or receipted is None or client_id in receipted:
+            self.stats['invalid'] += 1
+            return
+        
+        receipted.add(client_id)
+        self.stats['receipts'] += 1
+        latency = max(0, self._to_server_clock(client_id, received, read_ns) - sent)
+        histogram = self.rooms.get(room_id)
+        if histogram is None and len(self.rooms) < self.max_rooms:
+            histogram = self.rooms[room_id] = Histogram()
+        if histogram is not None:
+            histogram.record(latency)
+        if self.monitor:
+            self.monitor.record_latency(latency)
+    
+    def metric_families(self):
+        stages = MetricFamily('chat_trace_stage_seconds', 'histogram',
+                              'Traced messages: QoS queue wait, and handler start to queued for members')
+        for stage, histogram in self.stages.items():
+            stages.add(histogram, stage=stage)
+        rooms = MetricFamily('chat_room_latency_seconds', 'histogram',
+                             'Traced messages: client send to delivery to a member, by room')
+        for room_id, histogram in self.rooms.items():
+            rooms.add(histogram, room=room_id)
+        return [stages, rooms]
+    
+    def get_stats(self):
+        return dict(
+            self.stats,
+            sample_rate=self.sample_rate,
+            stages_ms={stage: histogram.summary(scale=1e-6) for stage, histogram in self.stages.items()},
+            rooms_ms={room_id: histogram.summary(scale=1e-6) for room_id, histogram in self.rooms.items()}
+        )
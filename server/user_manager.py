@@ -1,68 +1,226 @@
-import json
+import asyncio
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 import threading
 from common.security import SecurityManager
 from datetime import datetime
+from user_store import create_user_store
+
+def _timed_call(func, *args):
+    # Runs in the executor; reports when the work actually started
+    return time.monotonic(), func(*args)
+
+def load_token_key(path):
+    """Resume token signing key, created on first use"""
+    path = Path(path)
+    if path.exists():
+        return path.read_bytes()
+    
+    key = SecurityManager.generate_key()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(key)
+    path.chmod(0o600)
+    return key
 
 class UserManager:
-    def __init__(self, db_file='users.json'):
+    def __init__(self, db_file='users.db', max_concurrent_hashes=4, use_processes=False, store=None,
+                 token_key_file='certificates/session-secret.key', token_ttl=3600):
         self.db_file = Path(db_file)
-        self.users = self._load_users()
+        self.store = store or create_user_store(self.db_file)
         self.active_sessions = {}  # {username: session_id}
+        # {username: (session_id, or None once logged out; time to forget it)}. Only the
+        # latest token resumes a session whose connection dropped, and none a logged out one.
+        # Off when a room bus or cluster keeps the sessions of several processes.
+        self.ended_sessions = {}
+        self.remember_ended_sessions = True
         self.lock = threading.RLock()
+        
+        # Resume tokens are signed with a key kept on disk, so they survive restarts
+        self.token_key_file = Path(token_key_file)
+        self.token_ttl = token_ttl
+        self._token_key = None
+        
+        # bcrypt runs off the event loop, at most max_concurrent_hashes at a time
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=max_concurrent_hashes)
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_concurrent_hashes,
+                thread_name_prefix='bcrypt'
+            )
+        self.hash_stats = {
+            'pending': 0,
+            'completed': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0
+        }
     
-    def _load_users(self):
-        if self.db_file.exists():
-            with open(self.db_file, 'r') as f:
-                return json.load(f)
-        return {}
+    async def _run_hash(self, func, *args):
+        stats = self.hash_stats
+        stats['pending'] += 1
+        submitted = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, _timed_call, func, *args)
+        try:
+            started, result = await future
+        finally:
+            stats['pending'] -= 1
+        
+        wait = max(0.0, started - submitted)
+        stats['completed'] += 1
+        stats['total_wait'] += wait
+        stats['max_wait'] = max(stats['max_wait'], wait)
+        return result
     
-    def _save_users(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.users, f)
+    def get_hash_stats(self):
+        stats = self.hash_stats
+        return {
+            'pending': stats['pending'],
+            'completed': stats['completed'],
+            'avg_queue_wait_ms': stats['total_wait'] / stats['completed'] * 1000 if stats['completed'] else 0,
+            'max_queue_wait_ms': stats['max_wait'] * 1000
+        }
+    
+    async def register_async(self, username, password):
+        if self.store.exists(username):
+            return False, None
+        
+        hashed_password = await self._run_hash(SecurityManager.hash_password, password)
+        
+        # The store commits before answering, so this waits on disk, off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._add_user, username, hashed_password)
+    
+    async def authenticate_async(self, username, password):
+        user_data = self.store.get(username)
+        if user_data is None:
+            return False, None
+        
+        hashed_password = user_data['password'].encode('utf-8')
+        if not await self._run_hash(SecurityManager.verify_password, password, hashed_password):
+            return False, None
+        
+        return self._start_session(username, user_data)
     
     def register(self, username, password):
+        if self.store.exists(username):
+            return False, None
+        
+        hashed_password = SecurityManager.hash_password(password)
+        return self._add_user(username, hashed_password)
+    
+    def _add_user(self, username, hashed_password):
+        user_data = {
+            'id': str(uuid.uuid4()),
+            'username': username,
+            'password': hashed_password.decode('utf-8'),
+            'created': str(datetime.now())
+        }
+        
+        # Someone may have taken the name while we were hashing, here or in
+        # another worker; the store refuses it then, and only acknowledges
+        # a user once it is committed
+        if not self.store.add(user_data):
+            return False, None
+        
+        return True, user_data
+    
+    def _start_session(self, username, user_data):
         with self.lock:
-            if username in self.users:
-                return False, None
-            
-            user_id = str(uuid.uuid4())
-            hashed_password = SecurityManager.hash_password(password)
-            
-            user_data = {
-                'id': user_id,
-                'username': username,
-                'password': hashed_password.decode('utf-8'),
-                'created': str(datetime.now())
-            }
+            # Check if already logged in
+            if username in self.active_sessions:
+                return False, None  # Prevent multiple sessions
             
-            self.users[username] = user_data
-            self._save_users()
+            session_id = str(uuid.uuid4())
+            self.active_sessions[username] = session_id
+            self.ended_sessions.pop(username, None)
             
             return True, user_data
     
     def authenticate(self, username, password):
+        user_data = self.store.get(username)
+        if user_data is None:
+            return False, None
+        
+        hashed_password = user_data['password'].encode('utf-8')
+        if not SecurityManager.verify_password(password, hashed_password):
+            return False, None
+        
+        return self._start_session(username, user_data)
+    
+    def _get_token_key(self):
+        if self._token_key is None:
+            self._token_key = load_token_key(self.token_key_file)
+        return self._token_key
+    
+    def get_session_id(self, username):
         with self.lock:
-            if username not in self.users:
+            return self.active_sessions.get(username)
+    
+    def issue_resume_token(self, username):
+        session_id = self.get_session_id(username)
+        if session_id is None:
+            return None
+        return SecurityManager.sign_token(
+            {'user': username, 'sid': session_id, 'exp': int(time.time() + self.token_ttl)},
+            self._get_token_key()
+        )
+    
+    def check_resume_token(self, token):
+        # HMAC check only: microseconds, no bcrypt
+        return SecurityManager.verify_token(token, self._get_token_key())
+    
+    def resume_session(self, token_payload):
+        username = token_payload['user']
+        user_data = self.store.get(username)
+        if user_data is None:
+            return False, None
+        
+        with self.lock:
+            # A fresh login, a later resume or a logout supersedes the token's session
+            if username in self.active_sessions:
+                current = self.active_sessions[username]
+            else:
+                ended = self.ended_sessions.get(username)
+                # Not known here (a restart): the token's expiry and signature decide
+                current = ended[0] if ended else token_payload['sid']
+            if current != token_payload['sid']:
                 return False, None
             
-            user_data = self.users[username]
-            hashed_password = user_data['password'].encode('utf-8')
-            
-            if SecurityManager.verify_password(password, hashed_password):
-                # Check if already logged in
-                if username in self.active_sessions:
-                    return False, None  # Prevent multiple sessions
-                
-                session_id = str(uuid.uuid4())
-                self.active_sessions[username] = session_id
-                
-                return True, user_data
-            
-            return False, None
+            # A new id for every resume, so the token just used is spent
+            self.active_sessions[username] = str(uuid.uuid4())
+            self.ended_sessions.pop(username, None)
+            return True, user_data
+    
+    def detach(self, username):
+        """The user's connection dropped; its latest resume token can pick the session up"""
+        self._end_session(username, logged_out=False)
     
     def logout(self, username):
+        """The session is over; no resume token picks it up again"""
+        self._end_session(username, logged_out=True)
+    
+    def drop_session(self, username):
+        """Forget a session this process started but may not keep"""
         with self.lock:
-            if username in self.active_sessions:
-                del self.active_sessions[username]
+            self.active_sessions.pop(username, None)
+    
+    def _end_session(self, username, logged_out):
+        with self.lock:
+            session_id = self.active_sessions.pop(username, None)
+            if not self.remember_ended_sessions or session_id is None:
+                return
+            
+            # Tokens are only issued while connected, so token_ttl after that
+            # every token of the session has expired and it can be forgotten
+            now = time.time()
+            ended = self.ended_sessions
+            while ended:
+                oldest = next(iter(ended))
+                if ended[oldest][1] > now:
+                    break
+                del ended[oldest]
+            ended.pop(username, None)
+            ended[username] = (None if logged_out else session_id, now + self.token_ttl)
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+class JsonUserStore:
+    """Whole-file users.json store, loaded into memory at startup.
+
+    Every add() rewrites the file, so this only suits small deployments,
+    run as a single process. Writes go to a temp file that is renamed over
+    the original, so a crash mid-write cannot leave a truncated file behind.
+    """
+    def __init__(self, path='users.json'):
+        self.path = Path(path)
+        self.users = self._load()
+        self.lock = threading.Lock()
+    
+    def _load(self):
+        if self.path.exists() and self.path.stat().st_size > 0:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        return {}
+    
+    def get(self, username):
+        return self.users.get(username)
+    
+    def exists(self, username):
+        return username in self.users
+    
+    def add(self, user_data):
+        """Saves a new user; False if the username is taken"""
+        with self.lock:
+            if user_data['username'] in self.users:
+                return False
+            self.users[user_data['username']] = user_data
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.users, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        return True
+    
+    def count(self):
+        return len(self.users)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+
+class _StagedUser:
+    __slots__ = ('user_data', 'added', 'error', 'done')
+    
+    def __init__(self, user_data):
+        self.user_data = user_data
+        self.added = False
+        self.error = None
+        self.done = threading.Event()
+
+class SQLiteUserStore:
+    """Indexed user store on SQLite (WAL mode) with group commits.
+
+    add() returns once the record is committed, or refused because the
+    username is taken: the primary key decides, so workers sharing the
+    database cannot both register a name. It blocks, so the server calls
+    it from an executor. A background thread commits whatever adds are
+    waiting as one transaction, so a burst of signups shares commits.
+    Lookups hit the primary key index; nothing is read in full at startup.
+    """
+    def __init__(self, path='users.db', migrate_from=None):
+        self.path = Path(path)
+        self.logger = logging.getLogger(__name__)
+        
+        self.write_conn = self._connect()
+        self.read_conn = self._connect()
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self._create_schema()
+        
+        self.pending = []  # [_StagedUser] waiting for the next commit
+        self.pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        
+        if migrate_from:
+            self._migrate_json(Path(migrate_from))
+        
+        self._flusher = threading.Thread(target=self._flush_loop, name='user-store-commit', daemon=True)
+        self._flusher.start()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
+    def _create_schema(self):
+        with self.write_lock:
+            self.write_conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'username TEXT PRIMARY KEY, id TEXT NOT NULL, '
+                'password TEXT NOT NULL, created TEXT NOT NULL) WITHOUT ROWID'
+            )
+            self.write_conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+    
+    def _migrate_json(self, json_path):
+        """One-time import of a legacy users.json into an empty database"""
+        with self.read_lock:
+            done = self.read_conn.execute(
+                "SELECT value FROM meta WHERE key = 'migrated_from'"
+            ).fetchone()
+        if done or not json_path.exists() or json_path.stat().st_size == 0:
+            return
+        
+        with open(json_path, 'r') as f:
+            users = json.load(f)
+        
+        with self.write_lock:
+            conn = self.write_conn
+            conn.execute('BEGIN')
+            conn.executemany(
+                'INSERT OR IGNORE INTO users (username, id, password, created) VALUES (?, ?, ?, ?)',
+                (
+                    (u['username'], u['id'], u['password'], u['created'])
+                    for u in users.values()
+                )
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)",
+                (str(json_path),)
+            )
+            conn.execute('COMMIT')
+        self.logger.info(f"Migrated {len(users)} users from {json_path}")
+    
+    def get(self, username):
+        with self.read_lock:
+            row = self.read_conn.execute(
+                'SELECT username, id, password, created FROM users WHERE username = ?',
+                (username,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'username': row[0], 'id': row[1], 'password': row[2], 'created': row[3]}
+    
+    def exists(self, username):
+        return self.get(username) is not None
+    
+    def add(self, user_data):
+        """Commits a new user; False if the username is taken"""
+        staged = _StagedUser(user_data)
+        with self.pending_lock:
+            if self._closed:
+                raise RuntimeError('user store is closed')
+            self.pending.append(staged)
+        self._wakeup.set()
+        staged.done.wait()
+        if staged.error is not None:
+            raise staged.error
+        return staged.added
+    
+    def count(self):
+        with self.read_lock:
+            return self.read_conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    
+    def flush(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        
+        try:
+            with self.write_lock:
+                conn = self.write_conn
+                # IMMEDIATE: take the write lock now, waiting out other workers' commits
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for staged in batch:
+                        u = staged.user_data
+                        try:
+                            conn.execute(
+                                'INSERT INTO users (username, id, password, created) VALUES (?, ?, ?, ?)',
+                                (u['username'], u['id'], u['password'], u['created'])
+                            )
+                            staged.added = True
+                        except sqlite3.IntegrityError:
+                            pass  # taken, possibly earlier in this same batch
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+        except Exception as e:
+            for staged in batch:
+                staged.added = False
+                staged.error = e
+            raise
+        finally:
+            # Nobody hears back before the commit, so no one is told of a user that is not stored
+            for staged in batch:
+                staged.done.set()
+    
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Error committing users: {e}")
+    
+    def compact(self):
+        """Rewrite the database file; SQLite swaps it in atomically"""
+        self.flush()
+        with self.write_lock:
+            self.write_conn.execute('VACUUM')
+            self.write_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    
+    def close(self):
+        with self.pending_lock:
+            self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
+        self.write_conn.close()
+        self.read_conn.close()
+
+def create_user_store(db_file):
+    """users.json keeps the legacy store; anything else is SQLite, migrating a
+    users.json that sits next to it on first start"""
+    path = Path(db_file)
+    if path.suffix == '.json':
+        return JsonUserStore(path)
+    return SQLiteUserStore(path, migrate_from=path.with_suffix('.json'))
@@ -0,0 +1,90 @@
+"""A ChatServer for tests and benchmarks that call its handlers directly.
+
+ChatServer() wants certificates and sets up log files, a message log on
+disk and its background tasks. make_bare_server() skips __init__ and sets
+the attributes handlers read to cheap stand-ins instead: no sockets,
+threads or files. Callers put the server and client directories on
+sys.path first, as every script here does.
+"""
+import logging
+
+from common.framing import MAX_FRAME_SIZE
+from common.protocol import CODEC_JSON
+from server.server import ChatServer
+from connection_writer import SlowConsumerPolicy
+from metrics import LoopLagProbe
+from performance_monitor import PerformanceMonitor
+from qos_manager import QoSManager
+from room_manager import RoomManager
+
+class NullConnection:
+    """Stands in for a ConnectionWriter that takes every frame and sends none"""
+    queued_bytes = 0
+    
+    def __init__(self, codec=CODEC_JSON):
+        self.codec = codec
+    
+    def send(self, frame, priority=None):
+        return True
+
+class RecordingConnection(NullConnection):
+    """A NullConnection that keeps the frames sent to it"""
+    def __init__(self, codec=CODEC_JSON):
+        super().__init__(codec)
+        self.frames = []
+    
+    def send(self, frame, priority=None):
+        self.frames.append(frame)
+        return True
+
+class NullLog:
+    """A MessageLog that keeps nothing"""
+    def append(self, room_id, message_id, frame):
+        pass
+    
+    def read(self, room_id, since=0, limit=100):
+        return []
+    
+    def get_stats(self):
+        return {}
+
+def make_bare_server(**overrides):
+    """ChatServer with no I/O; overrides replace any attribute, e.g. message_log=MessageLog(path)"""
+    server = ChatServer.__new__(ChatServer)
+    server.worker_id = None
+    server.num_workers = 1
+    server.node_id = None
+    server.cluster_nodes = None
+    server.bus = None
+    server.clients = {}
+    server.user_connections = {}
+    server.room_manager = RoomManager()
+    server.qos_manager = QoSManager()
+    server.performance_monitor = PerformanceMonitor()
+    server.slow_consumer_policy = SlowConsumerPolicy()
+    server.max_frame_size = MAX_FRAME_SIZE
+    server.message_log = NullLog()
+    server.history_on_join = 50
+    server.ordering = 'connection'
+    server.file_transfers = {}
+    server.max_transfers_per_client = 8
+    server.file_transfer_timeout = 60
+    server.shared_files = {}
+    server.max_shared_files = 1000
+    server.file_relay_timeout = 10
+    server.max_stream_chunks_in_flight = 32
+    server.loop_probe = LoopLagProbe()  # not started
+    server.watchdog = None
+    server.tracer = None
+    server.metrics_endpoint = None
+    server.logger = logging.getLogger('bare_server')
+    for name, value in overrides.items():
+        setattr(server, name, value)
+    return server
+
+def add_client(server, client_id, connection=None, room_id=None, username=None):
+    """Registers a connected, logged in client, a member of room_id if given"""
+    username = username or client_id
+    server.clients[client_id] = {'writer': connection, 'user': {'username': username}, 'room_id': room_id}
+    if room_id:
+        server.room_manager.join_room(room_id, client_id, username)
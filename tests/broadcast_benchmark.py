@@ -0,0 +1,76 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType
+from tests.bare_server import make_bare_server, add_client, NullConnection
+
+class BroadcastBenchmark:
+    def __init__(self, num_clients=10000, num_rooms=500, iterations=2000):
+        self.num_clients = num_clients
+        self.num_rooms = num_rooms
+        self.iterations = iterations
+        
+        # Bare server: no sockets, certificates or background tasks needed.
+        # NullConnections, so only the fan-out cost is measured
+        self.server = make_bare_server()
+        self.room_ids = []
+    
+    def populate(self):
+        self.room_ids = [
+            self.server.room_manager.create_room(f"room_{i}")
+            for i in range(self.num_rooms)
+        ]
+        for i in range(self.num_clients):
+            add_client(self.server, f"client_{i}", NullConnection(), self.room_ids[i % self.num_rooms], f"user_{i}")
+    
+    async def _full_scan_broadcast(self, room_id, message, exclude_client=None):
+        # Previous implementation: walk every connection on every broadcast
+        frame = message.to_bytes()
+        for client_id, client_info in self.server.clients.items():
+            if client_info['room_id'] == room_id and client_id != exclude_client:
+                self.server._send_frame(client_info['writer'], frame, message.priority)
+    
+    async def measure(self, broadcast):
+        latencies = []
+        for i in range(self.iterations):
+            room_id = self.room_ids[i % self.num_rooms]
+            message = Message(
+                MessageType.TEXT_MESSAGE,
+                {'username': 'bench', 'text': f"message {i}"},
+                room_id=room_id
+            )
+            start = time.perf_counter()
+            await broadcast(room_id, message)
+            latencies.append(time.perf_counter() - start)
+        
+        latencies.sort()
+        return {
+            'avg_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000
+        }
+    
+    async def run(self):
+        self.populate()
+        room_size = self.num_clients // self.num_rooms
+        print(f"Broadcast benchmark: {self.num_clients} connections, "
+              f"{self.num_rooms} rooms (~{room_size} members each), {self.iterations} broadcasts")
+        
+        for name, broadcast in [
+            ('full scan', self._full_scan_broadcast),
+            ('room index', self.server._broadcast_to_room)
+        ]:
+            result = await self.measure(broadcast)
+            print(f"{name:>12}: avg {result['avg_ms']:.3f} ms | "
+                  f"p50 {result['p50_ms']:.3f} ms | p99 {result['p99_ms']:.3f} ms")
+
+if __name__ == "__main__":
+    num_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    benchmark = BroadcastBenchmark(num_clients=num_clients, num_rooms=num_rooms)
+    asyncio.run(benchmark.run())
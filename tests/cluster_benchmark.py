@@ -0,0 +1,228 @@
+import asyncio
+import signal
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType
+from cluster import HashRing
+
+ROOT = Path(__file__).parent.parent
+
+class BenchClient:
+    """Bare protocol client connected to one node"""
+    def __init__(self, node, port):
+        self.node = node
+        self.port = port
+    
+    async def connect(self):
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port, ssl=ssl_context)
+    
+    def send(self, message):
+        self.writer.write(message.to_bytes())
+    
+    async def receive(self):
+        length = struct.unpack('!I', await self.reader.readexactly(4))[0]
+        return Message.from_bytes(await self.reader.readexactly(length))
+    
+    async def expect(self, msg_type, timeout=10):
+        while True:
+            message = await asyncio.wait_for(self.receive(), timeout)
+            if message.type == msg_type:
+                return message
+    
+    async def login(self, username, register=True):
+        if register:
+            self.send(Message(MessageType.REGISTER_REQUEST, {'username': username, 'password': 'benchpass123'}))
+            await self.expect(MessageType.REGISTER_RESPONSE)
+        self.send(Message(MessageType.AUTH_REQUEST, {'username': username, 'password': 'benchpass123'}))
+        return (await self.expect(MessageType.AUTH_RESPONSE)).data
+    
+    async def join(self, room_id):
+        self.send(Message(MessageType.JOIN_ROOM, {'room_id': room_id}))
+        await self.expect(MessageType.SUCCESS)
+        history = await self.expect(MessageType.HISTORY)
+        return history.data
+
+class ClusterBenchmark:
+    """Rooms spread over a cluster of nodes on localhost.
+
+    Measures how many rooms move when a node joins, compared with plain
+    modulo hashing, and how much a hop through the room's owner adds to
+    broadcast latency. Then stops a node and brings it back, checking
+    that rooms keep working and their history is handed back. Run from
+    the repository root, after generating certificates/ as described in
+    the README.
+    """
+    def __init__(self, num_nodes=3, num_messages=500, base_port=8910, link_port=9110):
+        self.nodes = {chr(ord('a') + i): (base_port + i, link_port + i) for i in range(num_nodes)}
+        self.spec = ','.join(f"{node}=127.0.0.1:{link}" for node, (_, link) in self.nodes.items())
+        self.num_messages = num_messages
+        self.processes = {}
+    
+    def reshuffle(self, num_keys=20000):
+        keys = [f"room-{i}" for i in range(num_keys)]
+        before = HashRing(list(self.nodes))
+        after = HashRing(list(self.nodes) + ['new'])
+        moved_ring = sum(before.owner(key) != after.owner(key) for key in keys) / num_keys
+        
+        n = len(self.nodes)
+        moved_modulo = sum(
+            zlib.crc32(key.encode()) % n != zlib.crc32(key.encode()) % (n + 1) for key in keys
+        ) / num_keys
+        
+        load = {}
+        for key in keys:
+            load[after.owner(key)] = load.get(after.owner(key), 0) + 1
+        spread = max(load.values()) / (num_keys / (n + 1))
+        return moved_ring, moved_modulo, spread
+    
+    def _start_node(self, node, work_dir):
+        port, _ = self.nodes[node]
+        self.processes[node] = subprocess.Popen(
+            [sys.executable, str(ROOT / 'server' / 'server.py'), '--host', '127.0.0.1',
+             '--port', str(port), '--node-id', node, '--cluster', self.spec],
+            cwd=work_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    
+    async def _stop_node(self, node):
+        process = self.processes.pop(node)
+        process.send_signal(signal.SIGINT)
+        await asyncio.get_running_loop().run_in_executor(None, process.wait, 30)
+    
+    async def _client(self, node, username, register=True):
+        deadline = time.monotonic() + 15
+        while True:
+            client = BenchClient(node, self.nodes[node][0])
+            try:
+                await client.connect()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+        response = await client.login(username, register)
+        if not response.get('success'):
+            raise RuntimeError(f"Login failed for {username} on node {node}: {response}")
+        return client
+    
+    async def _latency(self, sender, receivers):
+        """Send num_messages one at a time; returns {node: [latency]} per receiving node"""
+        latencies = {receiver.node: [] for receiver in receivers}
+        
+        async def arrival(receiver, sent):
+            await receiver.expect(MessageType.TEXT_MESSAGE)
+            latencies[receiver.node].append(time.perf_counter() - sent)
+        
+        for i in range(self.num_messages):
+            sent = time.perf_counter()
+            sender.send(Message(MessageType.TEXT_MESSAGE, {'text': f"ping {i}"}))
+            await asyncio.gather(*[arrival(receiver, sent) for receiver in receivers])
+        return latencies
+    
+    @staticmethod
+    def _percentiles(timings):
+        timings = sorted(timings)
+        return timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000
+    
+    async def run_test(self):
+        moved_ring, moved_modulo, spread = self.reshuffle()
+        n = len(self.nodes)
+        print(f"Cluster benchmark: {n} nodes on localhost")
+        print(f"  adding a node moves {moved_ring:.1%} of rooms on the ring "
+              f"(ideal {1 / (n + 1):.1%}), {moved_modulo:.1%} with modulo hashing; "
+              f"busiest node holds {spread:.2f}x its share")
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            (Path(tmp) / 'certificates').symlink_to(Path('certificates').resolve())
+            for node in self.nodes:
+                self._start_node(node, tmp)
+            try:
+                await self._run_cluster(tmp, moved_ring < 2 / (n + 1))
+            finally:
+                for node in list(self.processes):
+                    await self._stop_node(node)
+    
+    async def _run_cluster(self, work_dir, reshuffle_ok):
+        tag = str(int(time.time()))
+        nodes = list(self.nodes)
+        await asyncio.sleep(2)  # let the nodes link up
+        
+        admin = await self._client(nodes[0], f"admin_{tag}")
+        admin.send(Message(MessageType.CREATE_ROOM, {'name': 'bench'}))
+        room_id = (await admin.expect(MessageType.SUCCESS)).data['room_id']
+        owner = HashRing(nodes).owner(room_id)
+        others = [node for node in nodes if node != owner]
+        
+        # The sender sits on a node that does not own the room, so its
+        # messages travel sender node -> owner -> every node with members
+        sender = await self._client(others[0], f"sender_{tag}")
+        await sender.join(room_id)
+        receivers = []
+        for node in nodes:
+            receiver = await self._client(node, f"recv_{node}_{tag}")
+            await receiver.join(room_id)
+            receivers.append(receiver)
+        await asyncio.sleep(0.5)
+        for receiver in receivers:
+            while True:
+                try:
+                    await receiver.expect(MessageType.TEXT_MESSAGE, timeout=0.2)
+                except asyncio.TimeoutError:
+                    break
+        
+        latencies = await self._latency(sender, receivers)
+        print(f"  broadcast from node {others[0]}, room owned by node {owner} "
+              f"({self.num_messages} messages):")
+        for node, timings in latencies.items():
+            p50, p99 = self._percentiles(timings)
+            role = 'same node as sender' if node == others[0] else (
+                'owner' if node == owner else 'via owner')
+            print(f"    node {node} ({role:>19}): p50 {p50:6.2f} ms | p99 {p99:6.2f} ms")
+        
+        # The sender's node goes away; the rest of the room carries on
+        stopped = others[0]
+        survivors = [receiver for receiver in receivers if receiver.node != stopped]
+        await self._stop_node(stopped)
+        await asyncio.sleep(1)
+        survivors[0].send(Message(MessageType.TEXT_MESSAGE, {'text': 'still here'}))
+        try:
+            await survivors[-1].expect(MessageType.TEXT_MESSAGE)
+            failover_ok = True
+        except asyncio.TimeoutError:
+            failover_ok = False
+        
+        # Back again: a member joining there is served the room's full history
+        self._start_node(stopped, work_dir)
+        await asyncio.sleep(3)
+        returning = await self._client(stopped, f"sender_{tag}", register=False)
+        history = await returning.join(room_id)
+        handoff_ok = history['last_id'] == self.num_messages + 1
+        
+        for client in [admin, sender, returning] + receivers:
+            client.writer.close()
+        
+        if reshuffle_ok and failover_ok and handoff_ok:
+            print(f"Node {stopped} stopped and restarted: room kept working, "
+                  f"history up to #{history['last_id']} served ✓")
+        else:
+            print(f"FAILED: reshuffle ok {reshuffle_ok}, delivery after node loss {failover_ok}, "
+                  f"history after rejoin {history}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    asyncio.run(ClusterBenchmark(num_messages=num_messages).run_test())
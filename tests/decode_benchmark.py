@@ -0,0 +1,153 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import struct
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from common.codec import unpack_value
+from common.protocol import (
+    Message, MessageType, Priority, CODEC_JSON, CODEC_BINARY, BINARY_MAGIC, BINARY_HEADER,
+    FLAG_ROOM_UUID, FLAG_ROOM_STR, TYPES_BY_CODE
+)
+
+def legacy_from_bytes(data):
+    """Message.from_bytes as it was: __init__ stamps the time twice, enums are
+    looked up by value and the payload is always decoded"""
+    if data[0] == BINARY_MAGIC:
+        _, type_code, priority, flags, msg_id, timestamp = BINARY_HEADER.unpack_from(data)
+        pos = BINARY_HEADER.size
+        room_id = None
+        if flags & FLAG_ROOM_UUID:
+            room_id = str(uuid.UUID(bytes=bytes(data[pos:pos + 16])))
+            pos += 16
+        elif flags & FLAG_ROOM_STR:
+            length = struct.unpack_from('!H', data, pos)[0]
+            room_id = str(data[pos + 2:pos + 2 + length], 'utf-8')
+            pos += 2 + length
+        payload, _ = unpack_value(data, pos)
+        msg = Message(TYPES_BY_CODE[type_code], payload, Priority(priority), room_id)
+        msg.id = msg_id
+        msg.timestamp = datetime.fromtimestamp(timestamp).isoformat()
+        return msg
+    
+    json_data = json.loads(str(data, 'utf-8'))
+    msg = Message(
+        MessageType(json_data['type']),
+        json_data['data'],
+        Priority(json_data['priority']),
+        json_data.get('room_id')
+    )
+    msg.id = json_data['id']
+    msg.timestamp = json_data['timestamp']
+    return msg
+
+def sample_messages():
+    room_id = str(uuid.uuid4())
+    return {
+        'heartbeat': Message(MessageType.HEARTBEAT),
+        'auth request': Message(
+            MessageType.AUTH_REQUEST,
+            {'username': 'alice', 'password': 'correct horse'}
+        ),
+        'text message': Message(
+            MessageType.TEXT_MESSAGE,
+            {'username': 'alice', 'text': 'Hey, is everyone ready for the demo at three?'},
+            room_id=room_id
+        ),
+        'user list (50)': Message(
+            MessageType.USER_LIST,
+            {'users': [f"user_{i}" for i in range(50)]},
+            room_id=room_id
+        ),
+        'file transfer (4 KB)': Message(
+            MessageType.FILE_TRANSFER,
+            {
+                'transfer_id': os.urandom(16).hex(),
+                'filename': 'report.pdf',
+                'size': 1048576,
+                'chunk_size': 4096,
+                'chunk_num': 42,
+                'total_chunks': 256,
+                'data': os.urandom(4096)
+            },
+            priority=Priority.LOW,
+            room_id=room_id
+        )
+    }
+
+def decode_header(body):
+    # What routing needs: the type, priority and room, never the payload
+    message = Message.from_bytes(body)
+    return message.type, message.priority, message.room_id
+
+def decode_full(body):
+    message = Message.from_bytes(body)
+    return message.data, message.timestamp
+
+def decode_legacy(body):
+    message = legacy_from_bytes(body)
+    return message.data, message.timestamp
+
+class DecodeBenchmark:
+    def __init__(self, iterations=20000):
+        self.iterations = iterations
+    
+    def _time(self, func, body):
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            func(body)
+        return (time.perf_counter() - start) / self.iterations * 1_000_000
+    
+    def _same(self, body):
+        old, new = legacy_from_bytes(body), Message.from_bytes(body)
+        return all(getattr(old, field) == getattr(new, field)
+                   for field in ('id', 'type', 'priority', 'room_id', 'data', 'timestamp'))
+    
+    def _profile(self, bodies):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        for _ in range(self.iterations // 10):
+            for body in bodies:
+                decode_full(body)
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('tottime').print_stats(8)
+        return out.getvalue()
+    
+    def run(self):
+        print(f"Decode benchmark ({self.iterations} iterations per case, µs per message)")
+        print(f"{'message':>20} | {'codec':>6} | {'legacy':>7} | {'full':>7} | {'header':>7}")
+        print("-" * 61)
+        
+        bodies = []
+        identical = True
+        for name, message in sample_messages().items():
+            for codec in (CODEC_JSON, CODEC_BINARY):
+                body = message.to_bytes(codec)[4:]
+                bodies.append(body)
+                identical = identical and self._same(body)
+                legacy = self._time(decode_legacy, body)
+                full = self._time(decode_full, body)
+                header = self._time(decode_header, body)
+                print(f"{name:>20} | {codec:>6} | {legacy:>7.2f} | {full:>7.2f} | {header:>7.2f}")
+        
+        print("\nProfile of full decodes of every case above:")
+        print(self._profile(bodies))
+        
+        if identical:
+            print("Decoded messages match the previous decoder ✓")
+        else:
+            print("FAILED: decoded messages differ from the previous decoder")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    DecodeBenchmark(iterations=iterations).run()
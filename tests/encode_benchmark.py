@@ -0,0 +1,61 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType
+from tests.bare_server import make_bare_server, add_client, NullConnection
+
+class EncodeBenchmark:
+    def __init__(self, room_sizes=(10, 100, 500, 1000), iterations=200):
+        self.room_sizes = room_sizes
+        self.iterations = iterations
+    
+    def _make_server(self, room_size):
+        server = make_bare_server()
+        room_id = server.room_manager.create_room('bench')
+        for i in range(room_size):
+            add_client(server, f"client_{i}", NullConnection(), room_id, f"user_{i}")
+        return server, room_id
+    
+    async def _per_recipient_broadcast(self, server, room_id, message):
+        # Previous behaviour: every recipient pays for its own to_bytes()
+        for client_id in server.room_manager.get_room_members(room_id):
+            await server._send_message(server.clients[client_id]['writer'], message)
+    
+    async def _time(self, broadcast, server, room_id):
+        message = Message(
+            MessageType.TEXT_MESSAGE,
+            {
+                'username': 'bench',
+                'text': 'The quick brown fox jumps over the lazy dog. ' * 4,
+                'timestamp': '2025-01-01T00:00:00'
+            },
+            room_id=room_id
+        )
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            await broadcast(server, room_id, message)
+        return (time.perf_counter() - start) / self.iterations
+    
+    async def run(self):
+        print(f"Encode-once benchmark ({self.iterations} broadcasts per room size)")
+        print(f"{'room size':>10} | {'per-recipient':>14} | {'encode-once':>12} | {'speedup':>7}")
+        print("-" * 55)
+        
+        for room_size in self.room_sizes:
+            server, room_id = self._make_server(room_size)
+            per_recipient = await self._time(self._per_recipient_broadcast, server, room_id)
+            encode_once = await self._time(
+                lambda s, r, m: s._broadcast_to_room(r, m), server, room_id
+            )
+            print(f"{room_size:>10} | {per_recipient * 1000:>11.3f} ms | "
+                  f"{encode_once * 1000:>9.3f} ms | {per_recipient / encode_once:>6.2f}x")
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    benchmark = EncodeBenchmark(iterations=iterations)
+    asyncio.run(benchmark.run())
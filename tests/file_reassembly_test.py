@@ -0,0 +1,106 @@
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'client'))
+
+from file_manager import FileManager
+
+class FileReassemblyTester:
+    def __init__(self, num_transfers=10, size_mb=10, chunk_size=64 * 1024):
+        self.num_transfers = num_transfers
+        self.size = size_mb * 1024 * 1024
+        self.chunk_size = chunk_size
+    
+    def _metadata(self, i):
+        return {
+            'transfer_id': os.urandom(16).hex(),
+            'filename': f"file_{i}.bin",
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': -(-self.size // self.chunk_size)
+        }
+    
+    def run_test(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = FileManager(tmp)
+            transfers = [self._metadata(i) for i in range(self.num_transfers)]
+            sources = [os.urandom(self.chunk_size) for _ in range(4)]
+            
+            # Interleave every transfer's chunks in random order, with some duplicates
+            schedule = [
+                (t, n) for t in transfers for n in range(t['total_chunks'])
+            ]
+            random.shuffle(schedule)
+            schedule += random.sample(schedule, len(schedule) // 20)
+            
+            for t in transfers:
+                manager.start_transfer(t)
+            
+            tracemalloc.start()
+            start = time.perf_counter()
+            completed = 0
+            for t, n in schedule:
+                data = sources[n % len(sources)]
+                if n == t['total_chunks'] - 1:
+                    data = data[:self.size - n * self.chunk_size]
+                if manager.receive_stream_chunk(t['transfer_id'], n, data):
+                    completed += 1
+            duration = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            
+            total_mb = self.num_transfers * self.size / (1024 * 1024)
+            print(f"Reassembled {completed}/{self.num_transfers} transfers "
+                  f"({total_mb:.0f} MB) in {duration:.2f}s")
+            print(f"Peak Python memory while receiving: {peak / 1024:.0f} KB")
+            
+            intact = all(
+                (Path(tmp) / t['filename']).read_bytes()[n * self.chunk_size:(n + 1) * self.chunk_size]
+                == sources[n % len(sources)][:self.size - n * self.chunk_size]
+                for t in transfers for n in (0, t['total_chunks'] // 2, t['total_chunks'] - 1)
+            )
+            leftovers = list(Path(tmp).glob('.*.part'))
+            
+            # An abandoned transfer is dropped along with its .part file
+            abandoned = self._metadata('abandoned')
+            manager.start_transfer(abandoned)
+            manager.receive_stream_chunk(abandoned['transfer_id'], 0, sources[0])
+            evicted = manager.evict_idle_transfers(max_idle=0)
+            
+            # Ids that could name another file, and sizes that are negative or over
+            # the limit, are refused before anything is opened on disk
+            hostile = [
+                dict(self._metadata('traversal'), transfer_id='../../' + os.urandom(13).hex()),
+                dict(self._metadata('short'), transfer_id='abc'),
+                dict(self._metadata('negative'), size=-1),
+                dict(self._metadata('huge'), size=manager.max_file_size + 1),
+                dict(self._metadata('chunks'), total_chunks=10 ** 12)
+            ]
+            refused = sum(manager.start_transfer(t) is None for t in hostile)
+            
+            ok = (
+                completed == self.num_transfers
+                and intact
+                and not leftovers
+                and peak < 4 * 1024 * 1024
+                and evicted == 1
+                and refused == len(hostile)
+                and not list(Path(tmp).rglob('*.part'))
+            )
+            if ok:
+                print("Memory stays flat and abandoned transfers are cleaned up ✓")
+                print(f"Invalid transfer ids and sizes refused before touching disk ({refused}/{len(hostile)}) ✓")
+            else:
+                print(f"FAILED: completed={completed} intact={intact} evicted={evicted} "
+                      f"refused={refused}/{len(hostile)}")
+                sys.exit(1)
+
+if __name__ == "__main__":
+    num_transfers = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    FileReassemblyTester(num_transfers=num_transfers).run_test()
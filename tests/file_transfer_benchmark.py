@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+sys.path.append(str(Path(__file__).parent.parent / 'client'))
+
+from common.protocol import Message, MessageType, CODEC_JSON, CODEC_BINARY, SUPPORTED_CODECS, pack_file_chunk
+from common.manifest import build_manifest_blob, hash_chunk, transfer_id_for
+from server.server import ChatServer
+from user_manager import UserManager
+from content_store import ContentStore
+from client.client import ChatClient
+from file_manager import FileManager
+
+class RecordingConnection:
+    codec = CODEC_JSON
+    queued_bytes = 0
+    
+    def __init__(self):
+        self.frames = []
+    
+    def send(self, frame, priority=None):
+        self.frames.append(bytes(frame))
+        return True
+    
+    def saw(self, text):
+        return any(text.encode() in frame for frame in self.frames)
+
+class StalledConnection(RecordingConnection):
+    """A room member whose queue stays full until released"""
+    codec = CODEC_BINARY
+    queued_bytes = 1 << 40
+    
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+    
+    async def wait_below(self, limit):
+        await self.released.wait()
+
+class FrameFeed:
+    """The reading side of a connection, fed whole frames by the test"""
+    def __init__(self):
+        self.frames = asyncio.Queue()
+    
+    def feed(self, frame):
+        self.frames.put_nowait(frame[4:])  # read_frame() hands over frames without their length prefix
+    
+    def close(self):
+        self.frames.put_nowait(None)
+    
+    async def read_frame(self):
+        frame = await self.frames.get()
+        if frame is None:
+            raise asyncio.IncompleteReadError(b'', None)
+        return frame
+
+class FileTransferBenchmark:
+    """Sends a file between two real clients through a server over loopback TLS.
+
+    Run from the repository root, after generating certificates/ as
+    described in the README.
+    """
+    def __init__(self, size_mb=100, port=8898):
+        self.size_mb = size_mb
+        self.port = port
+    
+    async def _wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError("Timed out waiting for the server")
+            await asyncio.sleep(0.01)
+    
+    async def _client(self, name, codecs, download_dir):
+        client = ChatClient('127.0.0.1', self.port, codecs=codecs)
+        client.file_manager = FileManager(download_dir)
+        await client.connect()
+        await client.register(name, 'benchpass123')
+        await asyncio.sleep(0.2)
+        await client.login(name, 'benchpass123')
+        await self._wait_for(lambda: client.resume_token is not None)
+        return client
+    
+    async def _transfer(self, server, tmp_dir, source, codecs, label):
+        sender = await self._client(f"sender_{label}_{time.time()}", codecs, tmp_dir / 'sent')
+        receiver = await self._client(f"receiver_{label}_{time.time()}", codecs, tmp_dir / label)
+        
+        await sender.create_room(f"bench_{label}")
+        await self._wait_for(lambda: sender.current_room is not None)
+        room_id = sender.current_room
+        sender.current_room = None
+        await sender.join_room(room_id)
+        await self._wait_for(lambda: sender.current_room is not None)
+        await receiver.join_room(room_id)
+        await self._wait_for(lambda: receiver.current_room is not None)
+        
+        received = tmp_dir / label / source.name
+        uploaded_before = server.performance_monitor.metrics['bytes_transferred']
+        start = time.perf_counter()
+        await sender.send_file(source)
+        await self._wait_for(
+            lambda: received.exists() and not receiver.file_manager.active_transfers,
+            timeout=600
+        )
+        duration = time.perf_counter() - start
+        uploaded = server.performance_monitor.metrics['bytes_transferred'] - uploaded_before
+        
+        intact = received.read_bytes() == source.read_bytes()
+        await sender.disconnect()
+        await receiver.disconnect()
+        return duration, uploaded, intact
+    
+    def _chunks(self, label, num_chunks=2, chunk_size=1024):
+        return [f"{label} chunk {i}".encode().ljust(chunk_size, b'.') for i in range(num_chunks)]
+    
+    def _manifest(self, label, num_chunks=2, chunk_size=1024):
+        chunks = self._chunks(label, num_chunks, chunk_size)
+        chunk_hashes = [hash_chunk(chunk) for chunk in chunks]
+        file_hash = hashlib.sha256(
+            build_manifest_blob(num_chunks * chunk_size, chunk_size, chunk_hashes)
+        ).hexdigest()
+        return Message(MessageType.FILE_TRANSFER, {
+            'transfer_id': transfer_id_for(file_hash),
+            'file_hash': file_hash,
+            'filename': f"{label}.bin",
+            'size': num_chunks * chunk_size,
+            'chunk_size': chunk_size,
+            'chunk_hashes': chunk_hashes
+        })
+    
+    async def _check_guards(self, server):
+        """Uploads a client abandons or corrupts do not pile up, and only members
+        of a room a file was shared in may fetch it"""
+        room_id = server.room_manager.create_room('guards')
+        other_room = server.room_manager.create_room('elsewhere')
+        connections = {}
+        for client_id, room in (('guard_sender', room_id), ('guard_member', room_id), ('guard_outsider', other_room)):
+            connections[client_id] = RecordingConnection()
+            self._add_client(server, client_id, connections[client_id], room)
+        sender = connections['guard_sender']
+        failures = []
+        
+        corrupt = self._manifest('corrupt')
+        await server._handle_file_transfer('guard_sender', corrupt, sender)
+        await server._accept_file_chunk('guard_sender', corrupt.data['transfer_id'], 0, b'not the chunk', None, sender)
+        if ('guard_sender', corrupt.data['transfer_id']) in server.file_transfers or not sender.saw('upload abandoned'):
+            failures.append('an upload with a corrupt chunk stayed pending')
+        
+        for i in range(server.max_transfers_per_client):
+            await server._handle_file_transfer('guard_sender', self._manifest(f"stalled {i}"), sender)
+        await server._handle_file_transfer('guard_sender', self._manifest('one too many'), sender)
+        if not sender.saw('Too many file uploads'):
+            failures.append(f"more than {server.max_transfers_per_client} uploads accepted from one client")
+        for transfer in server.file_transfers.values():
+            transfer['last_active'] -= server.file_transfer_timeout + 1
+        await server._handle_file_transfer('guard_sender', self._manifest('after expiry'), sender)
+        if server._uploads_in_progress('guard_sender') != 1:
+            failures.append('stalled uploads were not expired')
+        
+        fetch = Message(MessageType.FILE_FETCH, {'file_hash': corrupt.data['file_hash'], 'chunks': [0]})
+        await server._handle_file_fetch('guard_member', fetch, connections['guard_member'])
+        await server._handle_file_fetch('guard_outsider', fetch, connections['guard_outsider'])
+        if connections['guard_member'].saw('no longer available'):
+            failures.append('a member of the room could not fetch a file shared there')
+        if not connections['guard_outsider'].saw('no longer available'):
+            failures.append('a client outside the room fetched a file shared there')
+        
+        for client_id in connections:
+            await server._disconnect_client(client_id)
+        if failures:
+            print(f"FAILED: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Guards: corrupt and stalled uploads dropped, uploads capped, fetches limited to the room ✓")
+    
+    def _add_client(self, server, client_id, connection, room_id):
+        server.clients[client_id] = {'writer': connection, 'user': {'username': client_id}, 'room_id': room_id}
+        if room_id:
+            server.room_manager.join_room(room_id, client_id, client_id)
+    
+    async def _check_uploads_beside_slow_member(self, server):
+        """Uploads waiting on a slow member must not hold the QoS workers, or
+        every other client's messages queue behind them"""
+        uploaders = server.qos_manager.max_concurrent
+        room_id = server.room_manager.create_room('slow member')
+        slow = StalledConnection()
+        self._add_client(server, 'slow_reader', slow, room_id)
+        feeds, loops = [], []
+        for i in range(uploaders):
+            client_id = f"uploader_{i}"
+            connection = RecordingConnection()
+            self._add_client(server, client_id, connection, room_id)
+            manifest = self._manifest(f"held upload {i}")
+            await server._handle_file_transfer(client_id, manifest, connection)
+            feed = FrameFeed()
+            for chunk_num, chunk in enumerate(self._chunks(f"held upload {i}")):
+                feed.feed(pack_file_chunk(manifest.data['transfer_id'], chunk_num, chunk))
+            feeds.append(feed)
+            loops.append(asyncio.create_task(server._client_loop(client_id, feed, connection)))
+        await asyncio.sleep(0.2)
+        held = server.qos_manager.get_stats()['active_keys']
+        
+        bystander = RecordingConnection()
+        self._add_client(server, 'bystander', bystander, None)
+        feed = FrameFeed()
+        feeds.append(feed)
+        loops.append(asyncio.create_task(server._client_loop('bystander', feed, bystander)))
+        start = time.perf_counter()
+        feed.feed(Message(MessageType.HEARTBEAT).to_bytes(CODEC_JSON))
+        await self._wait_for(lambda: bystander.saw('heartbeat'), timeout=2 * server.file_relay_timeout)
+        elapsed = time.perf_counter() - start
+        
+        slow.released.set()
+        for feed in feeds:
+            feed.close()
+        await asyncio.gather(*loops)
+        for client_id in ['slow_reader', 'bystander'] + [f"uploader_{i}" for i in range(uploaders)]:
+            await server._disconnect_client(client_id)
+        if held >= uploaders and elapsed < 1.0:
+            print(f"Heartbeat answered in {elapsed * 1000:.0f} ms while {uploaders} uploads "
+                  f"waited on a slow member ✓")
+        else:
+            print(f"FAILED: heartbeat took {elapsed * 1000:.0f} ms beside {held} held uploads")
+            sys.exit(1)
+    
+    async def run_test(self):
+        server = ChatServer('127.0.0.1', self.port)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp_dir = Path(tmp)
+            server.user_manager = UserManager(db_file=tmp_dir / 'users.db')
+            server.content_store = ContentStore(tmp_dir / 'content', max_bytes=4 * self.size_mb * 1024 * 1024)
+            server_task = asyncio.create_task(server.start())
+            await asyncio.sleep(0.5)
+            
+            print("File transfer benchmark over loopback TLS")
+            scenarios = [
+                ('binary stream', SUPPORTED_CODECS, self.size_mb),
+                # Same file again: served from the server's content store
+                ('binary repeat', SUPPORTED_CODECS, self.size_mb),
+                # The JSON fallback base64-encodes every chunk; keep it smaller
+                ('json fallback', [CODEC_JSON], max(1, self.size_mb // 10))
+            ]
+            for label, codecs, size_mb in scenarios:
+                source = tmp_dir / f"payload_{size_mb}mb.bin"
+                if not source.exists():
+                    with open(source, 'wb') as f:
+                        for _ in range(size_mb):
+                            f.write(os.urandom(1024 * 1024))
+                
+                duration, uploaded, intact = await self._transfer(
+                    server, tmp_dir, source, codecs, label.replace(' ', '_')
+                )
+                print(f"{label:>14}: {size_mb:>4} MB in {duration:6.2f}s | "
+                      f"{size_mb / duration:7.1f} MB/s | "
+                      f"uploaded {uploaded / (1024 * 1024):7.1f} MB | intact: {intact}")
+            
+            await self._check_guards(server)
+            await self._check_uploads_beside_slow_member(server)
+            server_task.cancel()
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    benchmark = FileTransferBenchmark(size_mb=size_mb)
+    asyncio.run(benchmark.run_test())
@@ -0,0 +1,116 @@
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from idle_timer import IdleTimer
+
+def full_scan(clients, now, timeout):
+    # Previous implementation: every pass looks at every connection
+    return [
+        client_id for client_id, info in clients.items()
+        if now - info.get('last_heartbeat', now) > timeout
+    ]
+
+class IdleTimerBenchmark:
+    """Cost of finding idle connections among many live ones: the full scan
+    cleanup_inactive_clients ran against the timing wheel"""
+    def __init__(self, num_connections=100000, timeout=60, precision=1.0):
+        self.num_connections = num_connections
+        self.timeout = timeout
+        self.precision = precision
+    
+    def measure(self):
+        random.seed(3)
+        start = 1000.0
+        # Connections active at random points of the last timeout, 1% of them idle too long
+        activity = {
+            f"client_{i}": start - random.uniform(0, self.timeout) * (2 if i % 100 == 0 else 1)
+            for i in range(self.num_connections)
+        }
+        timer = IdleTimer(self.timeout, self.precision)
+        timer.next_tick = int((start - 2 * self.timeout) / self.precision)
+        for client_id, last in activity.items():
+            timer.add(client_id, now=last)
+        # Catch the wheel up to the present, as the server's loop would have
+        timer.expire(now=start)
+        clients = {client_id: {'last_heartbeat': last} for client_id, last in activity.items()}
+        
+        scan_times, wheel_times = [], []
+        now = start
+        for _ in range(30):
+            now += self.precision
+            # Live connections keep sending frames between passes
+            for client_id in random.sample(list(clients), self.num_connections // 100):
+                clients[client_id]['last_heartbeat'] = now
+                timer.touch(client_id, now=now)
+            
+            t = time.perf_counter()
+            full_scan(clients, now, self.timeout)
+            scan_times.append(time.perf_counter() - t)
+            
+            t = time.perf_counter()
+            for client_id, _ in timer.expire(now=now):
+                del clients[client_id]
+            wheel_times.append(time.perf_counter() - t)
+        
+        return sum(scan_times) / len(scan_times), sum(wheel_times) / len(wheel_times)
+    
+    def expires_on_time(self):
+        """Nothing goes early, and everything idle goes within one precision step"""
+        random.seed(5)
+        timer = IdleTimer(timeout=10, precision=0.5)
+        start = timer.next_tick * timer.precision
+        last_activity = {}
+        for i in range(2000):
+            last_activity[i] = start + random.uniform(0, 5)
+            timer.add(i, now=last_activity[i])
+        
+        now = start
+        while timer:
+            now += 0.1
+            for key, _ in timer.expire(now=now):
+                idle = now - last_activity[key]
+                if idle < timer.timeout or idle > timer.timeout + timer.precision + 0.1:
+                    return False
+        return True
+    
+    def activity_postpones_expiry(self):
+        timer = IdleTimer(timeout=10, precision=1.0)
+        start = timer.next_tick * timer.precision
+        timer.add('busy', 'busy connection', now=start)
+        timer.add('quiet', 'quiet connection', now=start)
+        timer.add('gone', 'closed connection', now=start)
+        timer.remove('gone')
+        
+        expired = []
+        for second in range(1, 40):
+            timer.touch('busy', now=start + second)  # a frame every second
+            expired += timer.expire(now=start + second)
+        return expired == [('quiet', 'quiet connection')] and len(timer) == 1
+    
+    def run_test(self):
+        print(f"Idle timer benchmark: {self.num_connections} connections, "
+              f"{self.timeout}s timeout, {self.precision}s precision")
+        scan, wheel = self.measure()
+        print(f"Full scan: {scan * 1000:8.3f} ms per pass")
+        print(f"    Wheel: {wheel * 1000:8.3f} ms per pass ({scan / wheel:.0f}x less)")
+        
+        if self.expires_on_time():
+            print("Idle connections expired no earlier than the timeout and within its precision ✓")
+        else:
+            print("FAILED: a connection expired early or late")
+            sys.exit(1)
+        
+        if self.activity_postpones_expiry():
+            print("Frames keep a connection alive; only the quiet one expired ✓")
+        else:
+            print("FAILED: an active or removed connection expired")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    num_connections = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    IdleTimerBenchmark(num_connections=num_connections).run_test()
@@ -0,0 +1,194 @@
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType, CODEC_JSON, CODEC_BINARY
+from message_log import MessageLog
+from tracer import MessageTracer
+from tests.bare_server import make_bare_server, add_client, RecordingConnection
+
+UPLINK = 2_000_000  # ns from a client to the server
+DOWNLINK = 3_000_000  # ns from the server to a client
+
+class SimulatedClient:
+    """A client whose monotonic clock is clock_offset ns away from the server's"""
+    def __init__(self, client_id, clock_offset, codec):
+        self.client_id = client_id
+        self.clock_offset = clock_offset
+        self.connection = RecordingConnection(codec)
+    
+    def clock(self, server_ns):
+        return server_ns + self.clock_offset
+
+class LatencyTracingTest:
+    def __init__(self, num_messages=200):
+        self.num_messages = num_messages
+    
+    def make_server(self, directory, tracing=True):
+        server = make_bare_server(message_log=MessageLog(Path(directory) / 'rooms'))
+        server.tracer = MessageTracer(1.0, server.performance_monitor) if tracing else None
+        
+        room_id = server.room_manager.create_room('traced')
+        clients = [
+            SimulatedClient('sender', -5_000_000_000, CODEC_BINARY),
+            SimulatedClient('member_1', 3_000_000_000, CODEC_JSON),
+            SimulatedClient('member_2', 40_000_000, CODEC_BINARY)
+        ]
+        for client in clients:
+            add_client(server, client.client_id, client.connection, room_id)
+        return server, room_id, clients
+    
+    def wire(self, message, codec):
+        """message as the server reads it off a connection: decoded from its frame"""
+        return Message.from_bytes(message.to_bytes(codec)[4:])
+    
+    async def send_text(self, server, sender, text, trace=True):
+        now = time.monotonic_ns()
+        message = Message(MessageType.TEXT_MESSAGE, {'text': text})
+        if trace:
+            message.data['trace'] = {'id': f"{text:>16}", 'sent': sender.clock(now - UPLINK)}
+        received = self.wire(message, sender.connection.codec)
+        received.received = now
+        await server._process_message(sender.client_id, received, sender.connection)
+    
+    async def send_receipts(self, server, member, claimed=None):
+        """What ChatClient does for each traced message it receives; returns the traces.
+        claimed: a receive time the member reports instead of its real one"""
+        frames, member.connection.frames = member.connection.frames, []
+        traces = []
+        for frame in frames:
+            message = Message.from_bytes(frame[4:])
+            trace = message.data.get('trace')
+            if not trace:
+                continue
+            traces.append(trace)
+            delivered = time.monotonic_ns() + DOWNLINK
+            receipt = Message(
+                MessageType.TRACE_RECEIPT,
+                {'id': trace['id'], 'sent': trace['sent'],
+                 'received': member.clock(delivered) if claimed is None else claimed},
+                room_id=message.room_id
+            )
+            received = self.wire(receipt, member.connection.codec)
+            received.received = delivered + UPLINK
+            await server._process_message(member.client_id, received, member.connection)
+        return traces
+    
+    async def send_receipt(self, server, member, data):
+        receipt = self.wire(Message(MessageType.TRACE_RECEIPT, data), CODEC_JSON)
+        receipt.received = time.monotonic_ns()
+        await server._process_message(member.client_id, receipt, member.connection)
+    
+    async def traced_latency(self, directory):
+        server, room_id, (sender, *members) = self.make_server(directory)
+        for i in range(self.num_messages):
+            await self.send_text(server, sender, f"message {i}")
+            for member in members:
+                await self.send_receipts(server, member)
+        
+        # A member claiming it got a message before it was sent is counted as 0, not negative
+        await self.send_text(server, sender, 'early')
+        trace, = await self.send_receipts(server, members[0], claimed=0)
+        
+        # Refused: a second receipt for the same trace, one for a trace never
+        # delivered, and one from the sender, who did not receive it
+        now = time.monotonic_ns()
+        await self.send_receipt(server, members[0], {'id': trace['id'], 'sent': trace['sent'], 'received': now})
+        await self.send_receipt(server, members[1], {'id': 'made up', 'sent': trace['sent'], 'received': now})
+        await self.send_receipt(server, sender, {'id': trace['id'], 'sent': trace['sent'], 'received': now})
+        
+        history, _, _, _ = server.room_manager.get_history(room_id, CODEC_JSON)
+        server.message_log.close()
+        return server, room_id, history
+    
+    async def untraced_cost(self, directory, rounds=31, runs=500):
+        """Median ns per untraced text message with tracing off and on"""
+        setups = {tracing: self.make_server(Path(directory) / str(tracing), tracing) for tracing in (False, True)}
+        timings = {False: [], True: []}
+        for round_num in range(rounds):
+            # Short rounds, alternated and in turns going first, so both see the same machine
+            for tracing in ((False, True) if round_num % 2 else (True, False)):
+                server, _, (sender, *members) = setups[tracing]
+                start = time.perf_counter_ns()
+                for i in range(runs):
+                    await self.send_text(server, sender, 'x', trace=False)
+                timings[tracing].append((time.perf_counter_ns() - start) / runs)
+                for member in members:
+                    member.connection.frames.clear()
+        for server, _, _ in setups.values():
+            server.message_log.close()
+        return statistics.median(timings[False]), statistics.median(timings[True])
+    
+    async def run_test(self):
+        print("Latency tracing test")
+        with tempfile.TemporaryDirectory() as directory:
+            server, room_id, history = await self.traced_latency(directory)
+        tracer = server.tracer
+        stats = tracer.get_stats()
+        room = stats['rooms_ms'][room_id]
+        expected_ms = (UPLINK + DOWNLINK) / 1e6
+        print(f"{stats['traced']} traced, {stats['receipts']} receipts | send to delivery "
+              f"p50 {room['p50']:.2f} ms, p99 {room['p99']:.2f} ms (network alone {expected_ms:.0f} ms) | "
+              f"queue wait p50 {stats['stages_ms']['queue_wait']['p50']:.3f} ms, "
+              f"handler p50 {stats['stages_ms']['handler']['p50']:.3f} ms")
+        
+        receipts = 2 * self.num_messages + 1
+        if stats['traced'] == self.num_messages + 1 and stats['receipts'] == receipts:
+            print("Every traced message got a receipt from every member ✓")
+        else:
+            print("FAILED: traces or receipts missing")
+            sys.exit(1)
+        
+        if stats['invalid'] == 3:
+            print("Duplicate, unknown and misdirected receipts are refused ✓")
+        else:
+            print(f"FAILED: {stats['invalid']} receipts refused, expected 3")
+            sys.exit(1)
+        
+        # Clocks seconds apart, yet latency comes out as the network time plus the server's
+        if expected_ms <= room['p50'] < expected_ms + 5 and room['count'] == receipts:
+            print("Latency measured across skewed client clocks ✓")
+        else:
+            print("FAILED: latency not recovered from skewed clocks")
+            sys.exit(1)
+        
+        monitor_latency = server.performance_monitor.get_current_stats()['latency_ms']
+        if monitor_latency['count'] == receipts and tracer.rooms[room_id].counts[0] == 1:
+            print("Receipts feed the monitor's latency histogram, a negative latency counts as 0 ✓")
+        else:
+            print("FAILED: latency not recorded in the monitor")
+            sys.exit(1)
+        
+        if history and not any(b'trace' in frame for frame in history):
+            print("Room history is stored without traces ✓")
+        else:
+            print("FAILED: traces kept in room history")
+            sys.exit(1)
+        
+        for member in ('sender', 'member_1', 'member_2'):
+            server._leave_room(room_id, member)
+        if room_id not in tracer.rooms and room_id not in tracer.outstanding:
+            print("A deleted room's latency figures are dropped ✓")
+        else:
+            print("FAILED: tracer keeps figures of a deleted room")
+            sys.exit(1)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            off, on = await self.untraced_cost(directory)
+        print(f"Untraced text message: median {off / 1000:.1f} µs with tracing off, {on / 1000:.1f} µs with it on")
+        # The tracing path adds a flag check; the margin is for a noisy machine, not for tracing
+        if on < off * 1.25:
+            print("Messages outside the sample cost next to nothing ✓")
+        else:
+            print("FAILED: tracing slows down untraced messages")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    asyncio.run(LatencyTracingTest(num_messages).run_test())
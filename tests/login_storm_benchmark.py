@@ -0,0 +1,96 @@
+import asyncio
+import sys
+import time
+import tempfile
+import json
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.security import SecurityManager
+from user_manager import UserManager
+
+class LoginStormBenchmark:
+    def __init__(self, num_logins=500, chat_interval=0.01):
+        self.num_logins = num_logins
+        self.chat_interval = chat_interval
+        self.password = "testpass123"
+    
+    def _make_user_manager(self, tmp_dir):
+        # All accounts share one real bcrypt hash so setup stays fast
+        hashed = SecurityManager.hash_password(self.password).decode('utf-8')
+        users = {
+            f"storm_{i}": {
+                'id': f"id_{i}",
+                'username': f"storm_{i}",
+                'password': hashed,
+                'created': 'benchmark'
+            }
+            for i in range(self.num_logins)
+        }
+        db_file = Path(tmp_dir) / 'users.json'
+        with open(db_file, 'w') as f:
+            json.dump(users, f)
+        return UserManager(db_file=db_file)
+    
+    async def _chat_probe(self, stop, delays):
+        # Stands in for chat traffic: how late does a frame scheduled now get to run?
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            expected = loop.time() + self.chat_interval
+            await asyncio.sleep(self.chat_interval)
+            delays.append(max(0.0, loop.time() - expected))
+    
+    async def _storm(self, login):
+        delays = []
+        stop = asyncio.Event()
+        probe = asyncio.create_task(self._chat_probe(stop, delays))
+        await asyncio.sleep(self.chat_interval * 2)
+        
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            login(f"storm_{i}") for i in range(self.num_logins)
+        ])
+        duration = time.perf_counter() - start
+        
+        stop.set()
+        await probe
+        
+        delays.sort()
+        return {
+            'duration': duration,
+            'ok': sum(1 for success, _ in results if success),
+            'p50_ms': delays[len(delays) // 2] * 1000 if delays else 0,
+            'p99_ms': delays[int(len(delays) * 0.99)] * 1000 if delays else 0,
+            'max_ms': delays[-1] * 1000 if delays else 0
+        }
+    
+    async def run(self):
+        print(f"Login storm benchmark: {self.num_logins} concurrent logins")
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            user_manager = self._make_user_manager(tmp_dir)
+            
+            async def inline_login(username):
+                # Previous behaviour: bcrypt on the event loop
+                await asyncio.sleep(0)
+                return user_manager.authenticate(username, self.password)
+            
+            async def offloaded_login(username):
+                return await user_manager.authenticate_async(username, self.password)
+            
+            for name, login in [('on event loop', inline_login), ('executor', offloaded_login)]:
+                result = await self._storm(login)
+                print(f"{name:>14}: {result['ok']}/{self.num_logins} logins in {result['duration']:.1f} s | "
+                      f"chat delay p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, "
+                      f"max {result['max_ms']:.1f} ms")
+                for i in range(self.num_logins):
+                    user_manager.logout(f"storm_{i}")
+            
+            print(f"Hash queue: {user_manager.get_hash_stats()}")
+
+if __name__ == "__main__":
+    num_logins = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    benchmark = LoginStormBenchmark(num_logins=num_logins)
+    asyncio.run(benchmark.run())
@@ -0,0 +1,182 @@
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType, CODEC_JSON, CODEC_BINARY, BINARY_MAGIC
+from room_manager import RoomManager
+from message_log import MessageLog
+from tests.bare_server import make_bare_server, add_client, NullConnection, RecordingConnection, NullLog
+
+def last_reply(connection):
+    """The last message sent on connection. Replayed history goes out as one
+    write of many frames; those are not replies"""
+    for frame in reversed(connection.frames):
+        if len(frame) == 4 + int.from_bytes(frame[:4], 'big'):
+            return Message.from_bytes(frame[4:])
+
+class MessageLogBenchmark:
+    def __init__(self, num_messages=500000, num_rooms=50, room_size=20):
+        self.num_messages = num_messages
+        self.num_rooms = num_rooms
+        self.room_size = room_size
+    
+    def _frame(self, i, codec=CODEC_JSON):
+        return Message(
+            MessageType.TEXT_MESSAGE,
+            {
+                'username': f"user_{i % 100}",
+                'text': f"message {i} " + "x" * 100,
+                'timestamp': '2025-01-01T00:00:00'
+            },
+            room_id='bench'
+        ).to_bytes(codec)
+    
+    async def _sustained_appends(self, log):
+        # Appends arrive from the event loop in bursts, as handlers run
+        frames = [self._frame(i) for i in range(1000)]
+        rooms = [f"room_{i}" for i in range(self.num_rooms)]
+        max_pending = 0
+        start = time.perf_counter()
+        for i in range(self.num_messages):
+            log.append(rooms[i % self.num_rooms], i // self.num_rooms + 1, frames[i % 1000])
+            if i % 1000 == 999:
+                max_pending = max(max_pending, len(log.pending))
+                await asyncio.sleep(0)
+        queued = time.perf_counter() - start
+        
+        while log.stats['written'] < self.num_messages:
+            await asyncio.sleep(0.01)
+        drained = time.perf_counter() - start
+        return queued, drained, max_pending
+    
+    def _make_server(self, message_log):
+        server = make_bare_server(message_log=message_log)
+        room_id = server.room_manager.create_room('bench')
+        for i in range(self.room_size):
+            add_client(server, f"client_{i}", NullConnection(), room_id, f"user_{i}")
+        return server
+    
+    async def _handler_latency(self, message_log, iterations=20000):
+        server = self._make_server(message_log)
+        message = Message(MessageType.TEXT_MESSAGE, {'text': 'The quick brown fox jumps over the lazy dog'})
+        timings = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            await server._handle_text_message('client_0', message, None)
+            timings.append(time.perf_counter() - start)
+            if i % 100 == 99:
+                await asyncio.sleep(0)
+        timings.sort()
+        return timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6
+    
+    async def _history_requests(self, message_log):
+        """Page sizes a client asks for are checked, and clamped to what a room keeps.
+        Requests go through a codec as they would off the wire; ids a client took
+        from binary frame headers are floats"""
+        server = self._make_server(message_log)
+        server.history_on_join = 50
+        text = Message(MessageType.TEXT_MESSAGE, {'text': 'hello'})
+        for _ in range(server.room_manager.history_messages + 50):
+            await server._handle_text_message('client_0', text, None)
+        
+        connection = RecordingConnection()
+        replies = {}
+        last_id = server.room_manager.history_messages + 50
+        for label, data, codec in (
+            ('huge', {'limit': 10 ** 9}, CODEC_JSON), ('zero', {'limit': 0}, CODEC_JSON),
+            ('default', {}, CODEC_JSON),
+            # What the client's /history <id> sends, in either codec
+            ('client', {'since': last_id - 5}, CODEC_JSON), ('binary', {'since': last_id - 5}, CODEC_BINARY),
+            ('float', {'since': float(last_id - 10), 'limit': 3.0}, CODEC_JSON),
+            ('negative', {'limit': -1}, CODEC_JSON), ('text', {'limit': 'all'}, CODEC_JSON),
+            ('since', {'since': 'x'}, CODEC_JSON), ('fraction', {'since': 1.5}, CODEC_JSON)
+        ):
+            request = Message.from_bytes(Message(MessageType.HISTORY, data).to_bytes(codec)[4:])
+            await server._handle_history('client_1', request, connection)
+            replies[label] = last_reply(connection)
+        counts = {label: reply.data.get('count') for label, reply in replies.items() if reply.type == MessageType.HISTORY}
+        refused = [label for label, reply in replies.items() if reply.type == MessageType.ERROR]
+        return counts, refused
+    
+    async def run_test(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = MessageLog(Path(tmp) / 'rooms')
+            print(f"Message log benchmark: {self.num_messages} appends across {self.num_rooms} rooms")
+            
+            queued, drained, max_pending = await self._sustained_appends(log)
+            stats = log.get_stats()
+            print(f"   appends: {self.num_messages / queued:>9.0f} msg/s queued | "
+                  f"{self.num_messages / drained:>9.0f} msg/s on disk | max backlog {max_pending}")
+            print(f"    writes: {stats['flushes']} group commits, {stats['fsyncs']} fsyncs, "
+                  f"max flush {stats['max_flush_ms']:.1f} ms, {stats['disk_bytes'] / (1024 * 1024):.1f} MB")
+            
+            # Replay a range from the middle of a room through the sparse index and mmap
+            per_room = self.num_messages // self.num_rooms
+            start = time.perf_counter()
+            reads = 200
+            for i in range(reads):
+                records = log.read('room_7', since=(i * 37) % (per_room - 100), limit=100)
+            replay = (time.perf_counter() - start) / reads
+            print(f"    replay: 100 messages in {replay * 1e6:.0f} µs "
+                  f"(ids {records[0][0]}-{records[-1][0]})")
+            
+            baseline = await self._handler_latency(NullLog())
+            logged = await self._handler_latency(log)
+            print(f"   handler: p50 {baseline[0]:.1f} µs / p99 {baseline[1]:.1f} µs without log | "
+                  f"p50 {logged[0]:.1f} µs / p99 {logged[1]:.1f} µs with log")
+            log.close()
+            
+            # Everything flushed survives a restart
+            reopened = MessageLog(Path(tmp) / 'rooms')
+            records = reopened.read('room_3', since=0, limit=per_room + 1)
+            reopened.close()
+            if len(records) == per_room and records[-1][0] == per_room:
+                print(f"Restart: all {per_room} messages of room_3 replayed from disk ✓")
+            else:
+                print(f"FAILED: replayed {len(records)} of {per_room} messages after restart")
+                sys.exit(1)
+            
+            # A room logged in the binary codec, replayed to a peer speaking JSON
+            # after a restart, long after anyone wrote to it
+            quiet = MessageLog(Path(tmp) / 'quiet', segment_bytes=4096)
+            for i in range(1, 201):
+                quiet.append('room_q', i, self._frame(i, CODEC_BINARY))
+            quiet.close()
+            written = len(list((Path(tmp) / 'quiet' / 'room_q').glob('*.log')))
+            reopened = MessageLog(Path(tmp) / 'quiet', retention_bytes=12 * 1024)
+            server = self._make_server(reopened)
+            records = server._read_room_log('room_q', CODEC_JSON, 0, 1000)
+            if records and all(frame[4] != BINARY_MAGIC for _, frame in records):
+                print(f"Replay: {len(records)} binary-logged messages re-encoded for a JSON peer ✓")
+            else:
+                print("FAILED: binary frames replayed to a JSON peer")
+                sys.exit(1)
+            
+            reopened.apply_retention()  # what the writer thread runs every retention_interval
+            left = len(list((Path(tmp) / 'quiet' / 'room_q').glob('*.log')))
+            reopened.close()
+            if 1 < left < written:
+                print(f"Retention: a room nobody writes to trimmed from {written} to {left} segments ✓")
+            else:
+                print(f"FAILED: retention left {left} of {written} segments of a quiet room")
+                sys.exit(1)
+            
+            history_log = MessageLog(Path(tmp) / 'history')
+            counts, refused = await self._history_requests(history_log)
+            history_log.close()
+            kept = RoomManager().history_messages
+            if (counts == {'huge': kept, 'zero': 0, 'default': 50, 'client': 5, 'binary': 5, 'float': 3}
+                    and refused == ['negative', 'text', 'since', 'fraction']):
+                print(f"History requests: limits clamped to {kept}, invalid ones refused ✓")
+            else:
+                print(f"FAILED: history requests answered {counts}, refused {refused}")
+                sys.exit(1)
+
+if __name__ == "__main__":
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    asyncio.run(MessageLogBenchmark(num_messages=num_messages).run_test())
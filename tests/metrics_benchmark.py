@@ -0,0 +1,196 @@
+import random
+import sys
+import time
+from collections import deque, defaultdict
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from metrics import Histogram, QUANTILES
+from performance_monitor import PerformanceMonitor
+
+class LegacyMonitor:
+    """The recording side of PerformanceMonitor as it was, kept for comparison"""
+    def __init__(self, window_size=1000):
+        self.metrics = {
+            'messages_sent': 0,
+            'bytes_transferred': 0,
+            'processing_times': deque(maxlen=window_size),
+            'message_latencies': deque(maxlen=window_size)
+        }
+        self.hourly_stats = defaultdict(lambda: {'messages': 0, 'bytes': 0, 'avg_latency': 0})
+    
+    def record_message(self, size_bytes):
+        self.metrics['messages_sent'] += 1
+        self.metrics['bytes_transferred'] += size_bytes
+        hour_key = datetime.now().strftime('%Y-%m-%d %H:00')
+        self.hourly_stats[hour_key]['messages'] += 1
+        self.hourly_stats[hour_key]['bytes'] += size_bytes
+    
+    def record_processing_time(self, time_seconds):
+        self.metrics['processing_times'].append(time_seconds)
+    
+    def record_latency(self, latency_ms):
+        self.metrics['message_latencies'].append(latency_ms)
+        hour_key = datetime.now().strftime('%Y-%m-%d %H:00')
+        stats = self.hourly_stats[hour_key]
+        if stats['avg_latency'] == 0:
+            stats['avg_latency'] = latency_ms
+        else:
+            stats['avg_latency'] = (stats['avg_latency'] + latency_ms) / 2
+
+class MetricsBenchmark:
+    """Nanoseconds per recorded sample, old monitor against the new one"""
+    def __init__(self, samples=50000, budget_ns=200, attempts=5):
+        self.samples = samples
+        self.budget_ns = budget_ns
+        self.attempts = attempts  # measurements before a record over budget is a failure
+        random.seed(11)
+        # Handler times of 20 µs to 20 ms, long tailed like the real thing
+        self.values = [int(random.lognormvariate(11, 1.2)) for _ in range(samples)]
+    
+    def _per_call(self, record, values):
+        # Best batch of a pass: other work on the machine only ever adds time
+        best = float('inf')
+        for i in range(0, len(values), 5000):
+            batch = values[i:i + 5000]
+            start = time.perf_counter_ns()
+            for value in batch:
+                record(value)
+            best = min(best, (time.perf_counter_ns() - start) / len(batch))
+        return best
+    
+    def _loop_cost(self, values):
+        best = float('inf')
+        for i in range(0, len(values), 5000):
+            batch = values[i:i + 5000]
+            start = time.perf_counter_ns()
+            for value in batch:
+                pass
+            best = min(best, (time.perf_counter_ns() - start) / len(batch))
+        return best
+    
+    def measure(self, rounds=9):
+        legacy, monitor = LegacyMonitor(), PerformanceMonitor()
+        seconds = [value / 1e9 for value in self.values]
+        milliseconds = [value / 1e6 for value in self.values]
+        calls = {
+            'record_message': (
+                (legacy.record_message, self.values), (monitor.record_message, self.values)
+            ),
+            'record_processing_time': (
+                (legacy.record_processing_time, seconds), (monitor.record_processing_time, self.values)
+            ),
+            'record_latency': (
+                (legacy.record_latency, milliseconds), (monitor.record_latency, self.values)
+            )
+        }
+        # Rounds take turns over every call, so a stretch of time when the
+        # machine is busy slows one round of each rather than all of one
+        best = {name: [float('inf'), float('inf')] for name in calls}
+        loop = float('inf')
+        for _ in range(rounds):
+            loop = min(loop, self._loop_cost(self.values))
+            for name, sides in calls.items():
+                for side, (record, values) in enumerate(sides):
+                    best[name][side] = min(best[name][side], self._per_call(record, values))
+        # Less the cost of the loop itself
+        return {name: (old - loop, new - loop) for name, (old, new) in best.items()}
+    
+    def quantiles_accurate(self):
+        histogram = Histogram()
+        for value in self.values:
+            histogram.record(value)
+        summary = histogram.summary()
+        ordered = sorted(self.values)
+        for name, q in QUANTILES.items():
+            exact = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            if abs(summary[name] - exact) > exact * 0.02:
+                print(f"  {name}: {summary[name]:.0f} against {exact}")
+                return False
+        return summary['count'] == len(self.values)
+    
+    def max_depth_tracked(self, num_clients=100000):
+        """The deepest send queue stays right as queues fill, drain and close,
+        and reading it does not go over every client"""
+        monitor = PerformanceMonitor()
+        depths = {}
+        for i in range(num_clients):
+            depths[i] = random.randrange(50)
+            monitor.record_send_queue(i, depths[i])
+        for step, i in enumerate(random.sample(range(num_clients), num_clients // 2)):
+            if random.random() < 0.5:
+                depths[i] = random.randrange(200)
+                monitor.record_send_queue(i, depths[i])
+            else:
+                del depths[i]
+                monitor.remove_send_queue(i)
+            if step % 5000 == 0 and monitor.max_send_queue_depth != max(depths.values()):
+                return False
+        # The deepest queues drain one after another
+        for i in sorted(depths, key=depths.get, reverse=True)[:100]:
+            depths[i] = 0
+            monitor.record_send_queue(i, 0)
+            if monitor.max_send_queue_depth != max(depths.values()):
+                return False
+        
+        start = time.perf_counter()
+        monitor.get_current_stats()
+        elapsed = time.perf_counter() - start
+        print(f"get_current_stats with {num_clients} send queues: {elapsed * 1000:.2f} ms")
+        return True
+    
+    def run_test(self):
+        print(f"Metrics benchmark: {self.samples} samples, ns per record")
+        print(f"{'call':>24} | {'legacy':>7} | {'new':>7}")
+        print("-" * 44)
+        results = self.measure()
+        # A busy machine only ever adds time, for seconds on end on a shared
+        # host: measure again, keeping each call's best, before calling it a miss
+        for _ in range(self.attempts - 1):
+            if max(new for _, new in results.values()) < self.budget_ns:
+                break
+            again = self.measure()
+            results = {name: (min(old, again[name][0]), min(new, again[name][1]))
+                       for name, (old, new) in results.items()}
+        for name, (old, new) in results.items():
+            print(f"{name:>24} | {old:>7.0f} | {new:>7.0f}")
+        slowest = max(new for _, new in results.values())
+        
+        monitor = PerformanceMonitor()
+        for value in self.values:
+            monitor.record_processing_time(value)
+        start = time.perf_counter()
+        monitor.get_current_stats()
+        print(f"get_current_stats with {self.samples} samples recorded: "
+              f"{(time.perf_counter() - start) * 1000:.2f} ms")
+        
+        if slowest < self.budget_ns:
+            print(f"Every record under {self.budget_ns} ns ✓")
+        else:
+            print(f"FAILED: slowest record {slowest:.0f} ns, over the {self.budget_ns} ns budget")
+            sys.exit(1)
+        
+        if all(new < old for name, (old, new) in results.items() if name != 'record_processing_time'):
+            print("Message and latency records cheaper than before ✓")
+        else:
+            print("FAILED: recording got slower")
+            sys.exit(1)
+        
+        if self.max_depth_tracked():
+            print("Deepest send queue tracked as queues fill, drain and close ✓")
+        else:
+            print("FAILED: max_send_queue_depth wrong")
+            sys.exit(1)
+        
+        if self.quantiles_accurate():
+            print("p50/p95/p99/p999 within 2% of the exact values ✓")
+        else:
+            print("FAILED: histogram quantiles off by more than 2%")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    MetricsBenchmark(samples=samples).run_test()
@@ -0,0 +1,141 @@
+import asyncio
+import re
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import MessageType, Priority
+from metrics import LoopLagProbe, render_prometheus
+from metrics_endpoint import MetricsEndpoint
+from tests.bare_server import make_bare_server, add_client
+
+SAMPLE_LINE = re.compile(r'^[a-z_]+(\{[a-z_]+="(?:[^"\\]|\\.)*"(,[a-z_]+="(?:[^"\\]|\\.)*")*\})? \S+$')
+
+class MetricsEndpointTest:
+    def __init__(self, num_rooms=10):
+        self.num_rooms = num_rooms
+    
+    def make_server(self, num_clients):
+        server = make_bare_server()
+        server.performance_monitor.register_metric_source(server._metric_families)
+        
+        rooms = [server.room_manager.create_room(f"room \"{i}\"") for i in range(self.num_rooms)]
+        for i in range(num_clients):
+            add_client(server, f"client_{i}", None, rooms[i % len(rooms)], f"user_{i}")
+        for room_id in rooms:
+            server.room_manager.next_message_id(room_id)
+        
+        monitor = server.performance_monitor
+        for i in range(1000):
+            monitor.record_message(100)
+            monitor.record_handled(MessageType.TEXT_MESSAGE, Priority.NORMAL, 20000 + i * 50)
+            monitor.record_handled(MessageType.HEARTBEAT, Priority.LOW, 3000)
+        monitor.record_outbound(4096)
+        return server
+    
+    async def scrape(self, connect, target='/metrics'):
+        reader, writer = await connect()
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        return head.split(b'\r\n')[0].decode(), body.decode()
+    
+    def exposition_valid(self, text):
+        histograms = {}
+        for line in text.splitlines():
+            if line.startswith('#'):
+                continue
+            if not SAMPLE_LINE.match(line):
+                print(f"  malformed line: {line}")
+                return False
+            if '_bucket{' in line:
+                series = re.sub(r',?le="[^"]*"', '', line.split(' ')[0])
+                histograms.setdefault(series, []).append(float(line.split(' ')[1]))
+            if '_count' in line.split(' ')[0]:
+                series = line.split(' ')[0].replace('_count', '_bucket')
+                if series.endswith('_bucket'):
+                    series += '{}'
+                counts = histograms.get(series, [])
+                # Buckets are cumulative, and +Inf holds every value
+                if counts != sorted(counts) or not counts or counts[-1] != float(line.split(' ')[1]):
+                    print(f"  inconsistent histogram: {series}")
+                    return False
+        return True
+    
+    def scrape_time(self, num_clients, runs=20):
+        server = self.make_server(num_clients)
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            render_prometheus(server.performance_monitor.metric_families())
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+    
+    async def loop_lag_seen(self):
+        probe = LoopLagProbe(interval=0.05)
+        probe.start()
+        await asyncio.sleep(0.1)
+        time.sleep(0.3)  # a handler hogging the loop
+        await asyncio.sleep(0.1)
+        probe.stop()
+        return probe.lag.summary()['max'] >= 0.2e9
+    
+    async def run_test(self):
+        print("Metrics endpoint test")
+        server = self.make_server(100)
+        endpoint = MetricsEndpoint(server.performance_monitor.metric_families, port=0)
+        await endpoint.start()
+        status, text = await self.scrape(lambda: asyncio.open_connection('127.0.0.1', endpoint.port))
+        missing_status, _ = await self.scrape(lambda: asyncio.open_connection('127.0.0.1', endpoint.port), '/')
+        await endpoint.close()
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / 'metrics.sock')
+            endpoint = MetricsEndpoint(server.performance_monitor.metric_families, path=path)
+            await endpoint.start()
+            unix_status, unix_text = await self.scrape(lambda: asyncio.open_unix_connection(path))
+            await endpoint.close()
+        
+        expected = [
+            'chat_handler_seconds_count{type="text_message",priority="NORMAL"} 1000',
+            'chat_handler_seconds_count{type="heartbeat",priority="LOW"} 1000',
+            'chat_qos_queue_depth{priority="CRITICAL"} 0',
+            'chat_outbound_queued_bytes 4096',
+            'chat_room_members{room="',
+            'name="room \\"0\\""} 10'
+        ]
+        if (status.endswith('200 OK') and unix_status.endswith('200 OK') and missing_status.endswith('404 Not Found')
+                and all(part in text for part in expected) and 'chat_frames_received_total 1000' in unix_text):
+            print(f"Scraped over TCP and a Unix socket, {len(text.splitlines())} lines ✓")
+        else:
+            print(f"FAILED: unexpected scrape ({status}, {unix_status}, {missing_status})")
+            sys.exit(1)
+        
+        if self.exposition_valid(text):
+            print("Exposition format well formed, histograms cumulative ✓")
+        else:
+            print("FAILED: malformed exposition")
+            sys.exit(1)
+        
+        few, many = self.scrape_time(100), self.scrape_time(100000)
+        print(f"Scrape with 100 clients: {few * 1000:.2f} ms | with 100000 clients: {many * 1000:.2f} ms")
+        if many < few * 3:
+            print("Scrape cost does not grow with the number of clients ✓")
+        else:
+            print("FAILED: scrape cost grows with the number of clients")
+            sys.exit(1)
+        
+        if await self.loop_lag_seen():
+            print("A 300 ms stall of the event loop shows up as loop lag ✓")
+        else:
+            print("FAILED: event loop stall not measured")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(MetricsEndpointTest().run_test())
@@ -0,0 +1,199 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from common.protocol import Message, MessageType
+
+ROOT = Path(__file__).parent.parent
+
+class LoadClient:
+    """Bare protocol client; the UI client does far more work per message than we want to measure"""
+    def __init__(self, port):
+        self.port = port
+    
+    async def connect(self):
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port, ssl=ssl_context)
+    
+    def send(self, message):
+        self.writer.write(message.to_bytes())
+    
+    async def receive(self):
+        length = struct.unpack('!I', await self.reader.readexactly(4))[0]
+        return Message.from_bytes(await self.reader.readexactly(length))
+    
+    async def expect(self, msg_type):
+        while True:
+            message = await self.receive()
+            if message.type == msg_type:
+                return message
+    
+    async def login(self, username):
+        self.send(Message(MessageType.REGISTER_REQUEST, {'username': username, 'password': 'loadpass123'}))
+        await self.expect(MessageType.REGISTER_RESPONSE)
+        self.send(Message(MessageType.AUTH_REQUEST, {'username': username, 'password': 'loadpass123'}))
+        response = await self.expect(MessageType.AUTH_RESPONSE)
+        if not response.data.get('success'):
+            raise RuntimeError(f"Login failed for {username}: {response.data}")
+
+async def _member(port, username, room_id, index, room_size, window, start_at, window_start, window_end, counts):
+    client = LoadClient(port)
+    await client.connect()
+    await client.login(username)
+    client.send(Message(MessageType.JOIN_ROOM, {'room_id': room_id}))
+    await client.expect(MessageType.SUCCESS)
+    
+    await asyncio.sleep(max(0, start_at - time.time()))
+    # A fixed number of tokens circulates around each room: whoever a message
+    # names sends the next one, so load follows what the server can deliver
+    if index == 0:
+        for _ in range(window):
+            client.send(Message(MessageType.TEXT_MESSAGE, {'text': str(1 % room_size)}))
+    
+    while time.time() < window_end:
+        try:
+            message = await asyncio.wait_for(client.receive(), window_end - time.time())
+        except asyncio.TimeoutError:
+            break
+        if message.type != MessageType.TEXT_MESSAGE:
+            continue
+        if window_start <= time.time() < window_end:
+            counts[0] += 1
+        if message.data['text'] == str(index):
+            client.send(Message(MessageType.TEXT_MESSAGE, {'text': str((index + 1) % room_size)}))
+    client.writer.close()
+
+def _load_process(port, members, room_size, window, start_at, window_start, window_end, results):
+    async def run():
+        counts = [0]
+        await asyncio.gather(*[
+            _member(port, username, room_id, index, room_size, window, start_at, window_start, window_end, counts)
+            for username, room_id, index in members
+        ])
+        return counts[0]
+    results.put(asyncio.run(run()))
+
+class MultiWorkerBenchmark:
+    """Message throughput of the server run with 1, 2, 4... worker processes.
+
+    Load comes from separate client processes, with each room's members
+    spread over them, so members of a room usually land on different
+    workers and every message crosses the room bus. Run from the
+    repository root, after generating certificates/ as described in the
+    README. Scaling needs at least as many free cores as workers.
+    """
+    def __init__(self, worker_counts=(1, 2, 4), num_rooms=24, room_size=4, window=8, duration=10,
+                 load_processes=4, port=8897):
+        self.worker_counts = worker_counts
+        self.num_rooms = num_rooms
+        self.room_size = room_size
+        self.window = window
+        self.duration = duration
+        self.load_processes = load_processes
+        self.port = port
+    
+    async def _wait_for_server(self, timeout=15):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                client = LoadClient(self.port)
+                await client.connect()
+                client.writer.close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+    
+    async def _create_rooms(self, tag):
+        admin = LoadClient(self.port)
+        await admin.connect()
+        await admin.login(f"admin_{tag}")
+        room_ids = []
+        for i in range(self.num_rooms):
+            admin.send(Message(MessageType.CREATE_ROOM, {'name': f"load_{i}"}))
+            room_ids.append((await admin.expect(MessageType.SUCCESS)).data['room_id'])
+        return admin, room_ids
+    
+    async def _measure(self, workers, work_dir):
+        server = subprocess.Popen(
+            [sys.executable, str(ROOT / 'server' / 'server.py'),
+             '--host', '127.0.0.1', '--port', str(self.port), '--workers', str(workers)],
+            cwd=work_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        try:
+            await self._wait_for_server()
+            await asyncio.sleep(1)  # let every worker bind the port
+            tag = f"{workers}_{int(time.time())}"
+            admin, room_ids = await self._create_rooms(tag)
+            
+            # Member i of every room goes to load process i % load_processes
+            plans = [[] for _ in range(self.load_processes)]
+            for r, room_id in enumerate(room_ids):
+                for index in range(self.room_size):
+                    plans[(r + index) % self.load_processes].append((f"load_{tag}_{r}_{index}", room_id, index))
+            
+            context = multiprocessing.get_context('spawn')
+            results = context.Queue()
+            start_at = time.time() + 5 + self.num_rooms * self.room_size * 0.02
+            window_start = start_at + 2
+            window_end = window_start + self.duration
+            processes = [
+                context.Process(
+                    target=_load_process,
+                    args=(self.port, plan, self.room_size, self.window, start_at, window_start, window_end, results)
+                )
+                for plan in plans
+            ]
+            for process in processes:
+                process.start()
+            
+            loop = asyncio.get_running_loop()
+            delivered = 0
+            for _ in processes:
+                delivered += await loop.run_in_executor(None, results.get, True, window_end - time.time() + 60)
+            for process in processes:
+                process.join()
+            admin.writer.close()
+            return delivered / self.duration
+        finally:
+            server.send_signal(signal.SIGINT)
+            await asyncio.get_running_loop().run_in_executor(None, server.wait, 30)
+    
+    async def run_test(self):
+        print(f"Multi-worker benchmark: {self.num_rooms} rooms x {self.room_size} members, "
+              f"{self.window} messages in flight per room, {self.duration}s per run, "
+              f"{os.cpu_count()} CPUs")
+        
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            (Path(tmp) / 'certificates').symlink_to(Path('certificates').resolve())
+            for workers in self.worker_counts:
+                results[workers] = await self._measure(workers, tmp)
+                base = results[self.worker_counts[0]]
+                print(f"  {workers:>2} workers: {results[workers]:>9.0f} deliveries/s | "
+                      f"{results[workers] / base:4.2f}x")
+        
+        if all(rate > 0 for rate in results.values()):
+            print("Messages delivered at every worker count ✓")
+        else:
+            print("FAILED: some runs delivered no messages")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    counts = tuple(int(n) for n in sys.argv[1].split(',')) if len(sys.argv) > 1 else (1, 2, 4)
+    asyncio.run(MultiWorkerBenchmark(worker_counts=counts).run_test())
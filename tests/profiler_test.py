@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType
+from metrics import LoopLagProbe
+from profiler import SlowHandlerWatchdog, SamplingProfiler
+from tests.bare_server import make_bare_server
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class LogRecords(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+    
+    def emit(self, record):
+        self.records.append(record)
+    
+    def levels(self, text):
+        return [record.levelname for record in self.records if text in record.getMessage()]
+
+class ProfilerTest:
+    """Handlers blocking the loop are caught with a stack naming them, waiting
+    and fast ones are not, and the sampling profiler writes folded stacks of
+    the event loop"""
+    def make_server(self, threshold=0.1, wait_threshold=0.2):
+        server = make_bare_server(loop_probe=LoopLagProbe(interval=0.05))
+        if threshold:
+            server.watchdog = SlowHandlerWatchdog(threshold, server.loop_probe, wait_threshold=wait_threshold)
+        
+        async def _handle_heartbeat(client_id, message, writer):
+            pass
+        
+        async def _handle_text_message(client_id, message, writer):
+            time.sleep(0.3)  # blocking call on the event loop
+        
+        async def _handle_history(client_id, message, writer):
+            await asyncio.sleep(0.3)  # slow, but the loop stays free
+        
+        async def _handle_register(client_id, message, writer):
+            # Like password hashing: over the threshold, but in the executor
+            await asyncio.get_running_loop().run_in_executor(None, time.sleep, 0.15)
+        
+        server._handle_heartbeat = _handle_heartbeat
+        server._handle_text_message = _handle_text_message
+        server._handle_history = _handle_history
+        server._handle_register = _handle_register
+        return server
+    
+    async def slow_handlers_reported(self):
+        server = self.make_server()
+        log = LogRecords()
+        logger = logging.getLogger(SlowHandlerWatchdog.__module__)
+        logger.addHandler(log)
+        logger.setLevel(logging.DEBUG)
+        server.loop_probe.start()
+        server.watchdog.start()
+        for _ in range(100):
+            await server._process_message('client_0', Message(MessageType.HEARTBEAT, {}), None)
+        await server._process_message('client_0', Message(MessageType.TEXT_MESSAGE, {'content': 'hi'}), None)
+        await server._process_message('client_0', Message(MessageType.HISTORY, {}), None)
+        await server._process_message('client_0', Message(MessageType.REGISTER_REQUEST, {}), None)
+        await asyncio.sleep(0.2)
+        server.watchdog.stop()
+        server.loop_probe.stop()
+        logger.removeHandler(log)
+        return list(server.watchdog.reports), server.watchdog.waits, log
+    
+    async def begin_end_cost(self, runs=20000):
+        """ns added to each message by the watchdog bracket, against none at all"""
+        timings = {}
+        for threshold in (None, 0.1):
+            server = self.make_server(threshold)
+            message = Message(MessageType.HEARTBEAT, {})
+            best = float('inf')
+            for _ in range(5):
+                start = time.perf_counter_ns()
+                for _ in range(runs):
+                    await server._process_message('client_0', message, None)
+                best = min(best, (time.perf_counter_ns() - start) / runs)
+            timings[threshold] = best
+        return timings[0.1] - timings[None]
+    
+    async def profile_written(self, directory):
+        profiler = SamplingProfiler(interval=0.002, out_dir=directory)
+        profiler.start()
+        for _ in range(10):
+            busy_wait(0.02)
+            await asyncio.sleep(0)
+        path = profiler.stop()
+        lines = Path(path).read_text().splitlines()
+        return path, lines
+    
+    async def run_test(self):
+        print("Profiler test")
+        reports, waits, log = await self.slow_handlers_reported()
+        by_handler = {report['handler']: report for report in reports}
+        blocking = by_handler.get('_handle_text_message')
+        if (blocking and blocking['blocking_loop'] and blocking['type'] == 'text_message'
+                and any('_handle_text_message' in frame for frame in blocking['stack'])
+                and log.levels('_handle_text_message') == ['WARNING']):
+            print(f"Blocking handler reported after {blocking['elapsed_ms']:.0f} ms, "
+                  f"stack ends in {blocking['stack'][-1]} ✓")
+        else:
+            print(f"FAILED: blocking handler not reported with its stack: {reports}")
+            sys.exit(1)
+        
+        if (waits == {('_handle_history', 'history'): 1} and log.levels('_handle_history') == ['DEBUG']
+                and not log.levels('_handle_register')):
+            print("Waiting handlers only logged at DEBUG past the wait threshold; "
+                  "an executor-bound one under it not at all ✓")
+        else:
+            print(f"FAILED: waiting handlers reported: {dict(waits)}, "
+                  f"{[(r.levelname, r.getMessage()[:60]) for r in log.records]}")
+            sys.exit(1)
+        
+        if '_handle_heartbeat' not in by_handler and len(reports) == 1:
+            print("Fast handlers and handler stalls are not reported twice ✓")
+        else:
+            print(f"FAILED: unexpected reports: {[(r['handler'], r['elapsed_ms']) for r in reports]}")
+            sys.exit(1)
+        
+        cost = await self.begin_end_cost()
+        print(f"Watchdog bracket per message: {cost:.0f} ns")
+        if cost < 2000:
+            print("Watchdog overhead per message is negligible ✓")
+        else:
+            print("FAILED: watchdog adds too much per message")
+            sys.exit(1)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path, lines = await self.profile_written(directory)
+            samples = sum(int(line.rsplit(' ', 1)[1]) for line in lines)
+            busy = sum(int(line.rsplit(' ', 1)[1]) for line in lines if 'busy_wait' in line.rsplit(';', 1)[-1])
+            print(f"Profile {Path(path).name}: {samples} samples, {busy} in busy_wait")
+            if lines and busy > samples / 2 and all(';' in line for line in lines):
+                print("Sampling profiler writes folded stacks of the event loop ✓")
+            else:
+                print("FAILED: profile does not show where the loop spent its time")
+                sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(ProfilerTest().run_test())
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from common.protocol import Message, MessageType, Priority, CODEC_JSON, CODEC_BINARY
+
+def sample_messages():
+    room_id = str(uuid.uuid4())
+    return {
+        'text message': Message(
+            MessageType.TEXT_MESSAGE,
+            {
+                'username': 'alice',
+                'text': 'Hey, is everyone ready for the demo at three?',
+                'timestamp': '2025-09-06T15:44:47.123456'
+            },
+            room_id=room_id
+        ),
+        'user list (50)': Message(
+            MessageType.USER_LIST,
+            {'users': [f"user_{i}" for i in range(50)]},
+            room_id=room_id
+        ),
+        'file chunk (4 KB)': Message(
+            MessageType.FILE_CHUNK,
+            {
+                'transfer_id': os.urandom(16).hex(),
+                'filename': 'report.pdf',
+                'chunk_num': 42,
+                'total_chunks': 256,
+                'data': os.urandom(4096)
+            },
+            priority=Priority.LOW,
+            room_id=room_id
+        )
+    }
+
+class ProtocolBenchmark:
+    def __init__(self, iterations=20000):
+        self.iterations = iterations
+    
+    def _time(self, func, arg):
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            func(arg)
+        return (time.perf_counter() - start) / self.iterations * 1_000_000
+    
+    def run(self):
+        print(f"Protocol benchmark ({self.iterations} iterations per case)")
+        print(f"{'message':>18} | {'codec':>6} | {'bytes':>6} | {'encode':>9} | {'decode':>9}")
+        print("-" * 62)
+        
+        for name, message in sample_messages().items():
+            for codec in (CODEC_JSON, CODEC_BINARY):
+                frame = message.to_bytes(codec)
+                body = frame[4:]
+                encode_us = self._time(message.to_bytes, codec)
+                decode_us = self._time(Message.from_bytes, body)
+                print(f"{name:>18} | {codec:>6} | {len(frame):>6} | "
+                      f"{encode_us:>6.2f} us | {decode_us:>6.2f} us")
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    ProtocolBenchmark(iterations=iterations).run()
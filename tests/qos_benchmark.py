@@ -0,0 +1,137 @@
+import asyncio
+import heapq
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Priority
+from qos_manager import QoSManager
+
+@dataclass(order=True)
+class LegacyPriorityItem:
+    priority: int
+    count: int = field(compare=False)
+    func: Any = field(compare=False)
+    args: Any = field(compare=False)
+    kwargs: Any = field(compare=False)
+
+class LegacyQoSManager:
+    """The previous task-per-message scheduler, kept for comparison"""
+    def __init__(self, max_concurrent=10):
+        self.queues = {
+            Priority.CRITICAL: [],
+            Priority.HIGH: [],
+            Priority.NORMAL: [],
+            Priority.LOW: []
+        }
+        self.max_concurrent = max_concurrent
+        self.current_tasks = 0
+        self.counter = 0
+        self.lock = asyncio.Lock()
+    
+    async def enqueue(self, func, *args, priority=Priority.NORMAL, **kwargs):
+        async with self.lock:
+            self.counter += 1
+            item = LegacyPriorityItem(
+                priority=-priority.value,
+                count=self.counter,
+                func=func,
+                args=args,
+                kwargs=kwargs
+            )
+            heapq.heappush(self.queues[priority], item)
+        
+        asyncio.create_task(self._process_queue())
+    
+    async def _process_queue(self):
+        async with self.lock:
+            if self.current_tasks >= self.max_concurrent:
+                return
+            
+            for priority in [Priority.CRITICAL, Priority.HIGH, Priority.NORMAL, Priority.LOW]:
+                if self.queues[priority]:
+                    item = heapq.heappop(self.queues[priority])
+                    self.current_tasks += 1
+                    
+                    asyncio.create_task(self._execute_task(item))
+                    break
+    
+    async def _execute_task(self, item):
+        try:
+            await item.func(*item.args, **item.kwargs)
+        finally:
+            async with self.lock:
+                self.current_tasks -= 1
+            
+            asyncio.create_task(self._process_queue())
+
+class QoSBenchmark:
+    def __init__(self, num_messages=100000, num_producers=100):
+        self.num_messages = num_messages
+        self.num_producers = num_producers
+    
+    async def _run(self, scheduler):
+        latencies = []
+        done = asyncio.Event()
+        remaining = [self.num_messages]
+        priorities = [Priority.NORMAL] * 8 + [Priority.HIGH, Priority.LOW]
+        
+        async def handler(enqueued_at):
+            latencies.append(time.perf_counter() - enqueued_at)
+            # Simulate a handler that yields once, like a send or a lookup
+            await asyncio.sleep(0)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+        
+        async def producer(count, offset):
+            for i in range(count):
+                await scheduler.enqueue(
+                    handler,
+                    time.perf_counter(),
+                    priority=priorities[(offset + i) % len(priorities)]
+                )
+                # Producers are connection read loops; they yield between frames
+                if i % 10 == 0:
+                    await asyncio.sleep(0)
+        
+        per_producer = self.num_messages // self.num_producers
+        remaining[0] = per_producer * self.num_producers
+        
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            producer(per_producer, p) for p in range(self.num_producers)
+        ])
+        await done.wait()
+        duration = time.perf_counter() - start
+        
+        latencies.sort()
+        return {
+            'throughput': len(latencies) / duration,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000
+        }
+    
+    async def run(self):
+        print(f"QoS scheduler benchmark: {self.num_messages} messages from {self.num_producers} producers")
+        
+        legacy = await self._run(LegacyQoSManager())
+        
+        pool = QoSManager()
+        pool.start()
+        worker_pool = await self._run(pool)
+        await pool.stop()
+        
+        for name, result in [('task-per-message', legacy), ('worker pool', worker_pool)]:
+            print(f"{name:>17}: {result['throughput']:>10.0f} msg/s | "
+                  f"p50 {result['p50_ms']:.3f} ms | p99 {result['p99_ms']:.3f} ms")
+
+if __name__ == "__main__":
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    benchmark = QoSBenchmark(num_messages=num_messages)
+    asyncio.run(benchmark.run())
@@ -0,0 +1,72 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType, CODEC_JSON, CODEC_BINARY
+from room_manager import RoomManager
+
+class RoomHistoryBenchmark:
+    def __init__(self, num_messages=10000, replay_count=50, joins=2000):
+        self.num_messages = num_messages
+        self.replay_count = replay_count
+        self.joins = joins
+    
+    def _message(self, room_id, i):
+        return Message(
+            MessageType.TEXT_MESSAGE,
+            {
+                'username': f"user_{i % 20}",
+                'text': f"message number {i} " + "x" * (i % 200),
+                'timestamp': '2024-01-01T00:00:00'
+            },
+            room_id=room_id
+        )
+    
+    def run_test(self):
+        room_manager = RoomManager()
+        room_id = room_manager.create_room('history')
+        room_manager.join_room(room_id, 'client_0', 'user_0')
+        
+        messages = []
+        for i in range(self.num_messages):
+            message = self._message(room_id, i)
+            message.id = room_manager.next_message_id(room_id)
+            frames = {CODEC_JSON: message.to_bytes(CODEC_JSON)}  # as built by the broadcast
+            room_manager.add_history(room_id, message.id, frames)
+            messages.append(message)
+        
+        stats = room_manager.get_history_stats()
+        print(f"Room history after {self.num_messages} messages: "
+              f"{stats['messages']} kept, {stats['bytes'] / 1024:.1f} KB "
+              f"(cap {stats['max_bytes_per_room'] / 1024:.0f} KB)")
+        
+        # Replay from stored frames versus encoding the same messages for every join
+        recent = messages[-self.replay_count:]
+        for codec in (CODEC_JSON, CODEC_BINARY):
+            start = time.perf_counter()
+            for _ in range(self.joins):
+                frames, _, _, _ = room_manager.get_history(room_id, codec, limit=self.replay_count)
+                batch = b''.join(frames)
+            stored = (time.perf_counter() - start) / self.joins
+            
+            start = time.perf_counter()
+            for _ in range(self.joins):
+                batch = b''.join(message.to_bytes(codec) for message in recent)
+            encoded = (time.perf_counter() - start) / self.joins
+            
+            print(f"{codec:>6} replay of {self.replay_count}: stored frames {stored * 1e6:7.1f} µs | "
+                  f"re-encode {encoded * 1e6:7.1f} µs | {encoded / stored:5.1f}x | {len(batch)} bytes")
+        
+        stats = room_manager.get_history_stats()
+        if stats['bytes'] <= stats['max_bytes_per_room']:
+            print("History memory stays within its cap ✓")
+        else:
+            print("FAILED: history exceeded its byte cap")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    RoomHistoryBenchmark(num_messages=num_messages).run_test()
@@ -0,0 +1,73 @@
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).parent.parent / 'server'
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': elapsed,
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'plotting': sorted(name for name in ('matplotlib', 'numpy', 'PIL') if name in sys.modules)
+}}))
+"""
+
+class StartupBenchmark:
+    """Import time and peak RSS of a fresh interpreter loading the server,
+    each measured in its own process"""
+    def __init__(self, runs=5):
+        self.runs = runs
+        self.cases = {
+            'interpreter only': 'pass',
+            'performance_monitor': 'import performance_monitor',
+            'server': 'import server',
+            'matplotlib.pyplot': 'import matplotlib.pyplot'
+        }
+    
+    def measure(self, statement):
+        results = []
+        for _ in range(self.runs):
+            result = subprocess.run(
+                [sys.executable, '-c', PROBE.format(statement=statement)],
+                cwd=SERVER_DIR, capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                return None
+            results.append(json.loads(result.stdout.splitlines()[-1]))
+        return {
+            'seconds': statistics.median(r['seconds'] for r in results),
+            'rss_mb': statistics.median(r['rss_mb'] for r in results),
+            'plotting': results[0]['plotting']
+        }
+    
+    def run_test(self):
+        print(f"Startup benchmark: median of {self.runs} fresh interpreters")
+        print(f"{'import':>20} | {'time':>8} | {'peak RSS':>9} | plotting modules loaded")
+        print("-" * 70)
+        results = {}
+        for name, statement in self.cases.items():
+            results[name] = self.measure(statement)
+            if results[name] is None:
+                print(f"{name:>20} | not importable here")
+                continue
+            r = results[name]
+            print(f"{name:>20} | {r['seconds'] * 1000:>5.0f} ms | {r['rss_mb']:>6.1f} MB | "
+                  f"{', '.join(r['plotting']) or '-'}")
+        
+        if results['server'] is None:
+            print("FAILED: the server module does not import")
+            sys.exit(1)
+        if results['server']['plotting']:
+            print("FAILED: starting the server loads plotting libraries")
+            sys.exit(1)
+        print("The server starts without plotting libraries ✓")
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    StartupBenchmark(runs=runs).run_test()
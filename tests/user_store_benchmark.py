@@ -0,0 +1,102 @@
+import json
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from user_store import JsonUserStore, SQLiteUserStore
+
+# A real bcrypt hash has this shape; the benchmark never verifies it
+FAKE_HASH = '$2b$12$' + 'x' * 53
+
+def make_user(i):
+    return {
+        'id': f"{i:08d}-0000-0000-0000-000000000000",
+        'username': f"user_{i}",
+        'password': FAKE_HASH,
+        'created': '2025-01-01 00:00:00.000000'
+    }
+
+class UserStoreBenchmark:
+    def __init__(self, num_users=1000000, registrations=10000, json_registrations=20):
+        self.num_users = num_users
+        self.registrations = registrations
+        self.json_registrations = json_registrations
+    
+    def _seed_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({f"user_{i}": make_user(i) for i in range(self.num_users)}, f)
+    
+    def _bench_json(self, tmp_dir):
+        path = Path(tmp_dir) / 'users.json'
+        self._seed_json(path)
+        
+        start = time.perf_counter()
+        store = JsonUserStore(path)
+        startup = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for i in range(self.json_registrations):
+            store.add(make_user(self.num_users + i))
+        per_registration = (time.perf_counter() - start) / self.json_registrations
+        return startup, 1 / per_registration
+    
+    def _bench_sqlite(self, tmp_dir):
+        json_path = Path(tmp_dir) / 'users.json'
+        db_path = Path(tmp_dir) / 'users.db'
+        
+        # First start migrates the legacy file
+        start = time.perf_counter()
+        store = SQLiteUserStore(db_path, migrate_from=json_path)
+        migration = time.perf_counter() - start
+        store.close()
+        
+        start = time.perf_counter()
+        store = SQLiteUserStore(db_path, migrate_from=json_path)
+        startup = time.perf_counter() - start
+        
+        # Registrations arrive concurrently, as from the server's executor threads;
+        # each add() returns once committed, and waiting adds share a commit
+        first = self.num_users + self.json_registrations  # past the names added to users.json
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            added = list(executor.map(store.add, (make_user(first + i) for i in range(self.registrations))))
+        throughput = self.registrations / (time.perf_counter() - start)
+        
+        # The same name twice at once, from another worker's connection too: only one gets it
+        other = SQLiteUserStore(db_path)
+        taken = make_user(first + self.registrations)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            claims = list(executor.map(lambda s: s.add(dict(taken)), (store, other)))
+        other.close()
+        if not all(added) or sorted(claims) != [False, True] or store.add(make_user(0)):
+            print(f"FAILED: a username was registered twice ({claims})")
+            sys.exit(1)
+        
+        start = time.perf_counter()
+        for i in range(0, self.num_users, max(1, self.num_users // 10000)):
+            store.get(f"user_{i}")
+        lookups = min(self.num_users, 10000)
+        lookup_us = (time.perf_counter() - start) / lookups * 1_000_000
+        
+        store.close()
+        return migration, startup, throughput, lookup_us
+    
+    def run(self):
+        print(f"User store benchmark: {self.num_users} existing users")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_startup, json_throughput = self._bench_json(tmp_dir)
+            migration, startup, throughput, lookup_us = self._bench_sqlite(tmp_dir)
+        
+        print(f"users.json: startup {json_startup:.2f} s | {json_throughput:.1f} registrations/s")
+        print(f"SQLite:     startup {startup * 1000:.1f} ms | {throughput:.0f} registrations/s | "
+              f"lookup {lookup_us:.1f} us | one-time migration {migration:.2f} s")
+
+if __name__ == "__main__":
+    num_users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    benchmark = UserStoreBenchmark(num_users=num_users)
+    benchmark.run()
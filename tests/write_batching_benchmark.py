@@ -0,0 +1,115 @@
+import asyncio
+import ssl
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'server'))
+
+from common.protocol import Message, MessageType
+from connection_writer import ConnectionWriter
+from performance_monitor import PerformanceMonitor
+
+CERT_DIR = Path('certificates')
+
+class WriteBatchingBenchmark:
+    """Small chat frames fanned out to many connections over loopback.
+
+    Compares writing every frame on its own (max_batch_bytes=1) with the
+    batched writer. Uses TLS when certificates/ exists, as the server
+    does; run from the repository root.
+    """
+    def __init__(self, num_connections=50, num_bursts=400, burst_size=10):
+        self.num_connections = num_connections
+        self.num_bursts = num_bursts
+        self.burst_size = burst_size
+        self.frame = Message(
+            MessageType.TEXT_MESSAGE,
+            {
+                'username': 'bench',
+                'text': 'The quick brown fox jumps over the lazy dog',
+                'timestamp': '2025-01-01T00:00:00'
+            },
+            room_id='bench'
+        ).to_bytes()
+    
+    def _ssl_contexts(self):
+        if not (CERT_DIR / 'server-cert.pem').exists():
+            return None, None
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(CERT_DIR / 'server-cert.pem', CERT_DIR / 'server-key.pem')
+        client_context = ssl.create_default_context()
+        client_context.check_hostname = False
+        client_context.verify_mode = ssl.CERT_NONE
+        return server_context, client_context
+    
+    async def measure(self, max_batch_bytes):
+        monitor = PerformanceMonitor()
+        connections = []
+        accepted = asyncio.Queue()
+        
+        async def handle(reader, writer):
+            await accepted.put(writer)
+            await reader.read()  # hold the connection open until the client closes it
+        
+        server_context, client_context = self._ssl_contexts()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, ssl=server_context)
+        port = server.sockets[0].getsockname()[1]
+        
+        readers = []
+        for i in range(self.num_connections):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=client_context)
+            readers.append((reader, writer))
+            connections.append(ConnectionWriter(
+                f"client_{i}", await accepted.get(), monitor=monitor, max_batch_bytes=max_batch_bytes
+            ))
+        
+        expected = len(self.frame) * self.num_bursts * self.burst_size
+        
+        async def consume(reader):
+            received = 0
+            while received < expected:
+                received += len(await reader.read(256 * 1024))
+        
+        consumers = [asyncio.create_task(consume(reader)) for reader, _ in readers]
+        start = time.perf_counter()
+        for _ in range(self.num_bursts):
+            # One handler's worth of broadcasts, then back to the loop
+            for _ in range(self.burst_size):
+                for connection in connections:
+                    connection.send(self.frame)
+            await asyncio.sleep(0)
+        await asyncio.gather(*consumers)
+        elapsed = time.perf_counter() - start
+        
+        for connection in connections:
+            await connection.close()
+        for _, writer in readers:
+            writer.close()
+        server.close()
+        
+        stats = monitor.get_current_stats()
+        frames = self.num_connections * self.num_bursts * self.burst_size
+        return frames / elapsed, stats['frames_per_write'], stats['bytes_per_write']
+    
+    async def run_test(self):
+        transport = 'TLS' if self._ssl_contexts()[0] else 'plain TCP'
+        print(f"Write batching benchmark: {self.num_connections} connections over {transport}, "
+              f"{self.num_bursts} bursts of {self.burst_size} frames of {len(self.frame)} bytes")
+        
+        results = {}
+        for name, max_batch_bytes in [('per frame', 1), ('batched', 64 * 1024)]:
+            rate, frames_per_write, bytes_per_write = await self.measure(max_batch_bytes)
+            results[name] = rate
+            print(f"{name:>10}: {rate:>9.0f} frames/s | {frames_per_write:5.1f} frames/write | "
+                  f"{bytes_per_write:7.0f} bytes/write")
+        
+        if results['batched'] >= results['per frame']:
+            print(f"Batched writes {results['batched'] / results['per frame']:.2f}x faster ✓")
+        else:
+            print("FAILED: batched writes slower than one write per frame")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(WriteBatchingBenchmark().run_test())